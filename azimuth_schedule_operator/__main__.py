@@ -1,9 +1,14 @@
 import asyncio
+import functools
 import os
+import tracemalloc
 
 import kopf
 
-from . import metrics
+from . import debug, metrics, sharding, standby, workers
+from .utils import k8s
+
+LIVENESS_ENDPOINT = "http://0.0.0.0:8000/healthz"
 
 
 async def main():
@@ -11,22 +16,70 @@ async def main():
     Run the operator and the metrics server together.
     """
     # This import is required to pick up the operator handlers
-    from . import operator  # noqa: F401
+    from . import operator
 
     kopf_enable_debug_logging = False
 
     if os.environ.get("AZIMUTH_LEASE_KOPF_DEBUG_LOGGING_ENABLED", "false") != "false":
         kopf_enable_debug_logging = True
 
+    # Start tracing allocations before the operator starts, if required
+    if metrics.MEMORY_INSTRUMENTATION_ENABLED:
+        tracemalloc.start(metrics.TRACEMALLOC_FRAMES)
+
     kopf.configure(
         log_prefix=True,
         debug=kopf_enable_debug_logging,
     )
-    tasks = await kopf.spawn_tasks(
-        clusterwide=True, liveness_endpoint="http://0.0.0.0:8000/healthz"
-    )
+    # Start the workers that the handlers are offloaded to, if required
+    # The watches, in-memory indexes and metrics stay in this process
+    if workers.WORKERS:
+        workers.POOL = workers.WorkerPool(workers.WORKERS, operator.setup_client)
+        workers.POOL.start()
+    if sharding.SHARDING_ENABLED:
+        # The operator is run for the namespaces assigned to this replica, and is
+        # restarted by the coordinator whenever the assignment changes
+        # The replicas must not pause each other using kopf peering
+        coordinator = sharding.Coordinator(
+            k8s.get_k8s_client(),
+            functools.partial(
+                kopf.operator, standalone=True, liveness_endpoint=LIVENESS_ENDPOINT
+            ),
+        )
+        tasks = [asyncio.create_task(coordinator.run())]
+    elif standby.STANDBY_ENABLED:
+        # The operator is only run once this replica holds the leader lease
+        # Until then, the caches used by the handlers are kept warm
+        leader = standby.Standby(
+            k8s.get_k8s_client(),
+            functools.partial(
+                kopf.operator,
+                clusterwide=True,
+                standalone=True,
+                liveness_endpoint=LIVENESS_ENDPOINT,
+            ),
+        )
+        tasks = [asyncio.create_task(leader.run())]
+    else:
+        tasks = await kopf.spawn_tasks(
+            clusterwide=True, liveness_endpoint=LIVENESS_ENDPOINT
+        )
     tasks.append(asyncio.create_task(metrics.metrics_server()))
-    await kopf.run_tasks(tasks)
+    tasks.append(asyncio.create_task(metrics.monitor_event_loop()))
+    if metrics.MEMORY_INSTRUMENTATION_ENABLED:
+        tasks.append(asyncio.create_task(metrics.monitor_memory()))
+    if debug.DEBUG_ENABLED:
+        tasks.append(asyncio.create_task(debug.debug_server()))
+    if workers.POOL:
+        # If a worker exits, the whole operator exits
+        tasks.append(asyncio.create_task(workers.POOL.monitor()))
+    try:
+        await kopf.run_tasks(tasks)
+    finally:
+        if workers.POOL:
+            await workers.POOL.stop()
 
 
-asyncio.run(main())
+# The workers import this module under a different name, so must not run the operator
+if __name__ == "__main__":
+    asyncio.run(main())
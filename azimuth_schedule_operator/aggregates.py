@@ -0,0 +1,134 @@
+import bisect
+import collections
+
+from dateutil.parser import isoparse
+
+
+class LeaseAggregates:
+    """Aggregated lease counts, maintained incrementally as leases change."""
+
+    def __init__(self):
+        # Map of uid -> (namespace, phase, ends_at timestamp)
+        self._leases = {}
+        # Number of leases for each (namespace, phase)
+        self._phase_counts = collections.Counter()
+        # Sorted end timestamps for the leases in each namespace
+        self._ends_at = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._leases)
+
+    def _add(self, uid, namespace, phase, ends_at):
+        self._leases[uid] = (namespace, phase, ends_at)
+        self._phase_counts[(namespace, phase)] += 1
+        if ends_at is not None:
+            bisect.insort(self._ends_at[namespace], ends_at)
+
+    def _discard(self, uid):
+        if uid not in self._leases:
+            return
+        namespace, phase, ends_at = self._leases.pop(uid)
+        self._phase_counts[(namespace, phase)] -= 1
+        if self._phase_counts[(namespace, phase)] <= 0:
+            del self._phase_counts[(namespace, phase)]
+        if ends_at is not None:
+            ends_at_list = self._ends_at[namespace]
+            del ends_at_list[bisect.bisect_left(ends_at_list, ends_at)]
+            if not ends_at_list:
+                del self._ends_at[namespace]
+
+    def update(self, body):
+        """Update the aggregates with the given lease."""
+        ends_at = body.get("spec", {}).get("endsAt")
+        uid = body["metadata"]["uid"]
+        self._discard(uid)
+        self._add(
+            uid,
+            body["metadata"]["namespace"],
+            body.get("status", {}).get("phase", "Unknown"),
+            isoparse(ends_at).timestamp() if ends_at else None,
+        )
+
+    def remove(self, body):
+        """Remove the given lease from the aggregates."""
+        self._discard(body["metadata"]["uid"])
+
+    def remove_namespaces(self, namespaces):
+        """Remove the leases in the given namespaces from the aggregates."""
+        for uid, (namespace, _, _) in list(self._leases.items()):
+            if namespace in namespaces:
+                self._discard(uid)
+
+    def phase_counts(self):
+        """Returns an iterable of (namespace, phase, count) tuples."""
+        for (namespace, phase), count in self._phase_counts.items():
+            yield namespace, phase, count
+
+    def ending_between(self, start, end):
+        """
+        Returns an iterable of (namespace, count) tuples for leases that end in the
+        window (start, end], given as timestamps.
+        """
+        for namespace, ends_at_list in self._ends_at.items():
+            yield (
+                namespace,
+                (
+                    bisect.bisect_right(ends_at_list, end)
+                    - bisect.bisect_right(ends_at_list, start)
+                ),
+            )
+
+
+class ScheduleAggregates:
+    """Aggregated schedule counts, maintained incrementally as schedules change."""
+
+    def __init__(self):
+        # Map of uid -> (namespace, pending delete)
+        self._schedules = {}
+        # Number of schedules in each namespace
+        self._counts = collections.Counter()
+        # Number of schedules in each namespace that have not yet triggered a delete
+        self._pending_delete_counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._schedules)
+
+    def _discard(self, uid):
+        if uid not in self._schedules:
+            return
+        namespace, pending_delete = self._schedules.pop(uid)
+        self._counts[namespace] -= 1
+        if self._counts[namespace] <= 0:
+            del self._counts[namespace]
+        if pending_delete:
+            self._pending_delete_counts[namespace] -= 1
+
+    def update(self, body):
+        """Update the aggregates with the given schedule."""
+        uid = body["metadata"]["uid"]
+        namespace = body["metadata"]["namespace"]
+        pending_delete = not body.get("status", {}).get("refDeleteTriggered", False)
+        self._discard(uid)
+        self._schedules[uid] = (namespace, pending_delete)
+        self._counts[namespace] += 1
+        if pending_delete:
+            self._pending_delete_counts[namespace] += 1
+
+    def remove(self, body):
+        """Remove the given schedule from the aggregates."""
+        self._discard(body["metadata"]["uid"])
+
+    def remove_namespaces(self, namespaces):
+        """Remove the schedules in the given namespaces from the aggregates."""
+        for uid, (namespace, _) in list(self._schedules.items()):
+            if namespace in namespaces:
+                self._discard(uid)
+
+    def pending_delete_counts(self):
+        """Returns an iterable of (namespace, count) tuples."""
+        for namespace in self._counts:
+            yield namespace, self._pending_delete_counts[namespace]
+
+
+LEASES = LeaseAggregates()
+SCHEDULES = ScheduleAggregates()
@@ -0,0 +1,89 @@
+import time
+import weakref
+
+# The caches that have been created, so that they can be reported
+CACHES = weakref.WeakSet()
+
+
+class Cache:
+    """
+    A cache of values with an optional time-to-live for each entry and an optional
+    maximum number of entries, after which the oldest entries are removed.
+
+    The cache records the number of hits and misses so that its effectiveness can
+    be reported by the debug endpoints.
+    """
+
+    def __init__(self, name, ttl=None, max_size=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Map of key -> (value, stored at)
+        self._entries = {}
+        CACHES.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expired(self, stored_at, now):
+        return self.ttl is not None and now - stored_at >= self.ttl
+
+    def __contains__(self, key):
+        # Checking for a key does not count as a lookup
+        entry = self._entries.get(key)
+        return entry is not None and not self._expired(entry[1], time.monotonic())
+
+    def get(self, key, default=None):
+        """Returns the value for the key, or the default if there is no fresh value."""
+        entry = self._entries.get(key)
+        if entry is not None and self._expired(entry[1], time.monotonic()):
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        # Re-insert the key so that the entries stay in the order they were stored
+        self._entries.pop(key, None)
+        self._entries[key] = (value, now)
+        # Remove the entries that have expired or that take the cache over its size,
+        # which are the oldest entries
+        for key, (_, stored_at) in list(self._entries.items()):
+            if self._expired(stored_at, now) or (
+                self.max_size is not None and len(self._entries) > self.max_size
+            ):
+                del self._entries[key]
+            else:
+                break
+
+    def pop(self, key, default=None):
+        """Removes the value for the key from the cache and returns it."""
+        entry = self._entries.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def clear(self):
+        """Removes all the values from the cache."""
+        self._entries.clear()
+
+    def stats(self):
+        """Returns the statistics for the cache."""
+        now = time.monotonic()
+        ages = [now - stored_at for _, stored_at in self._entries.values()]
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._entries),
+            "ttl": self.ttl,
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / lookups if lookups else None,
+            "oldestAge": max(ages, default=None),
+            "newestAge": min(ages, default=None),
+        }
@@ -0,0 +1,131 @@
+import collections
+
+from dateutil.parser import isoparse
+
+from .utils import treap
+
+
+class ReservationTimeline(treap.Treap):
+    """
+    Timeline of the number of machines reserved over time.
+
+    The timeline is stored as the change in the number of reserved machines at each
+    time, so the number reserved at a time is the sum of the changes up to that time.
+    Each subtree maintains the sum of its changes and the maximum prefix sum, which
+    allows the peak reservation in a window to be found without visiting every lease.
+    """
+
+    def _aggregate(self, node):
+        left_sum, left_peak = node.left.aggregate if node.left else (0, 0)
+        right_sum, right_peak = node.right.aggregate if node.right else (0, 0)
+        total = left_sum + node.value
+        return total + right_sum, max(left_peak, total, total + right_peak)
+
+    def add(self, timestamp, delta):
+        """Adds the given change to the reservation at the given time."""
+        value = self.get(timestamp, 0) + delta
+        if value:
+            self[timestamp] = value
+        else:
+            self.pop(timestamp, None)
+
+    def reserved_at(self, timestamp):
+        """Returns the number of machines reserved at the given time."""
+        reserved = 0
+        node = self._root
+        while node is not None:
+            if node.key <= timestamp:
+                reserved += node.value + (node.left.aggregate[0] if node.left else 0)
+                node = node.right
+            else:
+                node = node.left
+        return reserved
+
+    def peak_between(self, start, end):
+        """Returns the peak number of machines reserved between the given times."""
+        reserved = self.reserved_at(start)
+        left, right = self._split(self._root, start, inclusive=True)
+        middle, right = self._split(right, end, inclusive=True)
+        peak = reserved + (middle.aggregate[1] if middle is not None else 0)
+        self._root = self._merge(self._merge(left, middle), right)
+        return peak
+
+
+class CapacityIndex:
+    """
+    Index of the machines reserved by leases over time, for each size.
+
+    The index is maintained incrementally as leases change.
+    """
+
+    def __init__(self):
+        # Map of lease uid -> (namespace, list of (size id, start, end, count))
+        self._leases = {}
+        # Map of size id -> reservation timeline
+        self._timelines = collections.defaultdict(ReservationTimeline)
+
+    def __len__(self):
+        return len(self._leases)
+
+    def _apply(self, reservations, sign):
+        for size_id, starts_at, ends_at, count in reservations:
+            timeline = self._timelines[size_id]
+            timeline.add(starts_at, sign * count)
+            # Leases with no end reserve the machines indefinitely
+            if ends_at is not None:
+                timeline.add(ends_at, -sign * count)
+            if not timeline:
+                del self._timelines[size_id]
+
+    def update(self, body):
+        """Update the index with the given lease."""
+        self.remove(body)
+        # Leases in the error phase do not reserve anything
+        if body.get("status", {}).get("phase") == "Error":
+            return
+        spec = body.get("spec", {})
+        starts_at = spec.get("startsAt") or body["metadata"]["creationTimestamp"]
+        ends_at = spec.get("endsAt")
+        reservations = [
+            (
+                machine["sizeId"],
+                isoparse(starts_at).timestamp(),
+                isoparse(ends_at).timestamp() if ends_at else None,
+                machine["count"],
+            )
+            for machine in spec.get("resources", {}).get("machines", [])
+        ]
+        metadata = body["metadata"]
+        self._leases[metadata["uid"]] = (metadata["namespace"], reservations)
+        self._apply(reservations, 1)
+
+    def _discard(self, uid):
+        _, reservations = self._leases.pop(uid, (None, []))
+        self._apply(reservations, -1)
+
+    def remove(self, body):
+        """Remove the given lease from the index."""
+        self._discard(body["metadata"]["uid"])
+
+    def remove_namespaces(self, namespaces):
+        """Remove the leases in the given namespaces from the index."""
+        for uid, (namespace, _) in list(self._leases.items()):
+            if namespace in namespaces:
+                self._discard(uid)
+
+    def size_ids(self):
+        """Returns the size IDs that have reservations."""
+        return list(self._timelines.keys())
+
+    def reserved_at(self, size_id, timestamp):
+        """Returns the number of machines of the size reserved at the given time."""
+        timeline = self._timelines.get(size_id)
+        return timeline.reserved_at(timestamp) if timeline else 0
+
+    def peak_between(self, size_id, start, end):
+        """Returns the peak number of machines of the size reserved in the window."""
+        timeline = self._timelines.get(size_id)
+        return timeline.peak_between(start, end) if timeline else 0
+
+
+CAPACITY = CapacityIndex()
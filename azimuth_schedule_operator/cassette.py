@@ -0,0 +1,269 @@
+import asyncio
+import base64
+import binascii
+import collections
+import datetime
+import json
+import os
+import pathlib
+import re
+import time
+import urllib.parse
+
+import httpx
+import yaml
+
+from .utils import transports
+
+# The directory to record API traffic to, if set
+# Each API is recorded to a separate cassette, e.g. kubernetes.jsonl
+CASSETTE_RECORD_DIR = os.environ.get("AZIMUTH_SCHEDULE_CASSETTE_RECORD_DIR")
+
+REDACTED = "REDACTED"
+
+# Headers that carry credentials, which are always redacted
+SENSITIVE_HEADERS = {
+    "authorization",
+    "cookie",
+    "proxy-authorization",
+    "set-cookie",
+    "x-auth-token",
+    "x-subject-token",
+}
+# String values with a matching key are redacted, in bodies and query strings
+# The match is on the end of the key, so that references such as the name of a
+# secret, e.g. cloudCredentialsSecretName, are kept
+SENSITIVE_KEY = re.compile(r"(secret|password|passwd|token|private_key)$", re.I)
+# Headers that describe the encoding of the body as it was sent on the wire
+# Bodies are recorded decoded, so these are dropped
+ENCODING_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+class InteractionNotFoundError(httpx.TransportError):
+    """Raised when there is no recorded interaction for a request being replayed."""
+
+
+def scrub(value):
+    """
+    Returns a copy of the given JSON value with any credentials redacted.
+
+    The data for Kubernetes secrets is also scrubbed, keeping the structure of
+    YAML documents, e.g. clouds.yaml, so that the secrets can still be used in replay.
+    """
+    if isinstance(value, dict):
+        scrubbed = {}
+        for key, item in value.items():
+            if isinstance(item, str) and SENSITIVE_KEY.search(key):
+                scrubbed[key] = REDACTED
+            else:
+                scrubbed[key] = scrub(item)
+        if value.get("kind") == "Secret":
+            scrub_secret(value, scrubbed)
+        # The items in a list of secrets do not have a kind
+        elif value.get("kind") == "SecretList" and isinstance(value.get("items"), list):
+            for item, scrubbed_item in zip(value["items"], scrubbed["items"]):
+                if isinstance(item, dict):
+                    scrub_secret(item, scrubbed_item)
+        return scrubbed
+    elif isinstance(value, list):
+        return [scrub(item) for item in value]
+    else:
+        return value
+
+
+def scrub_secret(secret, scrubbed):
+    """Scrubs the data for the given Kubernetes secret into the scrubbed copy."""
+    if isinstance(secret.get("data"), dict):
+        scrubbed["data"] = {
+            key: scrub_secret_value(item) for key, item in secret["data"].items()
+        }
+    if isinstance(secret.get("stringData"), dict):
+        scrubbed["stringData"] = {key: REDACTED for key in secret["stringData"]}
+
+
+def scrub_secret_value(encoded):
+    """Returns the scrubbed version of a base64-encoded value from a secret."""
+    try:
+        decoded = base64.b64decode(encoded, validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        decoded = None
+    # CA certificates are public, and are needed to use the credentials
+    if decoded and decoded.startswith("-----BEGIN CERTIFICATE-----"):
+        return encoded
+    try:
+        data = yaml.safe_load(decoded) if decoded else None
+    except yaml.YAMLError:
+        data = None
+    if isinstance(data, dict):
+        decoded = yaml.safe_dump(scrub(data))
+    else:
+        decoded = REDACTED
+    return base64.b64encode(decoded.encode()).decode()
+
+
+def scrub_headers(headers):
+    return {
+        name: REDACTED if name in SENSITIVE_HEADERS else value
+        for name, value in headers.items()
+        if name not in ENCODING_HEADERS
+    }
+
+
+def scrub_url(url):
+    """Returns the given URL with the values of any sensitive parameters redacted."""
+    url = httpx.URL(str(url))
+    if not url.query:
+        return str(url)
+    params = [
+        (name, REDACTED if SENSITIVE_KEY.search(name) else value)
+        for name, value in urllib.parse.parse_qsl(
+            url.query.decode(), keep_blank_values=True
+        )
+    ]
+    return str(url.copy_with(query=urllib.parse.urlencode(params).encode()))
+
+
+def encode_body(content):
+    """Returns the JSON representation of the given body, scrubbing JSON content."""
+    if not content:
+        return {}
+    try:
+        return {"json": scrub(json.loads(content))}
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return {"text": content.decode(errors="replace")}
+
+
+def decode_body(body):
+    if "json" in body:
+        return json.dumps(body["json"]).encode()
+    else:
+        return body.get("text", "").encode()
+
+
+class Cassette:
+    """
+    A file of recorded interactions with an API, stored as JSON lines.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    def append(self, interaction):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open("a") as fh:
+            fh.write(json.dumps(interaction) + "\n")
+
+    def load(self):
+        with self.path.open() as fh:
+            return [json.loads(line) for line in fh if line.strip()]
+
+
+class RecordingTransport(transports.WrappingTransport):
+    """
+    Transport that records the scrubbed requests and responses made using the
+    wrapped transport to a cassette, with the time taken for each request.
+    """
+
+    def __init__(self, transport, cassette):
+        super().__init__(transport)
+        self._cassette = cassette
+
+    async def handle_async_request(self, request):
+        request_content = await request.aread()
+        recorded_at = datetime.datetime.now(datetime.timezone.utc)
+        started_at = time.perf_counter()
+        response = await self._transport.handle_async_request(request)
+        try:
+            # Read the raw content so that the client can decode it as usual
+            raw = b"".join([chunk async for chunk in response.aiter_raw()])
+        finally:
+            await response.aclose()
+        duration = time.perf_counter() - started_at
+        response = httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            content=raw,
+            extensions=response.extensions,
+        )
+        self._cassette.append(
+            {
+                "recordedAt": recorded_at.isoformat(),
+                "durationSeconds": duration,
+                "request": {
+                    "method": request.method,
+                    "url": scrub_url(request.url),
+                    "headers": scrub_headers(request.headers),
+                    **encode_body(request_content),
+                },
+                "response": {
+                    "status": response.status_code,
+                    "headers": scrub_headers(response.headers),
+                    **encode_body(response.content),
+                },
+            }
+        )
+        return response
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+    Transport that serves the responses from a cassette.
+
+    Requests are matched using the method and URL. Where the same request was
+    recorded more than once, the responses are served in the order they were
+    recorded, with the last response repeated once they are exhausted. If timing
+    is enabled, each response is delayed by the time the original request took.
+
+    The number of requests for each operation is recorded, using the given function
+    to name the operation for a request.
+    """
+
+    def __init__(self, cassette, timing=True, operation=None):
+        self._timing = timing
+        self._operation = operation or (lambda r: f"{r.method} {r.url.path}")
+        # Map of (method, url) -> list of recorded interactions
+        self._interactions = collections.defaultdict(list)
+        for interaction in cassette.load():
+            request = interaction["request"]
+            key = (request["method"], request["url"])
+            self._interactions[key].append(interaction)
+        # Map of (method, url) -> number of times the request has been served
+        self._served = collections.Counter()
+        # The number of requests for each operation
+        self.calls = collections.Counter()
+
+    async def handle_async_request(self, request):
+        self.calls[self._operation(request)] += 1
+        key = (request.method, scrub_url(request.url))
+        interactions = self._interactions.get(key)
+        if not interactions:
+            raise InteractionNotFoundError(
+                f"no recorded interaction for {key[0]} {key[1]}", request=request
+            )
+        index = min(self._served[key], len(interactions) - 1)
+        self._served[key] += 1
+        interaction = interactions[index]
+        if self._timing:
+            await asyncio.sleep(interaction["durationSeconds"])
+        response = interaction["response"]
+        return httpx.Response(
+            response["status"],
+            headers=response["headers"],
+            content=decode_body(response),
+        )
+
+
+# Map of API name -> cassette, so that all the clients for an API share a cassette
+CASSETTES = {}
+
+
+def record(name, transport):
+    """
+    Returns a transport that records the traffic for the named API if recording
+    is enabled, otherwise the given transport is returned.
+    """
+    if not CASSETTE_RECORD_DIR:
+        return transport
+    if name not in CASSETTES:
+        CASSETTES[name] = Cassette(pathlib.Path(CASSETTE_RECORD_DIR) / f"{name}.jsonl")
+    return RecordingTransport(transport, CASSETTES[name])
@@ -0,0 +1,316 @@
+import asyncio
+import collections
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from aiohttp import web
+
+from . import aggregates, cache, capacity, metrics, timeline
+
+# Indicates whether the debug endpoints are enabled
+DEBUG_ENABLED = os.environ.get("AZIMUTH_SCHEDULE_DEBUG_ENABLED", "false") != "false"
+# The debug endpoints are only served on localhost, so they must be reached using
+# kubectl port-forward
+DEBUG_HOST = "127.0.0.1"
+DEBUG_PORT = int(os.environ.get("AZIMUTH_SCHEDULE_DEBUG_PORT", "8081"))
+
+# The default and maximum durations for a profile
+DEFAULT_PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 300
+# The default interval between stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.01
+# The supported profile formats
+PROFILE_FORMATS = {"text", "pstats", "collapsed"}
+# The module whose outermost frame is used to attribute samples to a handler
+HANDLER_MODULE = "azimuth_schedule_operator.operator"
+
+# Only one profile can run at once
+PROFILE_LOCK = asyncio.Lock()
+
+# The supported keys for grouping allocations
+MEMORY_KEYS = {"lineno", "filename", "traceback"}
+# The previous tracemalloc snapshot, which the next snapshot is compared to
+MEMORY_SNAPSHOT = None
+
+
+def format_frame(frame):
+    """Formats a frame for a collapsed stack."""
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", code.co_filename)
+    # Qualified names for code objects are only available from Python 3.11
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse_stack(frame):
+    """
+    Returns the collapsed stack for the given frame, prefixed with the handler that
+    the stack belongs to, if any.
+    """
+    frames = []
+    handler = None
+    while frame is not None:
+        frames.append(format_frame(frame))
+        if frame.f_globals.get("__name__") == HANDLER_MODULE:
+            handler = frame.f_code.co_name
+        frame = frame.f_back
+    if handler:
+        frames.append(f"handler:{handler}")
+    return ";".join(reversed(frames))
+
+
+def sample_stacks(thread_id, interval, stop, counts):
+    """
+    Samples the stack of the given thread at the given interval until stopped,
+    counting the samples for each collapsed stack.
+    """
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            counts[collapse_stack(frame)] += 1
+
+
+async def profile_collapsed(seconds, interval):
+    """
+    Samples the event loop thread for the given number of seconds and returns the
+    collapsed stacks, suitable for producing a flamegraph.
+    """
+    stop = threading.Event()
+    counts = collections.Counter()
+    sampler = threading.Thread(
+        target=sample_stacks,
+        args=(threading.get_ident(), interval, stop, counts),
+        daemon=True,
+    )
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        await asyncio.to_thread(sampler.join)
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+async def profile_cprofile(seconds):
+    """
+    Runs cProfile on the event loop thread for the given number of seconds and
+    returns the statistics.
+    """
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profile.disable()
+    return pstats.Stats(profile)
+
+
+def query_number(request, name, default, maximum, type=int):
+    """Parses the named number from the request, which must be in (0, maximum]."""
+    try:
+        value = type(request.query.get(name, default))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"invalid {name}")
+    if not 0 < value <= maximum:
+        raise web.HTTPBadRequest(text=f"{name} must be in (0, {maximum}]")
+    return value
+
+
+async def profile_handler(request):
+    """Profiles the event loop for a number of seconds.
+
+    The following query parameters are supported:
+
+      * seconds - the number of seconds to profile for
+      * format - one of text (the default), pstats or collapsed
+      * sort - the sort key for the text format, defaults to cumulative
+      * limit - the number of functions to include in the text format
+      * interval - the sampling interval in seconds for the collapsed format
+
+    The text and pstats formats use cProfile, where pstats is the marshalled
+    statistics that can be loaded using pstats.Stats. The collapsed format uses a
+    sampling profiler, and each stack is prefixed with the handler that it belongs
+    to, if any.
+    """
+    seconds = query_number(
+        request, "seconds", DEFAULT_PROFILE_SECONDS, MAX_PROFILE_SECONDS, float
+    )
+    interval = query_number(request, "interval", DEFAULT_SAMPLE_INTERVAL, 1, float)
+    limit = query_number(request, "limit", 50, 10000)
+    format = request.query.get("format", "text")
+    if format not in PROFILE_FORMATS:
+        raise web.HTTPBadRequest(text=f"invalid format: {format}")
+    sort = request.query.get("sort", "cumulative")
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise web.HTTPBadRequest(text=f"invalid sort: {sort}")
+    if PROFILE_LOCK.locked():
+        raise web.HTTPConflict(text="a profile is already running")
+    async with PROFILE_LOCK:
+        if format == "collapsed":
+            return web.Response(text=await profile_collapsed(seconds, interval))
+        stats = await profile_cprofile(seconds)
+    if format == "pstats":
+        return web.Response(
+            body=marshal.dumps(stats.stats), content_type="application/octet-stream"
+        )
+    stats.stream = io.StringIO()
+    stats.sort_stats(sort).print_stats(limit)
+    return web.Response(text=stats.stream.getvalue())
+
+
+def await_stack(task):
+    """
+    Returns the frames that the given task is currently waiting in, by following the
+    chain of awaits from the task's coroutine, outermost first.
+    """
+    frames = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(
+            awaitable, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(f"{format_frame(frame)}:{frame.f_lineno}")
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(
+            awaitable, "gi_yieldfrom", None
+        )
+    return frames
+
+
+async def tasks_handler(request):
+    """Returns the asyncio tasks, in-flight handler invocations and caches.
+
+    For each in-flight handler invocation, the object being processed and the age
+    of the invocation are reported, along with the task that it is running in. For
+    each cache, the size, hit ratio and the ages of the entries are reported.
+    """
+    now = time.monotonic()
+    invocations = list(metrics.HANDLER_INVOCATIONS.values())
+    handler_tasks = {
+        id(invocation["task"]): invocation["handler"] for invocation in invocations
+    }
+    tasks = [
+        {
+            "name": task.get_name(),
+            "handler": handler_tasks.get(id(task)),
+            "stack": await_stack(task),
+        }
+        for task in asyncio.all_tasks()
+    ]
+    handlers = [
+        {
+            "handler": invocation["handler"],
+            "task": invocation["task"].get_name() if invocation["task"] else None,
+            "kind": invocation["kind"],
+            "namespace": invocation["namespace"],
+            "name": invocation["name"],
+            "age": now - invocation["started_at"],
+        }
+        for invocation in sorted(invocations, key=lambda i: i["started_at"])
+    ]
+    return web.json_response(
+        {
+            "tasks": sorted(tasks, key=lambda t: t["name"]),
+            "handlers": handlers,
+            "caches": sorted(
+                (c.stats() for c in list(cache.CACHES)), key=lambda c: c["name"]
+            ),
+            "indexes": {
+                "leaseAggregates": len(aggregates.LEASES),
+                "scheduleAggregates": len(aggregates.SCHEDULES),
+                "capacity": len(capacity.CAPACITY),
+                "timeline": len(timeline.TIMELINE),
+            },
+        }
+    )
+
+
+def format_statistic(stat):
+    """Formats a tracemalloc statistic, or statistic diff, for output."""
+    return {
+        "traceback": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+        "size": stat.size,
+        "sizeDiff": getattr(stat, "size_diff", stat.size),
+        "count": stat.count,
+        "countDiff": getattr(stat, "count_diff", stat.count),
+    }
+
+
+def take_snapshot():
+    """Takes a tracemalloc snapshot, excluding the allocations made by tracemalloc."""
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+
+
+async def memory_handler(request):
+    """Returns the allocation sites that have grown the most since the last call.
+
+    Each call takes a tracemalloc snapshot and compares it to the snapshot from the
+    previous call. The first call reports the largest allocation sites instead.
+    Memory instrumentation must be enabled for allocations to be traced.
+
+    The following query parameters are supported:
+
+      * limit - the number of allocation sites to return, defaults to 20
+      * key - how to group allocations, one of lineno (the default), filename or
+        traceback
+    """
+    global MEMORY_SNAPSHOT
+    if not tracemalloc.is_tracing():
+        raise web.HTTPConflict(text="memory instrumentation is not enabled")
+    limit = query_number(request, "limit", 20, 1000)
+    key = request.query.get("key", "lineno")
+    if key not in MEMORY_KEYS:
+        raise web.HTTPBadRequest(text=f"invalid key: {key}")
+    # Taking and comparing snapshots can be slow, so do it in a thread
+    snapshot = await asyncio.to_thread(take_snapshot)
+    if MEMORY_SNAPSHOT is not None:
+        stats = await asyncio.to_thread(snapshot.compare_to, MEMORY_SNAPSHOT, key)
+    else:
+        stats = await asyncio.to_thread(snapshot.statistics, key)
+    first = MEMORY_SNAPSHOT is None
+    MEMORY_SNAPSHOT = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    return web.json_response(
+        {
+            "baseline": first,
+            "traced": {"current": current, "peak": peak},
+            "statistics": [format_statistic(stat) for stat in stats[:limit]],
+        }
+    )
+
+
+def debug_app():
+    """Returns the application for the debug endpoints."""
+    app = web.Application()
+    app.add_routes(
+        [
+            web.get("/debug/profile", profile_handler),
+            web.get("/debug/tasks", tasks_handler),
+            web.get("/debug/memory", memory_handler),
+        ]
+    )
+    return app
+
+
+async def debug_server():
+    """Launch a lightweight HTTP server to serve the debug endpoints."""
+    runner = web.AppRunner(debug_app(), handle_signals=False)
+    await runner.setup()
+
+    site = web.TCPSite(runner, DEBUG_HOST, DEBUG_PORT, shutdown_timeout=1.0)
+    await site.start()
+
+    # Sleep until we need to clean up
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await asyncio.shield(runner.cleanup())
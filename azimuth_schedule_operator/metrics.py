@@ -1,11 +1,48 @@
 import asyncio
+import bisect
+import collections
 import functools
+import gc
+import os
+import time
+import tracemalloc
+import zlib
 
 import easykube
+import httpx
+import kopf
 from aiohttp import web
 from dateutil.parser import isoparse
 
+from . import aggregates, capacity, timeline
 from .models import registry
+from .utils import clock, transports
+
+# Indicates whether the per-object metric families should be produced
+# When disabled, only the aggregated metric families are produced
+PER_OBJECT_METRICS_ENABLED = (
+    os.environ.get("AZIMUTH_SCHEDULE_PER_OBJECT_METRICS_ENABLED", "true") != "false"
+)
+# The role of this replica when using warm standbys, i.e. "leader" or "standby"
+# A standby builds the same in-memory indexes as the leader, so only the leader
+# reports the metrics for the objects, and the operator metrics are labelled by role
+ROLE = None
+# The window used for the leases ending soon metric
+LEASE_ENDING_SOON_SECONDS = 3600
+# The window used for the peak reserved machines metric
+CAPACITY_PEAK_WINDOW_SECONDS = int(
+    os.environ.get("AZIMUTH_SCHEDULE_CAPACITY_PEAK_WINDOW_SECONDS", "86400")
+)
+# Indicates whether memory instrumentation is enabled
+# When enabled, allocations are traced using tracemalloc and memory usage is sampled
+MEMORY_INSTRUMENTATION_ENABLED = (
+    os.environ.get("AZIMUTH_SCHEDULE_MEMORY_INSTRUMENTATION_ENABLED", "false")
+    != "false"
+)
+# The number of frames that tracemalloc records for each allocation
+TRACEMALLOC_FRAMES = 10
+# The number of object types to report counts for
+MEMORY_TOP_TYPES = 20
 
 
 class Metric:
@@ -41,6 +78,11 @@ class Metric:
         for obj in self._objs:
             yield self.labels(obj), self.value(obj)
 
+    def samples(self):
+        """Returns the samples for the metric, i.e. (name, labels, value) tuples."""
+        for labels, value in self.records():
+            yield self.name, labels, value
+
 
 class ScheduleMetric(Metric):
     prefix = "azimuth_schedule"
@@ -117,6 +159,482 @@ class LeaseEndsAt(LeaseMetric):
             return -1
 
 
+class AggregateMetric(Metric):
+    """Base class for metrics produced from the in-memory aggregates."""
+
+    type = "gauge"
+    # The label that contains the namespace for each record
+    # If not given, the records are only included when no namespaces are
+    # requested and only in the first shard
+    namespace_label = None
+
+    def __init__(self, namespaces=None, shard_index=0, shard_count=1):
+        super().__init__()
+        self._namespaces = set(namespaces or [])
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+
+    def aggregate_records(self):
+        """Returns the (labels, value) tuples for all namespaces."""
+        return []
+
+    def records(self):
+        if not self.namespace_label:
+            if not self._namespaces and self._shard_index == 0:
+                yield from self.aggregate_records()
+            return
+        for labels, value in self.aggregate_records():
+            namespace = labels[self.namespace_label]
+            if self._namespaces and namespace not in self._namespaces:
+                continue
+            # Aggregates are sharded by namespace rather than by object
+            shard = zlib.crc32(namespace.encode()) % self._shard_count
+            if shard != self._shard_index:
+                continue
+            yield labels, value
+
+
+class LeasePhaseCount(AggregateMetric):
+    prefix = "azimuth_lease"
+    suffix = "phase_count"
+    description = "The number of leases in each phase"
+    namespace_label = "lease_namespace"
+
+    def aggregate_records(self):
+        for namespace, phase, count in aggregates.LEASES.phase_counts():
+            yield {"lease_namespace": namespace, "phase": phase}, count
+
+
+class LeaseEndingSoonCount(AggregateMetric):
+    prefix = "azimuth_lease"
+    suffix = "ending_soon_count"
+    description = "The number of leases ending within the next hour"
+    namespace_label = "lease_namespace"
+
+    def aggregate_records(self):
+        now = clock.now().timestamp()
+        for namespace, count in aggregates.LEASES.ending_between(
+            now, now + LEASE_ENDING_SOON_SECONDS
+        ):
+            yield {"lease_namespace": namespace}, count
+
+
+class ScheduleDeletePendingCount(AggregateMetric):
+    prefix = "azimuth_schedule"
+    suffix = "delete_pending_count"
+    description = "The number of schedules that have not yet triggered a delete"
+    namespace_label = "schedule_namespace"
+
+    def aggregate_records(self):
+        for namespace, count in aggregates.SCHEDULES.pending_delete_counts():
+            yield {"schedule_namespace": namespace}, count
+
+
+class ReservedMachines(AggregateMetric):
+    prefix = "azimuth_capacity"
+    suffix = "reserved_machines"
+    description = "The number of machines of each size that are currently reserved"
+
+    def aggregate_records(self):
+        now = clock.now().timestamp()
+        for size_id in capacity.CAPACITY.size_ids():
+            yield {"size_id": size_id}, capacity.CAPACITY.reserved_at(size_id, now)
+
+
+class PeakReservedMachines(AggregateMetric):
+    prefix = "azimuth_capacity"
+    suffix = "peak_reserved_machines"
+    description = (
+        "The peak number of machines of each size that are reserved in the "
+        "upcoming window"
+    )
+
+    def aggregate_records(self):
+        now = clock.now().timestamp()
+        for size_id in capacity.CAPACITY.size_ids():
+            peak = capacity.CAPACITY.peak_between(
+                size_id, now, now + CAPACITY_PEAK_WINDOW_SECONDS
+            )
+            yield {"size_id": size_id}, peak
+
+
+class OperatorMetric(Metric):
+    """
+    Base class for metrics that describe the operator itself.
+
+    Unlike the other metrics, these are updated as the operator runs and live for
+    the lifetime of the process.
+    """
+
+    prefix = "azimuth_schedule_operator"
+
+    def __init__(self, suffix, description):
+        super().__init__()
+        self.suffix = suffix
+        self.description = description
+        # Map of label items -> value
+        self._values = {}
+        # Map of worker -> values reported by that worker process
+        self._worker_values = {}
+        OPERATOR_METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def records(self):
+        for key, value in self._values.items():
+            yield dict(key), value
+        for worker, values in self._worker_values.items():
+            for key, value in values.items():
+                yield {**dict(key), "worker": worker}, value
+
+
+class Counter(OperatorMetric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter with the given labels."""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for labels, value in self.records():
+            yield f"{self.name}_total", labels, value
+
+
+class Gauge(OperatorMetric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        """Set the value of the gauge with the given labels."""
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        """Increment the gauge with the given labels."""
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrement the gauge with the given labels."""
+        self.inc(-amount, **labels)
+
+    def clear(self):
+        """Remove the values for all labels."""
+        self._values.clear()
+
+
+class Histogram(OperatorMetric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+        30.0,
+        60.0,
+    )
+
+    def __init__(self, suffix, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(suffix, description)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record an observation with the given labels."""
+        key = self._key(labels)
+        if key not in self._values:
+            # The count for each bucket, the overall count and the sum
+            self._values[key] = [[0] * len(self._buckets), 0, 0]
+        bucket_counts, _, _ = record = self._values[key]
+        index = bisect.bisect_left(self._buckets, value)
+        if index < len(self._buckets):
+            bucket_counts[index] += 1
+        record[1] += 1
+        record[2] += value
+
+    def samples(self):
+        for labels, (bucket_counts, count, total) in self.records():
+            cumulative = 0
+            for bucket, bucket_count in zip(self._buckets, bucket_counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {**labels, "le": str(bucket)}, cumulative
+            yield f"{self.name}_bucket", {**labels, "le": "+Inf"}, count
+            yield f"{self.name}_count", labels, count
+            yield f"{self.name}_sum", labels, total
+
+
+# The metrics that describe the operator itself
+OPERATOR_METRICS = []
+
+API_REQUESTS = Counter(
+    "api_requests",
+    "The number of requests made to the Kubernetes and OpenStack APIs",
+)
+API_REQUEST_DURATION = Histogram(
+    "api_request_duration_seconds",
+    "The time taken for requests to the Kubernetes and OpenStack APIs",
+)
+HANDLER_DURATION = Histogram(
+    "handler_duration_seconds",
+    "The time taken for operator handlers to run",
+)
+HANDLERS_IN_FLIGHT = Gauge(
+    "handlers_in_flight",
+    "The number of operator handlers that are currently running",
+)
+
+# Buckets for delays that are measured against the check interval
+DELAY_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+TIMER_LAG = Histogram(
+    "timer_lag_seconds",
+    "The time between when a timer was due to fire and when it actually fired",
+    buckets=DELAY_BUCKETS,
+)
+DELETION_LATENESS = Histogram(
+    "deletion_lateness_seconds",
+    "The time between when a delete was due and when it was issued",
+    buckets=DELAY_BUCKETS,
+)
+LEASE_PHASE_LATENCY = Histogram(
+    "lease_phase_latency_seconds",
+    (
+        "The time taken for a lease to enter a phase, measured from creation for "
+        "Pending, from the start time for Active and from the end time for "
+        "Terminated and Deleting"
+    ),
+    buckets=DELAY_BUCKETS,
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds",
+    "The most recently sampled delay in the asyncio event loop",
+)
+OPENSTACK_REQUEST_WAIT = Histogram(
+    "openstack_request_wait_seconds",
+    "The time that requests to OpenStack waited for the per-host limits",
+)
+OPENSTACK_REQUESTS_WAITING = Gauge(
+    "openstack_requests_waiting",
+    "The number of requests to OpenStack that are waiting for the per-host limits",
+)
+OPENSTACK_REQUEST_RETRIES = Counter(
+    "openstack_request_retries",
+    "The number of idempotent requests to OpenStack that were retried",
+)
+OPENSTACK_CIRCUIT_STATE = Gauge(
+    "openstack_circuit_state",
+    "The state of the circuit breaker for each cloud (0=closed, 1=half-open, 2=open)",
+)
+OPENSTACK_CIRCUIT_REJECTED = Counter(
+    "openstack_circuit_rejected_requests",
+    "The number of requests to OpenStack that failed fast due to an open circuit",
+)
+SHARD_MEMBERS = Gauge(
+    "shard_members",
+    "The number of live replicas in the shard group, as seen by this replica",
+)
+SHARD_NAMESPACES = Gauge(
+    "shard_namespaces",
+    "The number of namespaces that are assigned to this replica",
+)
+WORK_QUEUE_DEPTH = Gauge(
+    "work_queue_depth",
+    "The number of handlers that are waiting for a slot, by tenant and priority band",
+)
+WORK_QUEUE_WAIT = Histogram(
+    "work_queue_wait_seconds",
+    "The time that handlers waited for a slot, by tenant and priority band",
+)
+STANDBY_LEADER = Gauge(
+    "standby_leader",
+    "1 if this replica holds the leader lease and runs the operator, 0 otherwise",
+)
+FAILOVER_DURATION = Gauge(
+    "failover_seconds",
+    (
+        "The time from the loss of the previous leader until this replica had taken "
+        "over and issued the deletions that were due"
+    ),
+)
+
+MEMORY_RSS = Gauge(
+    "memory_rss_bytes",
+    "The resident set size of the operator process",
+)
+MEMORY_PYTHON_HEAP = Gauge(
+    "memory_python_heap_bytes",
+    "The memory allocated by Python, as traced by tracemalloc",
+)
+MEMORY_OBJECTS = Gauge(
+    "memory_objects",
+    "The number of objects tracked by the garbage collector for the most common types",
+)
+
+
+def worker_snapshot():
+    """Returns the values of the operator metrics, for reporting from a worker."""
+    return {metric.name: metric._values for metric in OPERATOR_METRICS}
+
+
+def update_worker_values(worker, snapshot):
+    """Updates the operator metrics with the values reported by a worker."""
+    for metric in OPERATOR_METRICS:
+        if metric.name in snapshot:
+            metric._worker_values[worker] = snapshot[metric.name]
+
+
+class InstrumentedTransport(transports.WrappingTransport):
+    """
+    Transport that records the requests to the given service, with the operation
+    for each request given by the operation function.
+
+    Requests that fail without a response, e.g. because the connection could not be
+    made, are recorded with a status of "timeout" or "error".
+    """
+
+    def __init__(self, transport, service, operation):
+        super().__init__(transport)
+        self._service = service
+        self._operation = operation
+
+    async def handle_async_request(self, request):
+        labels = {"service": self._service, "operation": self._operation(request)}
+        started_at = time.monotonic()
+        status = "error"
+        try:
+            response = await self._transport.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        except httpx.TimeoutException:
+            status = "timeout"
+            raise
+        finally:
+            API_REQUESTS.inc(**labels, status=status)
+            API_REQUEST_DURATION.observe(
+                time.monotonic() - started_at, **labels, status=status
+            )
+
+
+# The handler invocations that are currently in flight, indexed by a unique token
+HANDLER_INVOCATIONS = {}
+
+
+def instrument_handler(handler):
+    """Decorator that records the duration and outcome of a handler."""
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started_at = time.monotonic()
+        status = "success"
+        HANDLERS_IN_FLIGHT.inc(handler=handler.__name__)
+        token = object()
+        body = kwargs.get("body") or {}
+        metadata = body.get("metadata", {})
+        HANDLER_INVOCATIONS[token] = {
+            "handler": handler.__name__,
+            "started_at": started_at,
+            "task": asyncio.current_task(),
+            "kind": body.get("kind"),
+            "namespace": metadata.get("namespace"),
+            "name": metadata.get("name"),
+        }
+        try:
+            return await handler(*args, **kwargs)
+        except kopf.TemporaryError:
+            status = "retry"
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            HANDLERS_IN_FLIGHT.dec(handler=handler.__name__)
+            HANDLER_INVOCATIONS.pop(token, None)
+            HANDLER_DURATION.observe(
+                time.monotonic() - started_at,
+                handler=handler.__name__,
+                status=status,
+            )
+
+    return wrapper
+
+
+def instrument_timer(interval):
+    """
+    Decorator that records how late a timer fires compared to when it was due.
+
+    Kopf timers are due the given interval after the previous invocation finished.
+    The finish time is kept in the per-object memo that kopf passes to handlers.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            memo = kwargs.get("memo")
+            if memo is not None and "timer_finished_at" in memo:
+                due_at = memo["timer_finished_at"] + interval
+                TIMER_LAG.observe(
+                    max(time.monotonic() - due_at, 0), handler=handler.__name__
+                )
+            try:
+                return await handler(*args, **kwargs)
+            finally:
+                if memo is not None:
+                    memo["timer_finished_at"] = time.monotonic()
+
+        return wrapper
+
+    return decorator
+
+
+async def monitor_event_loop(interval=1.0):
+    """Periodically sample how far behind the event loop is running."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(loop.time() - started_at - interval, 0))
+
+
+def read_rss():
+    """Returns the resident set size of the current process in bytes."""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def type_name(cls):
+    """Returns the qualified name of the given type."""
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def sample_memory(top_types=MEMORY_TOP_TYPES):
+    """Sample the memory usage of the operator process."""
+    try:
+        MEMORY_RSS.set(read_rss())
+    except OSError:
+        pass
+    if tracemalloc.is_tracing():
+        MEMORY_PYTHON_HEAP.set(tracemalloc.get_traced_memory()[0])
+    counts = collections.Counter(type_name(type(obj)) for obj in gc.get_objects())
+    # The most common types change over time, so replace the previous values
+    MEMORY_OBJECTS.clear()
+    for name, count in counts.most_common(top_types):
+        MEMORY_OBJECTS.set(count, type=name)
+
+
+async def monitor_memory(interval=60.0):
+    """Periodically sample the memory usage of the operator process."""
+    while True:
+        sample_memory()
+        await asyncio.sleep(interval)
+
+
 def escape(content):
     """Escape the given content for use in metric output."""
     return content.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
@@ -135,6 +653,21 @@ def format_value(value):
         return formatted
 
 
+class WithLabels:
+    """Wraps a metric so that the given labels are added to each of its samples."""
+
+    def __init__(self, metric, **labels):
+        self._metric = metric
+        self._labels = labels
+
+    def __getattr__(self, name):
+        return getattr(self._metric, name)
+
+    def samples(self):
+        for name, labels, value in self._metric.samples():
+            yield name, {**labels, **self._labels}, value
+
+
 def render_openmetrics(*metrics):
     """Renders the metrics using OpenMetrics text format."""
     output = []
@@ -143,14 +676,14 @@ def render_openmetrics(*metrics):
             output.append(f"# HELP {metric.name} {escape(metric.description)}\n")
         output.append(f"# TYPE {metric.name} {metric.type}\n")
 
-        for labels, value in metric.records():
+        for name, labels, value in metric.samples():
             if labels:
                 labelstr = "{{{}}}".format(
                     ",".join([f'{k}="{escape(v)}"' for k, v in sorted(labels.items())])
                 )
             else:
                 labelstr = ""
-            output.append(f"{metric.name}{labelstr} {format_value(value)}\n")
+            output.append(f"{name}{labelstr} {format_value(value)}\n")
     output.append("# EOF\n")
 
     return (
@@ -174,29 +707,118 @@ METRICS = {
 }
 
 
+AGGREGATE_METRICS = [
+    LeasePhaseCount,
+    LeaseEndingSoonCount,
+    ScheduleDeletePendingCount,
+    ReservedMachines,
+    PeakReservedMachines,
+]
+
+
+def parse_shard(shard):
+    """Parse a shard selector of the form i/n into an (index, count) tuple."""
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"invalid shard selector: {shard}")
+    if count < 1 or not 0 <= index < count:
+        raise web.HTTPBadRequest(text=f"invalid shard selector: {shard}")
+    return index, count
+
+
+def shard_for_obj(obj, count):
+    """Returns the shard that the given object belongs to."""
+    return zlib.crc32(obj.metadata.uid.encode()) % count
+
+
+async def list_objects(ekresource, namespaces):
+    """Lists the objects for the resource, optionally restricted to the namespaces."""
+    if namespaces:
+        for namespace in namespaces:
+            async for obj in ekresource.list(namespace=namespace):
+                yield obj
+    else:
+        async for obj in ekresource.list(all_namespaces=True):
+            yield obj
+
+
 async def metrics_handler(ekclient, request):
-    """Produce metrics for the operator."""
+    """Produce metrics for the operator.
+
+    The metrics can be filtered using the following query parameters:
+
+      * namespace - only include objects from the given namespace (repeatable)
+      * family - only include the named metric family (repeatable)
+      * shard - only include objects in shard i of n, given as i/n
+    """
+    namespaces = request.query.getall("namespace", [])
+    families = set(request.query.getall("family", []))
+    shard = request.query.get("shard")
+    shard_index, shard_count = parse_shard(shard) if shard else (0, 1)
+
     metrics = []
-    for api_group, resources in METRICS.items():
-        ekapi = await ekclient.api_preferred_version(api_group)
+    # A standby reports only its own operator metrics, as the leader reports the
+    # metrics for the objects
+    is_standby = ROLE == "standby"
+    per_object_metrics = (
+        METRICS if PER_OBJECT_METRICS_ENABLED and not is_standby else {}
+    )
+    for api_group, resources in per_object_metrics.items():
+        ekapi = None
         for resource, metric_classes in resources.items():
+            resource_metrics = [
+                metric
+                for metric in (klass() for klass in metric_classes)
+                if not families or metric.name in families
+            ]
+            # Avoid listing the objects at all if no families are required
+            if not resource_metrics:
+                continue
+            if not ekapi:
+                ekapi = await ekclient.api_preferred_version(api_group)
             ekresource = await ekapi.resource(resource)
-            resource_metrics = [klass() for klass in metric_classes]
-            async for obj in ekresource.list(all_namespaces=True):
+            async for obj in list_objects(ekresource, namespaces):
+                if shard_count > 1 and shard_for_obj(obj, shard_count) != shard_index:
+                    continue
                 for metric in resource_metrics:
                     metric.add_obj(obj)
             metrics.extend(resource_metrics)
 
+    # The aggregated metrics are produced from memory without listing objects
+    if not is_standby:
+        metrics.extend(
+            metric
+            for metric in (
+                klass(namespaces, shard_index, shard_count)
+                for klass in AGGREGATE_METRICS
+            )
+            if not families or metric.name in families
+        )
+    # The operator metrics are not namespaced, so are only included when no
+    # namespaces are requested and only in the first shard
+    if not namespaces and shard_index == 0:
+        metrics.extend(
+            WithLabels(metric, role=ROLE) if ROLE else metric
+            for metric in OPERATOR_METRICS
+            if not families or metric.name in families
+        )
+
     content_type, content = render_openmetrics(*metrics)
     return web.Response(headers={"Content-Type": content_type}, body=content)
 
 
 async def metrics_server():
-    """Launch a lightweight HTTP server to serve the metrics endpoint."""
+    """Launch a lightweight HTTP server to serve the metrics and timeline endpoints."""
     ekclient = easykube.Configuration.from_environment().async_client()
 
     app = web.Application()
-    app.add_routes([web.get("/metrics", functools.partial(metrics_handler, ekclient))])
+    app.add_routes(
+        [
+            web.get("/metrics", functools.partial(metrics_handler, ekclient)),
+            web.get("/timeline/leases", timeline.timeline_handler),
+        ]
+    )
 
     runner = web.AppRunner(app, handle_signals=False)
     await runner.setup()
@@ -3,6 +3,8 @@ import datetime as dt
 from kube_custom_resource import CustomResource, schema
 from pydantic import Field
 
+from azimuth_schedule_operator.utils import clock
+
 
 class Machine(schema.BaseModel):
     """Represents a reservation for a machine."""
@@ -89,9 +91,25 @@ class LeaseStatus(schema.BaseModel, extra="allow"):
         default_factory=dict,
         description="Mapping of original size name to reserved size name.",
     )
+    phase_transitions: schema.Dict[str, dt.datetime] = Field(
+        default_factory=dict,
+        description="The time at which the lease first entered each phase.",
+    )
+    owners_delete_requested_at: schema.Optional[dt.datetime] = Field(
+        None,
+        description=(
+            "The time at which the deletion of the owners of the lease was requested."
+        ),
+    )
+    blazar_lease_id: schema.Optional[str] = Field(
+        None, description="The ID of the Blazar lease for the lease, if known."
+    )
 
     def set_phase(self, phase: LeasePhase, error_message: str | None = None):
         """Set the phase of the lease, along with an optional error message."""
+        # Only record the time for a phase the first time it is entered
+        if phase != self.phase:
+            self.phase_transitions.setdefault(phase.value, clock.now())
         self.phase = phase
         self.error_message = error_message if phase == LeasePhase.ERROR else ""
 
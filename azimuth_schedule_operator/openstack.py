@@ -1,12 +1,74 @@
 import asyncio
 import base64
 import contextlib
+import datetime
+import email.utils
+import os
+import random
+import re
+import time
 import urllib.parse
 
 import httpx
+import kopf
 import yaml
+from dateutil.parser import isoparse
 from easykube import rest
 
+from . import cache, cassette, metrics, workqueue
+from .utils import clock, transports
+
+# The maximum number of concurrent requests to each OpenStack host, 0 for no limit
+MAX_CONCURRENCY = int(
+    os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_MAX_CONCURRENCY", "50")
+)
+# The maximum rate of requests per second to each OpenStack host, 0 for no limit
+RATE_LIMIT = float(os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_RATE_LIMIT", "0"))
+# The number of requests that can be made at once before the rate limit applies
+# By default, this is one second's worth of requests
+RATE_BURST = int(os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_RATE_BURST", "0"))
+
+# The number of consecutive failed requests to a cloud that open its circuit
+CIRCUIT_FAILURE_THRESHOLD = int(
+    os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_CIRCUIT_FAILURE_THRESHOLD", "5")
+)
+# The time that a circuit stays open before a request is allowed to probe the cloud
+CIRCUIT_RESET_SECONDS = float(
+    os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_CIRCUIT_RESET_SECONDS", "60")
+)
+# Response statuses that indicate that the cloud is unhealthy
+CIRCUIT_FAILURE_STATUSES = {502, 503, 504}
+
+# The maximum number of times that an idempotent request is retried, 0 to disable
+RETRY_ATTEMPTS = int(os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_RETRY_ATTEMPTS", "3"))
+# The base and maximum delay between retries, which grows exponentially with jitter
+RETRY_BACKOFF_BASE = float(
+    os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_RETRY_BACKOFF_BASE", "0.5")
+)
+RETRY_BACKOFF_MAX = float(
+    os.environ.get("AZIMUTH_SCHEDULE_OPENSTACK_RETRY_BACKOFF_MAX", "10")
+)
+# Only requests that can safely be repeated are retried
+RETRY_METHODS = {"GET", "HEAD", "DELETE"}
+# Response statuses that indicate a transient problem with the cloud
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# The request extension that marks an attempt that will be retried if it fails
+# The circuit breaker only records the outcome of the final attempt for a request, so
+# that each request counts once towards opening the circuit
+RETRY_PENDING_EXTENSION = "azimuth_schedule_retry_pending"
+
+# The authenticated sessions for each cloud, i.e. the token and the service catalog,
+# that are saved by a standby replica so that the handlers can skip authentication
+# Sessions are kept for at most the default lifetime of a Keystone token, and the
+# number of sessions is bounded so that sessions for deleted credentials do not build up
+SESSIONS = cache.Cache("openstack-sessions", ttl=3600, max_size=1000)
+# Saved sessions are not used once their token is within this time of expiring
+SESSION_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+# Path segments that are used to name the operation for a request
+# Segments that are not entirely lower case words, e.g. IDs and versions, are ignored
+OPERATION_SEGMENT = re.compile(r"^[a-z_]+$")
+
 
 class UnsupportedAuthenticationError(Exception):
     """Raised when an unsupported authentication method is used."""
@@ -33,6 +95,10 @@ class Auth(httpx.Auth):
         self._application_credential_secret = application_credential_secret
         self._token = None
         self._user_id = None
+        self._expires_at = None
+        # The saved session that the token was restored from, if any
+        self._session_key = None
+        self._restored_token = None
         self._lock = asyncio.Lock()
 
     @contextlib.asynccontextmanager
@@ -67,20 +133,286 @@ class Auth(httpx.Auth):
     def _handle_token_response(self, response):
         response.raise_for_status()
         self._token = response.headers["X-Subject-Token"]
-        self._user_id = response.json()["token"]["user"]["id"]
+        token = response.json()["token"]
+        self._user_id = token["user"]["id"]
+        self._expires_at = (
+            isoparse(token["expires_at"]) if "expires_at" in token else None
+        )
+
+    def restore(self, session_key, token, user_id, expires_at):
+        """Uses the token from the given saved session instead of authenticating."""
+        self._session_key = session_key
+        self._token = self._restored_token = token
+        self._user_id = user_id
+        self._expires_at = expires_at
 
     async def async_auth_flow(self, request):
-        if self._token is None:
-            async with self._refresh_token():
-                response = yield self._build_token_request()
-                await response.aread()
-                self._handle_token_response(response)
-        request.headers["X-Auth-Token"] = self._token
-        # TODO(johngarbutt): this is needed for blazar
-        request.headers["Content-Type"] = "application/json"
-        # TODO(johngarbutt): this is needed for nova flavor extra spec info
-        request.headers["X-OpenStack-Nova-API-Version"] = "2.61"
-        response = yield request
+        while True:
+            if self._token is None:
+                async with self._refresh_token():
+                    response = yield self._build_token_request()
+                    await response.aread()
+                    self._handle_token_response(response)
+            request.headers["X-Auth-Token"] = self._token
+            # TODO(johngarbutt): this is needed for blazar
+            request.headers["Content-Type"] = "application/json"
+            # TODO(johngarbutt): this is needed for nova flavor extra spec info
+            request.headers["X-OpenStack-Nova-API-Version"] = "2.61"
+            response = yield request
+            # A restored token may have been revoked since it was saved, in which case
+            # we authenticate and try again
+            if (
+                response.status_code != 401
+                or request.headers["X-Auth-Token"] != self._restored_token
+            ):
+                return
+            if self._token == self._restored_token:
+                SESSIONS.pop(self._session_key)
+                self._token = None
+
+
+class HostLimiter:
+    """
+    Limits the concurrency and rate of requests to a single host.
+
+    The rate is limited using a token bucket, which is refilled at the given rate
+    up to the burst size.
+    """
+
+    def __init__(self, max_concurrency=0, rate=0, burst=0):
+        self._semaphore = (
+            asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        )
+        self._rate = rate
+        self._burst = burst or max(int(rate), 1)
+        self._tokens = self._burst
+        self._updated_at = time.monotonic()
+        # Only one request at a time waits for a token, so they are served in order
+        self._lock = asyncio.Lock()
+
+    async def _take_token(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._burst, self._tokens + (now - self._updated_at) * self._rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, host):
+        """Context manager that waits until a request to the host can be made."""
+        started_at = time.monotonic()
+        metrics.OPENSTACK_REQUESTS_WAITING.inc(host=host)
+        try:
+            if self._semaphore:
+                await self._semaphore.acquire()
+            try:
+                if self._rate:
+                    await self._take_token()
+            except BaseException:
+                if self._semaphore:
+                    self._semaphore.release()
+                raise
+        finally:
+            metrics.OPENSTACK_REQUESTS_WAITING.dec(host=host)
+        metrics.OPENSTACK_REQUEST_WAIT.observe(time.monotonic() - started_at, host=host)
+        try:
+            yield
+        finally:
+            if self._semaphore:
+                self._semaphore.release()
+
+
+# Map of host -> limiter, shared by all the clouds that use the host
+LIMITERS = {}
+
+
+class LimitedTransport(transports.WrappingTransport):
+    """
+    Transport that applies the per-host limits to the requests made using the
+    wrapped transport.
+    """
+
+    async def handle_async_request(self, request):
+        host = request.url.netloc.decode()
+        if host not in LIMITERS:
+            LIMITERS[host] = HostLimiter(MAX_CONCURRENCY, RATE_LIMIT, RATE_BURST)
+        async with LIMITERS[host].limit(host):
+            response = await self._transport.handle_async_request(request)
+            # Read the body while the request still holds its place
+            await response.aread()
+        return response
+
+
+class CircuitOpenError(kopf.TemporaryError):
+    """Raised when a request fails fast because the circuit for the cloud is open."""
+
+    def __init__(self, auth_url, delay):
+        super().__init__(f"circuit is open for cloud at {auth_url}", delay=delay)
+        self.auth_url = auth_url
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for the requests to a single cloud.
+
+    The circuit opens after the given number of consecutive failures, after which
+    requests fail fast. Once the reset time has passed, the circuit is half-open and
+    a single request is allowed to probe the cloud. If the probe succeeds, the
+    circuit closes, otherwise it opens again.
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, auth_url, failure_threshold, reset_seconds):
+        self.auth_url = auth_url
+        self._failure_threshold = failure_threshold
+        self._reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.OPENSTACK_CIRCUIT_STATE.set(state, auth_url=self.auth_url)
+
+    def _reject(self, delay):
+        metrics.OPENSTACK_CIRCUIT_REJECTED.inc(auth_url=self.auth_url)
+        raise CircuitOpenError(self.auth_url, max(delay, 1))
+
+    def before_request(self):
+        """Called before each request, raising if the request should fail fast."""
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self._reset_seconds - time.monotonic()
+            if remaining > 0:
+                self._reject(remaining)
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            # Only allow one request at a time to probe the cloud
+            if self._probing:
+                self._reject(self._reset_seconds)
+            self._probing = True
+
+    def record_success(self):
+        self._failures = 0
+        self._probing = False
+        if self.state != self.CLOSED:
+            self._set_state(self.CLOSED)
+
+    def record_abandoned(self):
+        """Called when a request ends without telling us anything about the cloud."""
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        self._probing = False
+        if self.state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+            self._opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+
+# Map of auth URL -> circuit breaker, shared by all the clouds that use the auth URL
+BREAKERS = {}
+
+
+class CircuitBreakerTransport(transports.WrappingTransport):
+    """
+    Transport that fails fast when the circuit for the cloud is open, and records
+    the outcome of each request made using the wrapped transport.
+    """
+
+    def __init__(self, transport, breaker):
+        super().__init__(transport)
+        self._breaker = breaker
+
+    async def handle_async_request(self, request):
+        self._breaker.before_request()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.TransportError:
+            self._record_failure(request)
+            raise
+        except BaseException:
+            # Other errors, e.g. cancellation, say nothing about the cloud
+            self._breaker.record_abandoned()
+            raise
+        if response.status_code in CIRCUIT_FAILURE_STATUSES:
+            self._record_failure(request)
+        else:
+            self._breaker.record_success()
+        return response
+
+    def _record_failure(self, request):
+        # A failed attempt that will be retried is not counted, so that a request
+        # only counts as one failure however many times it is retried
+        if request.extensions.get(RETRY_PENDING_EXTENSION):
+            self._breaker.record_abandoned()
+        else:
+            self._breaker.record_failure()
+
+
+def circuit_breaker(auth_url):
+    """Returns the circuit breaker for the given auth URL."""
+    if auth_url not in BREAKERS:
+        BREAKERS[auth_url] = CircuitBreaker(
+            auth_url, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS
+        )
+    return BREAKERS[auth_url]
+
+
+def request_operation(request):
+    """Returns the name of the operation for the given request."""
+    segments = [
+        segment
+        for segment in request.url.path.split("/")
+        if OPERATION_SEGMENT.match(segment)
+    ]
+    return f"{request.method} {'/'.join(segments)}"
+
+
+def retry_after(response):
+    """
+    Returns the delay in seconds requested by the Retry-After header of the given
+    response, or None if there is no valid header.
+    """
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        return None
+    return max((retry_at - clock.now()).total_seconds(), 0)
+
+
+def retry_delay(attempt, response=None):
+    """
+    Returns the delay before the given retry attempt, starting from zero.
+
+    The delay is chosen at random up to a limit that grows exponentially with each
+    attempt, so that clients that failed at the same time do not retry in lockstep.
+    If the cloud asked for a delay using Retry-After, that is respected instead.
+    Both are capped at the maximum backoff.
+    """
+    requested = retry_after(response) if response is not None else None
+    if requested is not None:
+        return min(requested, RETRY_BACKOFF_MAX)
+    limit = min(RETRY_BACKOFF_BASE * 2**attempt, RETRY_BACKOFF_MAX)
+    return random.uniform(0, limit)
 
 
 class Resource(rest.Resource):
@@ -143,6 +475,44 @@ class Client(rest.AsyncClient):
         # Prevent individual clients from being used in a context manager
         raise RuntimeError("clients must be used via a cloud object")
 
+    async def send(self, request, **kwargs):
+        """
+        Sends the given request, retrying idempotent requests that fail with a
+        transient error, so that a blip costs a request rather than a handler retry.
+
+        Only the outcome of the final attempt counts towards the circuit breaker for
+        the cloud. A handler gives up its slot in the work queue while it waits to
+        retry, so that other work can run.
+        """
+        attempt = 0
+        while True:
+            # The statuses that count as failures for the circuit breaker are all
+            # retried, so any failure is retried while there are attempts left
+            request.extensions[RETRY_PENDING_EXTENSION] = (
+                request.method in RETRY_METHODS and attempt < RETRY_ATTEMPTS
+            )
+            try:
+                return await super().send(request, **kwargs)
+            except (httpx.TransportError, httpx.HTTPStatusError) as exc:
+                response = getattr(exc, "response", None)
+                if (
+                    request.method not in RETRY_METHODS
+                    or attempt >= RETRY_ATTEMPTS
+                    or (
+                        response is not None
+                        and response.status_code not in RETRY_STATUSES
+                    )
+                ):
+                    raise
+                delay = retry_delay(attempt, response)
+                reason = str(response.status_code) if response is not None else "error"
+                metrics.OPENSTACK_REQUEST_RETRIES.inc(
+                    host=request.url.netloc.decode(), reason=reason
+                )
+                async with workqueue.released():
+                    await asyncio.sleep(delay)
+                attempt += 1
+
     def resource(self, name, prefix=None, plural_name=None, singular_name=None):
         # If an additional prefix is given, combine it with the existing prefix
         if prefix:
@@ -164,11 +534,56 @@ class Cloud:
         # A map of api name to client
         self._clients = {}
 
+    @property
+    def _session_key(self):
+        return (
+            self._auth.url,
+            self._auth._application_credential_id,
+            self._interface,
+            self._region,
+        )
+
+    def _restore_session(self):
+        session = SESSIONS.get(self._session_key)
+        if session is None:
+            return False
+        token, user_id, expires_at, endpoints = session
+        if expires_at - clock.now() < SESSION_EXPIRY_MARGIN:
+            SESSIONS.pop(self._session_key)
+            return False
+        self._auth.restore(self._session_key, token, user_id, expires_at)
+        self._endpoints = endpoints
+        return True
+
+    def save_session(self):
+        """
+        Saves the token and service catalog for the cloud, so that other cloud objects
+        for the same credential can use them without authenticating.
+        """
+        if self.is_authenticated and self._auth._expires_at:
+            SESSIONS[self._session_key] = (
+                self._auth._token,
+                self._auth._user_id,
+                self._auth._expires_at,
+                self._endpoints,
+            )
+
+    def forget_session(self):
+        """Removes the saved session for the cloud, e.g. once the credential is gone."""
+        SESSIONS.pop(self._session_key)
+
     async def __aenter__(self):
         await self._transport.__aenter__()
+        # If there is a saved session for the cloud, there is no need to authenticate
+        if self._restore_session():
+            return self
         # Once the transport has been initialised, we can initialise the endpoints
         client = Client(
-            base_url=self._auth.url, auth=self._auth, transport=self._transport
+            base_url=self._auth.url,
+            auth=self._auth,
+            transport=metrics.InstrumentedTransport(
+                self._transport, "identity", request_operation
+            ),
         )
         # We have to slightly artificially create the catalog URL as we don't
         # benefit from the prefix handling that the resources use
@@ -222,14 +637,23 @@ class Cloud:
                 base_url=self._endpoints[name],
                 prefix=prefix,
                 auth=self._auth,
-                transport=self._transport,
+                transport=metrics.InstrumentedTransport(
+                    self._transport, name, request_operation
+                ),
                 **kwargs,
             )
         return self._clients[name]
 
 
-def from_clouds(clouds, cloud, cacert):
-    """Returns an OpenStack cloud object from the content of a clouds file."""
+def from_clouds(clouds, cloud, cacert, transport=None):
+    """
+    Returns an OpenStack cloud object from the content of a clouds file.
+
+    If a transport is given, it is used for all requests instead of an HTTP transport
+    created from the config, e.g. to serve requests from an in-process fake. In both
+    cases, the per-host concurrency and rate limits and the circuit breaker for the
+    cloud are applied.
+    """
     config = clouds["clouds"][cloud]
     if config["auth_type"] != "v3applicationcredential":
         raise UnsupportedAuthenticationError(config["auth_type"])
@@ -238,22 +662,32 @@ def from_clouds(clouds, cloud, cacert):
         config["auth"]["application_credential_id"],
         config["auth"]["application_credential_secret"],
     )
-    # Create a default context using the verification from the config
-    context = httpx.create_ssl_context(verify=config.get("verify", True))
-    # If a cacert was given, load it into the context
-    if cacert is not None:
-        context.load_verify_locations(cadata=cacert)
-    transport = httpx.AsyncHTTPTransport(verify=context)
+    if transport is None:
+        # Create a default context using the verification from the config
+        context = httpx.create_ssl_context(verify=config.get("verify", True))
+        # If a cacert was given, load it into the context
+        if cacert is not None:
+            context.load_verify_locations(cadata=cacert)
+        transport = cassette.record(
+            "openstack", httpx.AsyncHTTPTransport(verify=context)
+        )
+    # Requests fail fast if the cloud is unhealthy, before waiting for the limits
+    transport = CircuitBreakerTransport(
+        LimitedTransport(transport), circuit_breaker(auth.url)
+    )
     return Cloud(
-        auth, transport, config.get("interface", "public"), config.get("region_name")
+        auth,
+        transport,
+        config.get("interface", "public"),
+        config.get("region_name"),
     )
 
 
-def from_secret_data(secret_data):
+def from_secret_data(secret_data, transport=None):
     """Returns an OpenStack cloud object from the given secret data."""
     clouds = yaml.safe_load(base64.b64decode(secret_data["clouds.yaml"]))
     if "cacert" in secret_data:
         cacert = base64.b64decode(secret_data["cacert"]).decode()
     else:
         cacert = None
-    return from_clouds(clouds, next(c for c in clouds["clouds"]), cacert)
+    return from_clouds(clouds, next(c for c in clouds["clouds"]), cacert, transport)
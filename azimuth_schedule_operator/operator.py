@@ -9,8 +9,19 @@ import sys
 import easykube
 import httpx
 import kopf
-
-from azimuth_schedule_operator import openstack
+from dateutil.parser import isoparse
+
+from azimuth_schedule_operator import (
+    aggregates,
+    cache,
+    capacity,
+    metrics,
+    openstack,
+    sharding,
+    timeline,
+    workers,
+    workqueue,
+)
 from azimuth_schedule_operator.models import registry
 from azimuth_schedule_operator.models.v1alpha1 import (
     lease as lease_crd,
@@ -18,10 +29,12 @@ from azimuth_schedule_operator.models.v1alpha1 import (
 from azimuth_schedule_operator.models.v1alpha1 import (
     schedule as schedule_crd,
 )
-from azimuth_schedule_operator.utils import k8s
+from azimuth_schedule_operator.utils import clock, k8s
 
 LOG = logging.getLogger(__name__)
 K8S_CLIENT = None
+# Indicates whether the CRDs have been applied by this process
+CRDS_APPLIED = False
 
 CHECK_INTERVAL_SECONDS = int(
     os.environ.get(
@@ -44,6 +57,27 @@ LEASE_DEFAULT_GRACE_PERIOD_SECONDS = int(
 # Valid values are "yes", "no" and "auto"
 # The default is "auto", which means Blazar will be used iff it is available
 LEASE_BLAZAR_ENABLED = os.environ.get("AZIMUTH_LEASE_BLAZAR_ENABLED", "auto")
+# The maximum number of owners of a lease that are deleted or checked at once
+OWNER_DELETE_CONCURRENCY = 5
+# The delay before first checking whether a Blazar lease has been deleted
+# The delay is doubled for each subsequent check, up to the maximum
+BLAZAR_DELETE_POLL_INITIAL_SECONDS = 1
+BLAZAR_DELETE_POLL_MAX_SECONDS = 15
+# The time to wait for a Blazar lease to be deleted before the handler is retried
+# The handler gives up its slot in the work queue while it waits between checks
+BLAZAR_DELETE_WAIT_SECONDS = 300
+
+# The time for which the cloud credentials that are pre-populated by a standby
+# replica are used, after which the handlers fetch them again
+WARM_CACHE_TTL_SECONDS = 120
+# The time for which the pre-populated flavors are used
+# Flavors rarely change, and the handlers fetch the flavors if any that they need are
+# missing, so the flavors are kept for longer
+FLAVOR_CACHE_TTL_SECONDS = 1200
+# The cloud credential secret data for each (namespace, name)
+CREDENTIALS = cache.Cache("cloud-credentials", ttl=WARM_CACHE_TTL_SECONDS)
+# The flavor names for each application credential, by flavor ID
+FLAVOR_NAMES = cache.Cache("flavor-names", ttl=FLAVOR_CACHE_TTL_SECONDS)
 
 
 @kopf.on.startup()
@@ -60,15 +94,26 @@ async def startup(settings, **kwargs):
     )
     # Apply kopf setting to force watches to restart periodically
     settings.watching.client_timeout = int(os.environ.get("KOPF_WATCH_TIMEOUT", "600"))
-    global K8S_CLIENT
-    K8S_CLIENT = k8s.get_k8s_client()
-    # Create or update the CRDs
+    await setup_client()
+    # A standby replica applies the CRDs before it takes over
+    if CRDS_APPLIED:
+        return
+    try:
+        await apply_crds()
+    except Exception:
+        LOG.error("CRDs are not available - exiting")
+        sys.exit(1)
+
+
+async def apply_crds():
+    """Creates or updates the CRDs and waits for their APIs to be available."""
+    global CRDS_APPLIED
     for crd in registry.get_crd_resources():
         try:
             await K8S_CLIENT.apply_object(crd, force=True)
         except Exception:
-            LOG.exception("error applying CRD %s - exiting", crd["metadata"]["name"])
-            sys.exit(1)
+            LOG.exception("error applying CRD %s", crd["metadata"]["name"])
+            raise
     LOG.info("All CRDs updated.")
     # Give Kubernetes a chance to create the APIs for the CRDs
     await asyncio.sleep(0.5)
@@ -84,14 +129,29 @@ async def startup(settings, **kwargs):
         try:
             _ = await K8S_CLIENT.get(f"/apis/{api_version}/{plural_name}")
         except Exception:
-            LOG.exception("api for %s not available - exiting", crd["metadata"]["name"])
-            sys.exit(1)
+            LOG.exception("api for %s not available", crd["metadata"]["name"])
+            raise
+    CRDS_APPLIED = True
+
+
+async def setup_client():
+    """
+    Creates the Kubernetes client for the handlers, if it does not already exist.
+
+    As well as the startup handler, this is used to prepare the worker processes and
+    standby replicas, which do not run the startup handler.
+    """
+    global K8S_CLIENT
+    if K8S_CLIENT is None:
+        K8S_CLIENT = k8s.get_k8s_client()
 
 
 @kopf.on.cleanup()
 async def cleanup(**_):
+    global K8S_CLIENT
     if K8S_CLIENT:
         await K8S_CLIENT.aclose()
+        K8S_CLIENT = None
     LOG.info("Cleanup complete.")
 
 
@@ -150,10 +210,13 @@ async def update_schedule_status(namespace: str, name: str, status_updates: dict
 
 
 async def check_for_delete(namespace: str, schedule: schedule_crd.Schedule):
-    now = datetime.datetime.now(datetime.timezone.utc)
+    now = clock.now()
     if now >= schedule.spec.not_after:
         LOG.info(f"Attempting delete for {namespace} and {schedule.metadata.name}.")
         await delete_reference(namespace, schedule.spec.ref)
+        metrics.DELETION_LATENESS.observe(
+            (now - schedule.spec.not_after).total_seconds(), kind="schedule"
+        )
         await update_schedule(
             namespace, schedule.metadata.name, ref_delete_triggered=True
         )
@@ -167,7 +230,7 @@ async def update_schedule(
     ref_exists: bool | None = None,
     ref_delete_triggered: bool | None = None,
 ):
-    now = datetime.datetime.now(datetime.timezone.utc)
+    now = clock.now()
     now_string = now.strftime("%Y-%m-%dT%H:%M:%SZ")
     status_updates = dict(updatedAt=now_string)
 
@@ -180,7 +243,28 @@ async def update_schedule(
     await update_schedule_status(namespace, name, status_updates)
 
 
+@kopf.on.event(registry.API_GROUP, "schedule")
+async def schedule_event(type, body, **_):
+    """Keep the in-memory schedule aggregates up to date."""
+    if type == "DELETED":
+        aggregates.SCHEDULES.remove(body)
+    else:
+        aggregates.SCHEDULES.update(body)
+
+
+def schedule_deadline(body, **_):
+    """Returns the time at which the ref for the schedule is due to be deleted."""
+    # The body is not validated here, as this runs before waiting in the queue
+    if body.get("status", {}).get("refDeleteTriggered"):
+        return None
+    return isoparse(body["spec"]["notAfter"])
+
+
 @kopf.timer(registry.API_GROUP, "schedule", interval=CHECK_INTERVAL_SECONDS)
+@workqueue.prioritise(schedule_deadline)
+@metrics.instrument_handler
+@metrics.instrument_timer(CHECK_INTERVAL_SECONDS)
+@workers.offload
 async def schedule_check(body, namespace, **_):
     schedule = schedule_crd.Schedule(**body)
 
@@ -203,6 +287,50 @@ async def find_blazar_lease(blazar_client, lease_name):
     )
 
 
+async def get_blazar_lease(blazar_client, lease):
+    """
+    Returns the Blazar lease for the given lease, or None if it does not exist.
+
+    If the ID of the Blazar lease is recorded in the status, it is fetched directly
+    rather than searching all the Blazar leases in the project.
+    """
+    if not lease.status.blazar_lease_id:
+        return await find_blazar_lease(blazar_client, f"az-{lease.metadata.name}")
+    try:
+        return await blazar_client.resource("leases").fetch(
+            lease.status.blazar_lease_id
+        )
+    except httpx.HTTPStatusError as exc:
+        if exc.response.status_code == 404:
+            return None
+        raise
+
+
+async def wait_for_blazar_lease_delete(
+    blazar_client, lease_id, delay=BLAZAR_DELETE_POLL_INITIAL_SECONDS
+):
+    """
+    Waits for the Blazar lease with the given ID to be deleted, checking with a delay
+    that starts at the given delay and grows after each check.
+
+    Returns True if the lease was deleted, False if it still exists after the wait.
+    """
+    leases = blazar_client.resource("leases")
+    waited = 0
+    while waited + delay <= BLAZAR_DELETE_WAIT_SECONDS:
+        async with workqueue.released():
+            await asyncio.sleep(delay)
+        waited += delay
+        try:
+            await leases.fetch(lease_id)
+        except httpx.HTTPStatusError as exc:
+            if exc.response.status_code == 404:
+                return True
+            raise
+        delay = min(delay * 2, BLAZAR_DELETE_POLL_MAX_SECONDS)
+    return False
+
+
 def blazar_enabled(cloud):
     """Returns True if Blazar should be used, False otherwise."""
     if LEASE_BLAZAR_ENABLED == "yes":
@@ -274,13 +402,42 @@ def get_size_map(blazar_lease):
     return size_map
 
 
-async def get_size_name_map(cloud, size_map):
-    """Produce a size name map for the given size map."""
+async def fetch_cloud_credentials(lease):
+    """Returns the data from the cloud credential secret for the lease."""
+    key = (lease.metadata.namespace, lease.spec.cloud_credentials_secret_name)
+    data = CREDENTIALS.get(key)
+    if data is None:
+        secrets = await K8S_CLIENT.api("v1").resource("secrets")
+        secret = await secrets.fetch(key[1], namespace=key[0])
+        data = secret.data
+    return data
+
+
+async def fetch_flavor_names(cloud):
+    """Returns a map of flavor ID -> name for the flavors visible to the cloud."""
     compute_client = cloud.api_client("compute")
-    flavor_names = {
+    return {
         flavor.id: flavor.name
         async for flavor in compute_client.resource("flavors").list()
     }
+
+
+async def get_flavor_names(cloud, flavor_ids):
+    """
+    Returns a map of flavor ID -> name that includes the given flavors, if they exist.
+
+    The cached flavors are only used if they include all the given flavors, as Blazar
+    creates a new flavor for each reservation.
+    """
+    flavor_names = FLAVOR_NAMES.get(cloud.application_credential_id)
+    if flavor_names is None or not set(flavor_ids) <= flavor_names.keys():
+        flavor_names = await fetch_flavor_names(cloud)
+    return flavor_names
+
+
+async def get_size_name_map(cloud, size_map):
+    """Produce a size name map for the given size map."""
+    flavor_names = await get_flavor_names(cloud, [*size_map.keys(), *size_map.values()])
     size_name_map = {}
     for original_id, new_id in size_map.items():
         try:
@@ -293,7 +450,7 @@ async def get_size_name_map(cloud, size_map):
 async def update_lease_status_no_blazar(cloud, lease):
     """Updates the lease status when Blazar is not used for the lease."""
     if lease.spec.starts_at:
-        now = datetime.datetime.now(datetime.timezone.utc)
+        now = clock.now()
         lease_started = now >= lease.spec.starts_at
     else:
         # No start date means start now
@@ -310,10 +467,58 @@ async def update_lease_status_no_blazar(cloud, lease):
         lease.status.set_phase(lease_crd.LeasePhase.PENDING)
 
 
+def observe_phase_transitions(lease, previous, blazar):
+    """
+    Records the latency for each phase that the lease has entered since the given
+    phase transitions, labelled with whether Blazar is used for the lease.
+    """
+    created_at = lease.metadata.creation_timestamp
+    for phase, entered_at in lease.status.phase_transitions.items():
+        if phase in previous:
+            continue
+        if phase == lease_crd.LeasePhase.PENDING:
+            since = created_at
+        elif phase == lease_crd.LeasePhase.ACTIVE:
+            since = max(filter(None, [created_at, lease.spec.starts_at]), default=None)
+        elif phase in (lease_crd.LeasePhase.TERMINATED, lease_crd.LeasePhase.DELETING):
+            # Leases that are deleted before they end are not late
+            since = lease.spec.ends_at
+            if since and entered_at < since:
+                continue
+        else:
+            continue
+        if since is None:
+            continue
+        metrics.LEASE_PHASE_LATENCY.observe(
+            max((entered_at - since).total_seconds(), 0),
+            lease_namespace=lease.metadata.namespace,
+            phase=phase,
+            path="blazar" if blazar else "no_blazar",
+        )
+
+
+@kopf.on.event(registry.API_GROUP, "lease")
+async def lease_event(type, body, **_):
+    """Keep the in-memory lease aggregates and indexes up to date."""
+    if type == "DELETED":
+        aggregates.LEASES.remove(body)
+        capacity.CAPACITY.remove(body)
+        timeline.TIMELINE.remove(body)
+    else:
+        aggregates.LEASES.update(body)
+        capacity.CAPACITY.update(body)
+        timeline.TIMELINE.update(body)
+
+
 @kopf.on.create(registry.API_GROUP, "lease")
-@kopf.on.resume(registry.API_GROUP, "lease")
+@kopf.on.resume(registry.API_GROUP, "lease", when=sharding.needs_resume)
+@workqueue.prioritise()
+@metrics.instrument_handler
+@workers.offload
 async def reconcile_lease(body, logger, **_):
     lease = lease_crd.Lease.model_validate(body)
+    # The latencies are recorded once we know whether Blazar is used
+    transitions = dict(lease.status.phase_transitions)
 
     # Put the lease into a pending state as soon as possible
     if lease.status.phase == lease_crd.LeasePhase.UNKNOWN:
@@ -321,24 +526,21 @@ async def reconcile_lease(body, logger, **_):
         await save_instance_status(lease)
 
     # Create a cloud instance from the referenced credential secret
-    secrets = await K8S_CLIENT.api("v1").resource("secrets")
-    cloud_creds = await secrets.fetch(
-        lease.spec.cloud_credentials_secret_name, namespace=lease.metadata.namespace
-    )
-    async with openstack.from_secret_data(cloud_creds.data) as cloud:
+    cloud_creds = await fetch_cloud_credentials(lease)
+    async with openstack.from_secret_data(cloud_creds) as cloud:
         # If the lease has no end date, we don't attempt to use Blazar
         if not lease.spec.ends_at:
             logger.info("lease has no end date")
             await update_lease_status_no_blazar(cloud, lease)
             await save_instance_status(lease)
+            observe_phase_transitions(lease, transitions, False)
             return
 
         # If the lease has an end date, we might need to do some Blazar stuff
         if blazar_enabled(cloud):
             blazar_client = cloud.api_client("reservation", timeout=30)
             logger.info("checking if blazar lease exists")
-            blazar_lease_name = f"az-{lease.metadata.name}"
-            blazar_lease = await find_blazar_lease(blazar_client, blazar_lease_name)
+            blazar_lease = await get_blazar_lease(blazar_client, lease)
             if not blazar_lease:
                 # NOTE(mkjpryor)
                 #
@@ -356,12 +558,13 @@ async def reconcile_lease(body, logger, **_):
                     logger.info("creating blazar lease")
                     try:
                         blazar_lease = await create_blazar_lease(
-                            blazar_client, blazar_lease_name, lease
+                            blazar_client, f"az-{lease.metadata.name}", lease
                         )
                     except BlazarLeaseCreateError as exc:
                         logger.error(str(exc))
                         lease.status.set_phase(lease_crd.LeasePhase.ERROR, str(exc))
                         await save_instance_status(lease)
+                        observe_phase_transitions(lease, transitions, True)
                         return
                 else:
                     phase = lease.status.phase.name
@@ -370,6 +573,7 @@ async def reconcile_lease(body, logger, **_):
             if blazar_lease:
                 blazar_lease_status = blazar_lease["status"]
                 logger.info(f"blazar lease has status '{blazar_lease_status}'")
+                lease.status.blazar_lease_id = blazar_lease["id"]
                 lease.status.set_phase(lease_crd.LeasePhase[blazar_lease_status])
                 if lease.status.phase == lease_crd.LeasePhase.ACTIVE:
                     lease.status.size_map = get_size_map(blazar_lease)
@@ -378,15 +582,136 @@ async def reconcile_lease(body, logger, **_):
                     )
                 # Save the current status of the lease
                 await save_instance_status(lease)
+            observe_phase_transitions(lease, transitions, True)
         else:
             # We are not using Blazar
             # We just control the phase based on the start and end times
             logger.info("not attempting to use blazar")
             await update_lease_status_no_blazar(cloud, lease)
             await save_instance_status(lease)
+            observe_phase_transitions(lease, transitions, False)
             return
 
 
+def delete_threshold(lease):
+    """Returns the time at which the owners of the lease should be deleted."""
+    # Use the grace period before the end of the lease from the lease, if given
+    grace_period = (
+        lease.spec.grace_period
+        if lease.spec.grace_period is not None
+        else LEASE_DEFAULT_GRACE_PERIOD_SECONDS
+    )
+    return lease.spec.ends_at - datetime.timedelta(seconds=grace_period)
+
+
+def lease_deadline(body, **_):
+    """Returns the time at which the owners of the lease are due to be deleted."""
+    # The body is not validated here, as this runs before waiting in the queue
+    spec = body.get("spec", {})
+    if not spec.get("endsAt") or body.get("status", {}).get("ownersDeleteRequestedAt"):
+        return None
+    grace_period = spec.get("gracePeriod")
+    if grace_period is None:
+        grace_period = LEASE_DEFAULT_GRACE_PERIOD_SECONDS
+    return isoparse(spec["endsAt"]) - datetime.timedelta(seconds=grace_period)
+
+
+async def for_each_owner(lease, func):
+    """
+    Calls the given coroutine function for each owner of the lease, with a bounded
+    number of calls at once.
+
+    Every call completes before the first error, if any, is raised.
+    """
+    semaphore = asyncio.Semaphore(OWNER_DELETE_CONCURRENCY)
+
+    async def call(owner):
+        async with semaphore:
+            resource = await K8S_CLIENT.api(owner.api_version).resource(owner.kind)
+            await func(resource, owner)
+
+    results = await asyncio.gather(
+        *(call(owner) for owner in lease.metadata.owner_references),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def delete_owner(resource, owner, namespace):
+    """Deletes the given owner of a lease."""
+    await resource.delete(
+        owner.name,
+        # Make sure that we block the owner from deleting, if configured
+        propagation_policy="Foreground",
+        namespace=namespace,
+    )
+
+
+async def delete_owners(lease):
+    """
+    Deletes the owners of the lease, e.g. the platform that is using it, and records
+    that the deletion was requested in the status of the lease.
+
+    The status is not saved, so that the caller can include the change in its write.
+    """
+    namespace = lease.metadata.namespace
+    await for_each_owner(
+        lease,
+        lambda resource, owner: delete_owner(resource, owner, namespace),
+    )
+    lease.status.owners_delete_requested_at = clock.now()
+
+
+async def verify_owners_deleting(lease):
+    """
+    Checks that the owners of a lease whose deletion was already requested are gone
+    or being deleted, deleting any owners for which the deletion was lost.
+    """
+    namespace = lease.metadata.namespace
+
+    async def verify(resource, owner):
+        try:
+            obj = await resource.fetch(owner.name, namespace=namespace)
+        except easykube.ApiError as exc:
+            if exc.status_code == 404:
+                return
+            raise
+        # An object with the same name but a different UID is not the owner
+        if obj.metadata.get("uid", owner.uid) != owner.uid:
+            return
+        if not obj.metadata.get("deletionTimestamp"):
+            LOG.warning(
+                "owner %s/%s of lease %s/%s is not being deleted - deleting again",
+                owner.kind,
+                owner.name,
+                namespace,
+                lease.metadata.name,
+            )
+            await delete_owner(resource, owner, namespace)
+
+    await for_each_owner(lease, verify)
+
+
+@workers.register
+async def warm_credentials(namespace, name, secret_data, refresh_flavors=False):
+    """
+    Populates the caches that are used by the handlers for the cloud credential
+    secret with the given data, i.e. the credentials, the session for the cloud and
+    the flavors.
+
+    The flavors are only fetched if they are not cached or a refresh is requested.
+    """
+    CREDENTIALS[(namespace, name)] = secret_data
+    async with openstack.from_secret_data(secret_data) as cloud:
+        if cloud.is_authenticated:
+            cloud.save_session()
+            appcred_id = cloud.application_credential_id
+            if refresh_flavors or appcred_id not in FLAVOR_NAMES:
+                FLAVOR_NAMES[appcred_id] = await fetch_flavor_names(cloud)
+
+
 @kopf.timer(
     registry.API_GROUP,
     "lease",
@@ -394,29 +719,52 @@ async def reconcile_lease(body, logger, **_):
     # This means that the timer will not run while we are modifying the resource
     idle=LEASE_CHECK_INTERVAL_SECONDS,
 )
+@workqueue.prioritise(lease_deadline)
+@metrics.instrument_handler
+@metrics.instrument_timer(LEASE_CHECK_INTERVAL_SECONDS)
+@workers.offload
 async def check_lease(body, logger, **_):
     lease = lease_crd.Lease.model_validate(body)
+    transitions = dict(lease.status.phase_transitions)
 
     # Create a cloud instance from the referenced credential secret
-    secrets = await K8S_CLIENT.api("v1").resource("secrets")
-    cloud_creds = await secrets.fetch(
-        lease.spec.cloud_credentials_secret_name, namespace=lease.metadata.namespace
-    )
-    async with openstack.from_secret_data(cloud_creds.data) as cloud:
+    cloud_creds = await fetch_cloud_credentials(lease)
+    async with openstack.from_secret_data(cloud_creds) as cloud:
         if not lease.spec.ends_at:
             await update_lease_status_no_blazar(cloud, lease)
             await save_instance_status(lease)
+            observe_phase_transitions(lease, transitions, False)
             return
 
+        # Issue the delete if the threshold time has passed
+        # This happens before the status is saved, so that the request for the delete
+        # is recorded in the same write
+        threshold = delete_threshold(lease)
+        now = clock.now()
+        delete_requested = False
+        if threshold < now and lease.status.owners_delete_requested_at:
+            logger.info("deletion of owners already requested - checking progress")
+            await verify_owners_deleting(lease)
+        elif threshold < now:
+            logger.info("lease is ending within grace period - deleting owners")
+            await delete_owners(lease)
+            delete_requested = True
+            # The lateness is only recorded for the delete that is first requested
+            metrics.DELETION_LATENESS.observe(
+                (now - threshold).total_seconds(), kind="lease"
+            )
+        else:
+            logger.info("lease is not within the grace period of ending")
+
         # If the lease has an end date, we may need to contact Blazar
         if blazar_enabled(cloud):
             blazar_client = cloud.api_client("reservation", timeout=30)
             logger.info("checking if blazar lease exists")
-            blazar_lease_name = f"az-{lease.metadata.name}"
-            blazar_lease = await find_blazar_lease(blazar_client, blazar_lease_name)
+            blazar_lease = await get_blazar_lease(blazar_client, lease)
             if blazar_lease:
                 blazar_lease_status = blazar_lease["status"]
                 logger.info(f"blazar lease has status '{blazar_lease_status}'")
+                lease.status.blazar_lease_id = blazar_lease["id"]
                 # Set the phase from the Blazar lease status
                 lease.status.set_phase(lease_crd.LeasePhase[blazar_lease_status])
                 # If the lease is active, report the size map
@@ -429,37 +777,23 @@ async def check_lease(body, logger, **_):
             else:
                 phase = lease.status.phase.name
                 logger.warn(f"phase is {phase} but blazar lease does not exist")
+                if delete_requested:
+                    await save_instance_status(lease)
+            observe_phase_transitions(lease, transitions, True)
         else:
             logger.info("not attempting to use blazar")
             await update_lease_status_no_blazar(cloud, lease)
             await save_instance_status(lease)
-
-    # Calculate the grace period before the end of the lease that we want to use
-    grace_period = (
-        lease.spec.grace_period
-        if lease.spec.grace_period is not None
-        else LEASE_DEFAULT_GRACE_PERIOD_SECONDS
-    )
-    # Calculate the threshold time at which we want to issue a delete
-    threshold = lease.spec.ends_at - datetime.timedelta(seconds=grace_period)
-    # Issue the delete if the threshold time has passed
-    if threshold < datetime.datetime.now(datetime.timezone.utc):
-        logger.info("lease is ending within grace period - deleting owners")
-        for owner in lease.metadata.owner_references:
-            resource = await K8S_CLIENT.api(owner.api_version).resource(owner.kind)
-            await resource.delete(
-                owner.name,
-                # Make sure that we block the owner from deleting, if configured
-                propagation_policy="Foreground",
-                namespace=lease.metadata.namespace,
-            )
-    else:
-        logger.info("lease is not within the grace period of ending")
+            observe_phase_transitions(lease, transitions, False)
 
 
 @kopf.on.delete(registry.API_GROUP, "lease")
-async def delete_lease(body, logger, **_):
+@workqueue.prioritise()
+@metrics.instrument_handler
+@workers.offload
+async def delete_lease(body, logger, retry=0, **_):
     lease = lease_crd.Lease.model_validate(body)
+    transitions = dict(lease.status.phase_transitions)
 
     # Wait until our finalizer is the only finalizer
     if any(f != registry.API_GROUP for f in lease.metadata.finalizers):
@@ -485,6 +819,9 @@ async def delete_lease(body, logger, **_):
         else:
             raise
     async with openstack.from_secret_data(cloud_creds.data) as cloud:
+        observe_phase_transitions(
+            lease, transitions, lease.spec.ends_at and blazar_enabled(cloud)
+        )
         # It is possible that the app cred was deleted but the secret wasn't
         # In that case, the cloud will report as unauthenticated
         if cloud.is_authenticated:
@@ -492,14 +829,39 @@ async def delete_lease(body, logger, **_):
             if lease.spec.ends_at and blazar_enabled(cloud):
                 logger.info("checking for blazar lease")
                 blazar_client = cloud.api_client("reservation", timeout=30)
-                blazar_lease_name = f"az-{lease.metadata.name}"
-                blazar_lease = await find_blazar_lease(blazar_client, blazar_lease_name)
+                blazar_lease = await get_blazar_lease(blazar_client, lease)
                 if blazar_lease:
-                    logger.info("deleting blazar lease")
-                    await blazar_client.resource("leases").delete(blazar_lease["id"])
-                    raise kopf.TemporaryError(
-                        "waiting for blazar lease to delete", delay=15
+                    # Don't delete a lease again if a previous attempt is in progress
+                    if blazar_lease["status"] != "DELETING":
+                        logger.info("deleting blazar lease")
+                        await blazar_client.resource("leases").delete(
+                            blazar_lease["id"]
+                        )
+                    # Wait for the lease to go using the same client, so that we can
+                    # move on to deleting the app cred as soon as it is gone
+                    logger.info("waiting for blazar lease to delete")
+                    # When the handler is retried, the lease has already been waited
+                    # for, so there is no point checking it as often to begin with
+                    deleted = await wait_for_blazar_lease_delete(
+                        blazar_client,
+                        blazar_lease["id"],
+                        (
+                            BLAZAR_DELETE_POLL_MAX_SECONDS
+                            if retry
+                            else BLAZAR_DELETE_POLL_INITIAL_SECONDS
+                        ),
                     )
+                    if not deleted:
+                        # Record the ID of the Blazar lease, if not already known, so
+                        # that the retry can fetch it directly
+                        if lease.status.blazar_lease_id != blazar_lease["id"]:
+                            lease.status.blazar_lease_id = blazar_lease["id"]
+                            await save_instance_status(lease)
+                        raise kopf.TemporaryError(
+                            "waiting for blazar lease to delete",
+                            delay=BLAZAR_DELETE_POLL_MAX_SECONDS,
+                        )
+                    logger.info("blazar lease deleted")
                 else:
                     logger.warn("blazar lease does not exist")
             else:
@@ -520,6 +882,8 @@ async def delete_lease(body, logger, **_):
                 else:
                     raise
             logger.info("deleted application credential for cluster")
+            # The saved session for the credential can never be used again
+            cloud.forget_session()
 
     # Now the appcred is gone, we can delete the secret
     await secrets.delete(
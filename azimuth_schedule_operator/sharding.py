@@ -0,0 +1,316 @@
+import asyncio
+import bisect
+import datetime
+import hashlib
+import logging
+import os
+import socket
+
+from . import aggregates, capacity, metrics, timeline
+from .models import registry
+from .utils import clock
+
+LOG = logging.getLogger(__name__)
+
+# Indicates whether the work is sharded between replicas
+# When enabled, each replica handles the leases and schedules in the namespaces that
+# are assigned to it, and the namespaces are rebalanced as replicas join and leave
+SHARDING_ENABLED = (
+    os.environ.get("AZIMUTH_SCHEDULE_SHARDING_ENABLED", "false") != "false"
+)
+# The name of the group of replicas that share the work
+SHARDING_GROUP = os.environ.get(
+    "AZIMUTH_SCHEDULE_SHARDING_GROUP", "azimuth-schedule-operator"
+)
+# The identity of this replica, which must be unique within the group
+SHARDING_IDENTITY = (
+    os.environ.get("AZIMUTH_SCHEDULE_SHARDING_IDENTITY") or socket.gethostname()
+)
+# The namespace containing the membership leases for the group
+SHARDING_NAMESPACE = os.environ.get("AZIMUTH_SCHEDULE_SHARDING_NAMESPACE", "default")
+# The time after which a replica that has not renewed its membership is considered
+# to have left the group
+SHARDING_LEASE_DURATION_SECONDS = int(
+    os.environ.get("AZIMUTH_SCHEDULE_SHARDING_LEASE_DURATION_SECONDS", "30")
+)
+# The time for which new namespaces are collected before the operator is restarted to
+# handle them, so that namespaces that are created together cause a single restart
+SHARDING_ADDITION_DELAY_SECONDS = int(
+    os.environ.get("AZIMUTH_SCHEDULE_SHARDING_ADDITION_DELAY_SECONDS", "60")
+)
+
+# The number of points that each member has on the hash ring
+# More points give a more even spread of namespaces between the members
+VIRTUAL_NODES = 64
+
+GROUP_LABEL = f"{registry.API_GROUP}/shard-group"
+VIEW_ANNOTATION = f"{registry.API_GROUP}/shard-view"
+
+# The namespaces that were handled by this replica before the operator was last
+# restarted, and are still handled by it
+# The objects in these namespaces were already resumed by the previous operator run
+CONTINUING_NAMESPACES = frozenset()
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring that assigns keys to members.
+
+    When a member joins or leaves, only the keys next to its points on the ring
+    move, i.e. roughly 1/N of the keys for N members.
+    """
+
+    def __init__(self, members, virtual_nodes=VIRTUAL_NODES):
+        points = sorted(
+            (hash_key(f"{member}/{index}"), member)
+            for member in members
+            for index in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._members = [member for _, member in points]
+
+    def owner(self, key):
+        """Returns the member that owns the key, or None if there are no members."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._members[index]
+
+
+def view_name(members):
+    """Returns a short name for the view of the group with the given members."""
+    return hashlib.sha256("\n".join(sorted(members)).encode()).hexdigest()[:16]
+
+
+def forget_namespaces(namespaces):
+    """
+    Removes the leases and schedules in the given namespaces from the in-memory
+    indexes, once they are handled by another replica.
+    """
+    aggregates.LEASES.remove_namespaces(namespaces)
+    aggregates.SCHEDULES.remove_namespaces(namespaces)
+    capacity.CAPACITY.remove_namespaces(namespaces)
+    timeline.TIMELINE.remove_namespaces(namespaces)
+
+
+def needs_resume(namespace, **_):
+    """
+    Filter for kopf resume handlers that skips the objects in namespaces that this
+    replica was already handling before the operator was restarted.
+    """
+    return namespace not in CONTINUING_NAMESPACES
+
+
+def format_microtime(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def parse_microtime(value):
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class Coordinator:
+    """
+    Shards the namespaces between the replicas in a group.
+
+    Each replica is a member of the group for as long as it keeps renewing a
+    coordination.k8s.io Lease. The namespaces are assigned to the live members using
+    a consistent hash ring, and each replica runs the operator for the namespaces
+    that are assigned to it.
+
+    Two replicas never handle the same namespace. Each member reports in its lease
+    the view of the group that it has completed the handoff for, i.e. it has stopped
+    handling any namespaces that it does not own in that view. A replica only starts
+    handling new namespaces once every member reports the same view. A replica that
+    cannot renew its lease stops handling namespaces before the lease expires.
+
+    The operator is restarted to change the namespaces that it handles. This happens
+    straight away when namespaces are removed or the view changes. Namespaces that are
+    created while the view is unchanged are collected for a while first, so that a
+    burst of new namespaces causes a single restart. The resume handlers are only run
+    for the objects in namespaces that this replica was not already handling.
+
+    The operator is given as a coroutine function that takes the namespaces to handle
+    and a flag to stop on as the namespaces and stop_flag keyword arguments, e.g. a
+    partial of kopf.operator.
+    """
+
+    def __init__(
+        self,
+        client,
+        operator,
+        identity=SHARDING_IDENTITY,
+        group=SHARDING_GROUP,
+        namespace=SHARDING_NAMESPACE,
+        lease_duration=SHARDING_LEASE_DURATION_SECONDS,
+        addition_delay=SHARDING_ADDITION_DELAY_SECONDS,
+    ):
+        self._client = client
+        self._operator = operator
+        self.identity = identity
+        self._group = group
+        self._namespace = namespace
+        self._lease_duration = lease_duration
+        self._renew_interval = lease_duration / 3
+        self._addition_delay = datetime.timedelta(seconds=addition_delay)
+        self._renewed_at = None
+        # The view that this replica has completed the handoff for
+        self._view = None
+        # The namespaces that the operator is running for, and the view it started in
+        self.running = frozenset()
+        self._running_view = None
+        # The time that new namespaces were first seen while the operator was running
+        self._added_at = None
+        self._task = None
+        self._stop_flag = None
+
+    @property
+    def lease_name(self):
+        return f"{self._group}-{self.identity}"
+
+    async def _leases(self):
+        return await self._client.api("coordination.k8s.io/v1").resource("leases")
+
+    async def renew(self):
+        """Renews the membership of this replica, reporting its view of the group."""
+        leases = await self._leases()
+        now = clock.now()
+        await leases.create_or_patch(
+            self.lease_name,
+            {
+                "metadata": {
+                    "labels": {GROUP_LABEL: self._group},
+                    "annotations": {VIEW_ANNOTATION: self._view or ""},
+                },
+                "spec": {
+                    "holderIdentity": self.identity,
+                    "leaseDurationSeconds": self._lease_duration,
+                    "renewTime": format_microtime(now),
+                },
+            },
+            namespace=self._namespace,
+        )
+        self._renewed_at = now
+
+    async def members(self):
+        """Returns a map of identity -> reported view for the live members."""
+        leases = await self._leases()
+        now = clock.now()
+        members = {}
+        async for lease in leases.list(
+            labels={GROUP_LABEL: self._group}, namespace=self._namespace
+        ):
+            spec = lease.get("spec", {})
+            if not spec.get("holderIdentity") or not spec.get("renewTime"):
+                continue
+            expires_at = parse_microtime(spec["renewTime"]) + datetime.timedelta(
+                seconds=spec.get("leaseDurationSeconds", self._lease_duration)
+            )
+            if expires_at > now:
+                annotations = lease["metadata"].get("annotations", {})
+                members[spec["holderIdentity"]] = annotations.get(VIEW_ANNOTATION)
+        return members
+
+    async def namespaces(self):
+        """Returns the names of all the namespaces in the cluster."""
+        namespaces = await self._client.api("v1").resource("namespaces")
+        return {ns["metadata"]["name"] async for ns in namespaces.list()}
+
+    async def _start(self, namespaces, view, continuing=frozenset()):
+        global CONTINUING_NAMESPACES
+        LOG.info("handling %d namespaces", len(namespaces))
+        CONTINUING_NAMESPACES = continuing
+        self._stop_flag = asyncio.Event()
+        self._task = asyncio.create_task(
+            self._operator(namespaces=sorted(namespaces), stop_flag=self._stop_flag)
+        )
+        self.running = namespaces
+        self._running_view = view
+        self._added_at = None
+
+    async def _stop(self, keep=frozenset()):
+        """
+        Stops the operator, forgetting the objects in the namespaces that it was
+        running for, except for the given namespaces that will be handled again.
+        """
+        if self._task is not None:
+            LOG.info("stopping handling of %d namespaces", len(self.running))
+            self._stop_flag.set()
+            try:
+                await self._task
+            except Exception:
+                LOG.exception("error stopping operator")
+            self._task = None
+        # The objects in the namespaces are no longer watched, so they would stay in
+        # the indexes and be reported by this replica as well as the new owner
+        forget_namespaces(self.running - keep)
+        self.running = frozenset()
+
+    async def step(self):
+        """Updates the membership of the group and rebalances the namespaces."""
+        try:
+            await self.renew()
+            members = await self.members()
+            namespaces = await self.namespaces()
+        except Exception:
+            LOG.exception("error updating shard membership")
+            # Stop handling namespaces before our lease expires and they are reassigned
+            fence_at = datetime.timedelta(
+                seconds=self._lease_duration - self._renew_interval
+            )
+            if self._renewed_at is None or clock.now() - self._renewed_at >= fence_at:
+                await self._stop()
+                self._view = None
+            return
+        members[self.identity] = self._view
+        view = view_name(members)
+        ring = HashRing(members)
+        assigned = frozenset(ns for ns in namespaces if ring.owner(ns) == self.identity)
+        metrics.SHARD_MEMBERS.set(len(members))
+        metrics.SHARD_NAMESPACES.set(len(assigned))
+        # Hand off any namespaces that we no longer own before reporting the new view
+        if not self.running <= assigned:
+            await self._stop(keep=assigned)
+        if self._view != view:
+            self._view = view
+            members[self.identity] = view
+            await self.renew()
+        # Only take on new namespaces once every member has handed off for this view
+        if assigned == self.running:
+            self._added_at = None
+            return
+        if any(v != view for v in members.values()):
+            return
+        # New namespaces in an unchanged view are collected before restarting
+        if self._task is not None and self._running_view == view:
+            now = clock.now()
+            self._added_at = self._added_at or now
+            if now - self._added_at < self._addition_delay:
+                return
+        continuing = self.running & assigned
+        await self._stop(keep=assigned)
+        if assigned:
+            await self._start(assigned, view, continuing)
+
+    async def run(self):
+        """
+        Runs the coordinator until the operator exits by itself, e.g. on a signal.
+        """
+        try:
+            while True:
+                await self.step()
+                if self._task is not None and self._task.done():
+                    return self._task.result()
+                await asyncio.sleep(self._renew_interval)
+        finally:
+            await self._stop()
+            # Leave the group, so that the namespaces are reassigned promptly
+            try:
+                leases = await self._leases()
+                await leases.delete(self.lease_name, namespace=self._namespace)
+            except Exception:
+                LOG.exception("error leaving shard group")
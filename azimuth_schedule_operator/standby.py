@@ -0,0 +1,497 @@
+import asyncio
+import datetime
+import functools
+import logging
+import os
+import socket
+
+import easykube
+
+from . import aggregates, capacity, metrics, operator, timeline, workers
+from .models import registry
+from .models.v1alpha1 import lease as lease_crd
+from .models.v1alpha1 import schedule as schedule_crd
+from .sharding import format_microtime, parse_microtime
+from .utils import clock
+
+LOG = logging.getLogger(__name__)
+
+# Indicates whether replicas wait as warm standbys for the leader to fail
+# When enabled, only the replica that holds the leader lease runs the operator, and
+# the others keep the caches that the handlers use warm so that they can take over
+STANDBY_ENABLED = os.environ.get("AZIMUTH_SCHEDULE_STANDBY_ENABLED", "false") != "false"
+# The name of the coordination.k8s.io Lease that is held by the leader
+STANDBY_LEASE_NAME = os.environ.get(
+    "AZIMUTH_SCHEDULE_STANDBY_LEASE_NAME", "azimuth-schedule-operator"
+)
+# The identity of this replica, which must be unique
+STANDBY_IDENTITY = (
+    os.environ.get("AZIMUTH_SCHEDULE_STANDBY_IDENTITY") or socket.gethostname()
+)
+# The namespace containing the leader lease
+STANDBY_NAMESPACE = os.environ.get("AZIMUTH_SCHEDULE_STANDBY_NAMESPACE", "default")
+# The time after which a leader that has not renewed the lease is considered lost
+STANDBY_LEASE_DURATION_SECONDS = int(
+    os.environ.get("AZIMUTH_SCHEDULE_STANDBY_LEASE_DURATION_SECONDS", "15")
+)
+
+# The interval at which a standby refreshes the caches, so that they are still fresh
+# enough to be used by the handlers when it takes over
+# The leases and schedules are watched, so only the cloud credential secrets that the
+# leases reference are fetched, and saved sessions are reused until they are about
+# to expire
+REFRESH_INTERVAL_SECONDS = operator.WARM_CACHE_TTL_SECONDS / 4
+# The interval at which a standby fetches the flavors for each cloud again
+FLAVOR_REFRESH_INTERVAL_SECONDS = operator.FLAVOR_CACHE_TTL_SECONDS / 2
+# The delay before a watch that has failed is started again
+WATCH_RETRY_SECONDS = 5
+
+
+class Standby:
+    """
+    Runs the operator in the replica that holds the leader lease, with the other
+    replicas waiting as warm standbys.
+
+    While waiting, a standby applies the CRDs, watches the leases and schedules to
+    keep them and the in-memory indexes up to date, and keeps the cloud credentials,
+    sessions and flavors that the handlers use warm. Only the cloud credential secrets
+    that are referenced by the leases are fetched, rather than watching all secrets.
+    When the leader is lost, the standby that takes over the lease first issues the
+    deletions that are due using that state, then starts the operator, whose handlers
+    use the warm caches.
+
+    When the handlers run in workers, the caches are warmed in the worker that runs
+    the handlers for each lease, as the caches in this process are not used.
+
+    Only the leader reports the metrics for the leases and schedules, and the operator
+    metrics are labelled with the role of the replica.
+
+    The time from the loss of the previous leader, i.e. when it last renewed the
+    lease, until the deletions that were due have been issued is reported as the
+    failover time.
+
+    The operator is given as a coroutine function that takes a flag to stop on as the
+    stop_flag keyword argument, e.g. a partial of kopf.operator.
+    """
+
+    def __init__(
+        self,
+        client,
+        operator,
+        identity=STANDBY_IDENTITY,
+        name=STANDBY_LEASE_NAME,
+        namespace=STANDBY_NAMESPACE,
+        lease_duration=STANDBY_LEASE_DURATION_SECONDS,
+    ):
+        self._client = client
+        self._operator = operator
+        self.identity = identity
+        self._name = name
+        self._namespace = namespace
+        self._lease_duration = lease_duration
+        self._renew_interval = lease_duration / 3
+        self._renewed_at = None
+        self._refreshed_at = None
+        self._flavors_refreshed_at = None
+        # The time that the previous leader was lost, if the lease was taken over
+        self.lost_at = None
+        # The leases and schedules, by uid, as last seen by the watches
+        self.leases = {}
+        self.schedules = {}
+        # The watch tasks, and the events that are set once each watch has listed
+        self._watches = []
+        self._synced = {}
+        self._task = None
+        self._stop_flag = None
+
+    @property
+    def is_leader(self):
+        return self._task is not None
+
+    async def _leases(self):
+        return await self._client.api("coordination.k8s.io/v1").resource("leases")
+
+    async def acquire(self):
+        """
+        Acquires or renews the leader lease, returning True if this replica holds it.
+        """
+        leases = await self._leases()
+        now = clock.now()
+        spec = {
+            "holderIdentity": self.identity,
+            "leaseDurationSeconds": self._lease_duration,
+            "renewTime": format_microtime(now),
+        }
+        try:
+            lease = await leases.fetch(self._name, namespace=self._namespace)
+        except easykube.ApiError as exc:
+            if exc.status_code != 404:
+                raise
+            lease = None
+        try:
+            if lease is None:
+                spec["acquireTime"] = spec["renewTime"]
+                await leases.create(
+                    {"metadata": {"name": self._name}, "spec": spec},
+                    namespace=self._namespace,
+                )
+            else:
+                current = lease.get("spec", {})
+                if current.get("holderIdentity") != self.identity:
+                    # A lease that was released has a renew time but no holder
+                    renewed_at = parse_microtime(current["renewTime"])
+                    expires_at = renewed_at + datetime.timedelta(
+                        seconds=current.get("leaseDurationSeconds", 0)
+                    )
+                    if current.get("holderIdentity") and expires_at > now:
+                        return False
+                    self.lost_at = renewed_at
+                    spec["acquireTime"] = spec["renewTime"]
+                    spec["leaseTransitions"] = current.get("leaseTransitions", 0) + 1
+                # The resource version makes sure only one replica takes over the lease
+                await leases.replace(
+                    self._name,
+                    {
+                        "metadata": {
+                            "name": self._name,
+                            "resourceVersion": lease["metadata"]["resourceVersion"],
+                        },
+                        "spec": {**current, **spec},
+                    },
+                    namespace=self._namespace,
+                )
+        except easykube.ApiError as exc:
+            # Another replica acquired or took over the lease first
+            if exc.status_code == 409:
+                return False
+            raise
+        self._renewed_at = now
+        return True
+
+    async def release(self):
+        """Releases the leader lease, if held, so that a standby can take over."""
+        leases = await self._leases()
+        lease = await leases.fetch(self._name, namespace=self._namespace)
+        spec = lease.get("spec", {})
+        if spec.get("holderIdentity") != self.identity:
+            return
+        spec = {k: v for k, v in spec.items() if k != "holderIdentity"}
+        spec["renewTime"] = format_microtime(clock.now())
+        await leases.replace(
+            self._name,
+            {
+                "metadata": {
+                    "name": self._name,
+                    "resourceVersion": lease["metadata"]["resourceVersion"],
+                },
+                "spec": spec,
+            },
+            namespace=self._namespace,
+        )
+
+    def _indexes(self, plural):
+        if plural == "leases":
+            return [aggregates.LEASES, capacity.CAPACITY, timeline.TIMELINE]
+        else:
+            return [aggregates.SCHEDULES]
+
+    def _sync_objects(self, plural, bodies):
+        previous = getattr(self, plural)
+        objects = {body["metadata"]["uid"]: body for body in bodies}
+        for uid, body in previous.items():
+            if uid not in objects:
+                for index in self._indexes(plural):
+                    index.remove(body)
+        for body in objects.values():
+            for index in self._indexes(plural):
+                index.update(body)
+        setattr(self, plural, objects)
+
+    def _apply_object_event(self, plural, event_type, body):
+        objects = getattr(self, plural)
+        uid = body["metadata"]["uid"]
+        if event_type == "DELETED":
+            objects.pop(uid, None)
+            for index in self._indexes(plural):
+                index.remove(body)
+        else:
+            objects[uid] = body
+            for index in self._indexes(plural):
+                index.update(body)
+
+    async def _watch(self, api_version, plural, sync, apply):
+        resource = await self._client.api(api_version).resource(plural)
+        while True:
+            try:
+                initial, events = await resource.watch_list(all_namespaces=True)
+                sync(initial)
+                self._synced[plural].set()
+                async for event in events:
+                    apply(event["type"], event["object"])
+            except Exception:
+                LOG.exception("error watching %s", plural)
+            # A watch that has expired or failed starts again from a full list
+            await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+    def _start_watches(self):
+        watches = [
+            (
+                registry.API_VERSION,
+                "leases",
+                functools.partial(self._sync_objects, "leases"),
+                functools.partial(self._apply_object_event, "leases"),
+            ),
+            (
+                registry.API_VERSION,
+                "schedules",
+                functools.partial(self._sync_objects, "schedules"),
+                functools.partial(self._apply_object_event, "schedules"),
+            ),
+        ]
+        for api_version, plural, sync, apply in watches:
+            self._synced[plural] = asyncio.Event()
+            self._watches.append(
+                asyncio.create_task(self._watch(api_version, plural, sync, apply))
+            )
+
+    async def _stop_watches(self):
+        for task in self._watches:
+            task.cancel()
+        await asyncio.gather(*self._watches, return_exceptions=True)
+        self._watches = []
+        self._synced = {}
+
+    async def refresh_objects(self):
+        """Lists the leases and schedules and refreshes the in-memory indexes."""
+        for plural in ["leases", "schedules"]:
+            resource = await self._client.api(registry.API_VERSION).resource(plural)
+            self._sync_objects(
+                plural, [body async for body in resource.list(all_namespaces=True)]
+            )
+
+    async def fetch_secrets(self, keys):
+        """
+        Fetches the cloud credential secrets with the given (namespace, name) keys,
+        returning a map of key -> data for those that contain cloud credentials.
+        """
+        keys = list(keys)
+        secrets = await self._client.api("v1").resource("secrets")
+        results = await asyncio.gather(
+            *(secrets.fetch(name, namespace=namespace) for namespace, name in keys),
+            return_exceptions=True,
+        )
+        data = {}
+        for (namespace, name), result in zip(keys, results):
+            if isinstance(result, Exception):
+                # A secret that is missing is reported by the handler
+                if (
+                    not isinstance(result, easykube.ApiError)
+                    or result.status_code != 404
+                ):
+                    LOG.error(
+                        "error fetching secret %s/%s", namespace, name, exc_info=result
+                    )
+                continue
+            secret_data = result.get("data") or {}
+            if "clouds.yaml" in secret_data:
+                data[(namespace, name)] = secret_data
+        return data
+
+    async def _warm(self, uid, namespace, name, secret_data, refresh_flavors):
+        kwargs = dict(
+            namespace=namespace,
+            name=name,
+            secret_data=secret_data,
+            refresh_flavors=refresh_flavors,
+        )
+        if workers.POOL:
+            await workers.POOL.call(uid, "warm_credentials", **kwargs)
+        else:
+            await operator.warm_credentials(**kwargs)
+
+    async def refresh(self):
+        """
+        Refreshes the caches that are used by the handlers from the watched objects
+        and the cloud credential secrets that they reference.
+
+        The caches are refreshed once for each cloud credential secret, or once for
+        each cloud credential secret in each worker. The flavors are only fetched at
+        a longer interval, or if they are not cached.
+        """
+        if not operator.CRDS_APPLIED:
+            await operator.apply_crds()
+        if not self._watches:
+            self._start_watches()
+        # Wait for the watches to list the objects, but not for long enough to miss
+        # renewing the leader lease
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(e.wait() for e in self._synced.values())),
+                self._renew_interval,
+            )
+        except asyncio.TimeoutError:  # noqa: UP041 - not the builtin on Python 3.10
+            LOG.warning("waiting for watches to list the objects")
+            return
+        now = clock.now()
+        refresh_flavors = self._flavors_refreshed_at is None or (
+            now - self._flavors_refreshed_at
+            >= datetime.timedelta(seconds=FLAVOR_REFRESH_INTERVAL_SECONDS)
+        )
+        # The cloud credential secret that is used by each lease, by uid
+        keys = {
+            uid: (
+                body["metadata"]["namespace"],
+                body["spec"]["cloudCredentialsSecretName"],
+            )
+            for uid, body in self.leases.items()
+        }
+        secrets = await self.fetch_secrets(set(keys.values()))
+        # Map of (worker, namespace, name) -> uid of a lease using the credential
+        credentials = {}
+        for uid, key in keys.items():
+            # The handler reports a credential that is missing
+            if key not in secrets:
+                continue
+            worker = workers.POOL.worker_for(uid) if workers.POOL else None
+            credentials.setdefault((worker, *key), uid)
+        results = await asyncio.gather(
+            *(
+                self._warm(
+                    uid, namespace, name, secrets[(namespace, name)], refresh_flavors
+                )
+                for (_, namespace, name), uid in credentials.items()
+            ),
+            return_exceptions=True,
+        )
+        for (_, namespace, name), result in zip(credentials, results):
+            if isinstance(result, Exception):
+                LOG.error(
+                    "error warming caches for %s/%s", namespace, name, exc_info=result
+                )
+        self._refreshed_at = now
+        if refresh_flavors:
+            self._flavors_refreshed_at = now
+
+    async def _delete_owners(self, lease):
+        await operator.delete_owners(lease)
+        await operator.save_instance_status(lease)
+
+    async def sweep(self):
+        """
+        Issues the deletions that are due for the leases and schedules, returning the
+        number of deletions that were issued.
+        """
+        now = clock.now()
+        deletions = []
+        for body in self.leases.values():
+            lease = lease_crd.Lease.model_validate(body)
+            if (
+                lease.spec.ends_at
+                and lease.metadata.owner_references
+                and not lease.status.owners_delete_requested_at
+                and operator.delete_threshold(lease) < now
+            ):
+                deletions.append(self._delete_owners(lease))
+        for body in self.schedules.values():
+            schedule = schedule_crd.Schedule.model_validate(body)
+            if (
+                not schedule.status.ref_delete_triggered
+                and schedule.spec.not_after <= now
+            ):
+                deletions.append(
+                    operator.check_for_delete(schedule.metadata.namespace, schedule)
+                )
+        results = await asyncio.gather(*deletions, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                LOG.error("error issuing deletion", exc_info=result)
+        return sum(not isinstance(result, Exception) for result in results)
+
+    async def _take_over(self):
+        LOG.info("acquired leader lease - taking over")
+        metrics.STANDBY_LEADER.set(1)
+        metrics.ROLE = "leader"
+        # The operator keeps the indexes up to date from its own watches
+        await self._stop_watches()
+        # Act on the current state rather than the state from the last refresh
+        try:
+            await self.refresh_objects()
+            deletions = await self.sweep()
+        except Exception:
+            LOG.exception("error issuing deletions that are due")
+        else:
+            LOG.info("issued %d deletions that were due", deletions)
+            if self.lost_at is not None:
+                metrics.FAILOVER_DURATION.set(
+                    (clock.now() - self.lost_at).total_seconds()
+                )
+        self._stop_flag = asyncio.Event()
+        self._task = asyncio.create_task(self._operator(stop_flag=self._stop_flag))
+
+    async def _stop(self):
+        await self._stop_watches()
+        if self._task is not None:
+            LOG.info("stopping operator")
+            self._stop_flag.set()
+            try:
+                await self._task
+            except Exception:
+                LOG.exception("error stopping operator")
+            self._task = None
+        metrics.STANDBY_LEADER.set(0)
+        metrics.ROLE = "standby"
+
+    async def step(self):
+        """
+        Acquires or renews the leader lease, taking over if the leader was lost or
+        refreshing the caches if another replica is the leader.
+
+        Returns False if this replica was the leader and has lost the lease.
+        """
+        try:
+            held = await self.acquire()
+        except Exception:
+            LOG.exception("error acquiring leader lease")
+            held = None
+        if self.is_leader:
+            if held is False:
+                LOG.error("leader lease was taken over by another replica")
+                return False
+            # Stop acting before the lease expires and a standby takes over
+            fence_at = datetime.timedelta(
+                seconds=self._lease_duration - self._renew_interval
+            )
+            if held is None and clock.now() - self._renewed_at >= fence_at:
+                LOG.error("unable to renew leader lease")
+                return False
+        elif held:
+            await self._take_over()
+        elif self._refreshed_at is None or (
+            clock.now() - self._refreshed_at
+            >= datetime.timedelta(seconds=REFRESH_INTERVAL_SECONDS)
+        ):
+            try:
+                await self.refresh()
+            except Exception:
+                LOG.exception("error refreshing standby caches")
+        return True
+
+    async def run(self):
+        """
+        Runs until the operator exits by itself, e.g. on a signal, or the leader lease
+        is lost, in which case the process should restart as a standby.
+        """
+        await operator.setup_client()
+        metrics.STANDBY_LEADER.set(0)
+        metrics.ROLE = "standby"
+        try:
+            while await self.step():
+                if self._task is not None and self._task.done():
+                    return self._task.result()
+                await asyncio.sleep(self._renew_interval)
+        finally:
+            await self._stop()
+            try:
+                await self.release()
+            except Exception:
+                LOG.exception("error releasing leader lease")
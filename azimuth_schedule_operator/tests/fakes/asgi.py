@@ -0,0 +1,116 @@
+import asyncio
+import collections
+import json
+import random
+import re
+import urllib.parse
+
+
+class Request:
+    """A request to a fake application."""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = urllib.parse.parse_qs(scope["query_string"].decode())
+        self.headers = {
+            name.decode().lower(): value.decode() for name, value in scope["headers"]
+        }
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+
+class Response:
+    """A response from a fake application."""
+
+    def __init__(self, status, data=None, headers=None, content=None):
+        self.status = status
+        self.data = data
+        self.headers = headers or {}
+        # Raw content to return instead of the JSON for the data, e.g. for streams
+        self.content = content
+
+
+class App:
+    """
+    Minimal ASGI application that dispatches requests to handlers using regular
+    expressions for the path.
+
+    Each handler is called with the request and the named groups from the path,
+    and returns a response. The number of requests for each named route is recorded
+    so that the calls made by the operator can be reported. Handlers for routes
+    with no name record their own calls.
+
+    Latency and errors can be injected for named routes, keyed by the method and
+    route name, e.g. "GET compute/flavors", with "*" giving the default for all
+    routes. Errors are injected using a seeded random generator, so that they are
+    reproducible.
+    """
+
+    def __init__(self, latency=None, error_rates=None, error_status=503, seed=None):
+        # List of (method, pattern, route name, handler) tuples
+        self._routes = []
+        # The number of requests for each route
+        self.calls = collections.Counter()
+        # Map of route -> latency in seconds
+        self.latency = dict(latency or {})
+        # Map of route -> the fraction of requests that fail
+        self.error_rates = dict(error_rates or {})
+        self.error_status = error_status
+        self._random = random.Random(seed)
+
+    def route(self, method, pattern, name, handler):
+        """Add a route to the application."""
+        self._routes.append((method, re.compile(pattern), name, handler))
+
+    def not_found(self, request):
+        return Response(404, {"error": f"{request.method} {request.path} not found"})
+
+    def _lookup(self, config, route):
+        return config.get(route, config.get("*", 0))
+
+    async def handle(self, request):
+        """Dispatch the request to the matching handler."""
+        for method, pattern, name, handler in self._routes:
+            match = pattern.fullmatch(request.path)
+            if method == request.method and match:
+                if name:
+                    route = f"{request.method} {name}"
+                    self.calls[route] += 1
+                    latency = self._lookup(self.latency, route)
+                    if latency:
+                        await asyncio.sleep(latency)
+                    if self._random.random() < self._lookup(self.error_rates, route):
+                        return Response(self.error_status, {"error": "injected error"})
+                return await handler(request, **match.groupdict())
+        self.calls[f"{request.method} unknown"] += 1
+        return self.not_found(request)
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        response = await self.handle(Request(scope, body))
+        if response.content is not None:
+            content = response.content
+        elif response.data is not None:
+            content = json.dumps(response.data).encode()
+        else:
+            content = b""
+        headers = {"content-type": "application/json", **response.headers}
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status,
+                "headers": [
+                    (name.encode(), value.encode()) for name, value in headers.items()
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": content})
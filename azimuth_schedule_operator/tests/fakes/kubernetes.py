@@ -0,0 +1,285 @@
+import asyncio
+import copy
+import itertools
+import json
+import uuid
+
+import easykube
+import httpx
+from pydantic.json import pydantic_encoder
+
+from azimuth_schedule_operator import metrics
+from azimuth_schedule_operator.models import registry
+from azimuth_schedule_operator.utils import clock, k8s
+
+from . import asgi
+
+# The resources that are served by default, as (api version, plural, kind) tuples
+DEFAULT_RESOURCES = [
+    ("v1", "secrets", "Secret"),
+    ("v1", "configmaps", "ConfigMap"),
+    (registry.API_VERSION, "leases", "Lease"),
+    (registry.API_VERSION, "schedules", "Schedule"),
+]
+# The kinds that are not namespaced
+CLUSTER_SCOPED_KINDS = {"Namespace"}
+
+OBJECT_PATH = (
+    r"/(?:api/(?P<core_version>v1)|apis/(?P<group>[^/]+)/(?P<version>[^/]+))"
+    r"(?:/namespaces/(?P<namespace>[^/]+))?"
+    r"/(?P<plural>[^/]+)(?:/(?P<name>[^/]+)(?:/(?P<subresource>status))?)?"
+)
+
+
+def merge_patch(target, patch):
+    """Applies a JSON merge patch to the target and returns the result."""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def status(code, reason, message):
+    return asgi.Response(
+        code,
+        {
+            "apiVersion": "v1",
+            "kind": "Status",
+            "status": "Failure",
+            "message": message,
+            "reason": reason,
+            "code": code,
+        },
+    )
+
+
+class FakeKubernetes(asgi.App):
+    """
+    In-process stand-in for the Kubernetes API.
+
+    Only the operations used by the operator are supported, i.e. discovery and
+    get, list, watch, create, replace, merge patch and delete for objects and the
+    status subresource. Resource versions are checked for replace operations.
+
+    A watch returns the events after the given resource version as soon as there are
+    any, rather than streaming them, and the client then watches again from the last
+    event.
+    """
+
+    def __init__(self, resources=DEFAULT_RESOURCES):
+        super().__init__()
+        # Map of api version -> plural name -> kind
+        self._resources = {}
+        for api_version, plural, kind in resources:
+            self._resources.setdefault(api_version, {})[plural] = kind
+        # Map of (api version, plural, namespace, name) -> object
+        self.objects = {}
+        self._resource_versions = itertools.count(1)
+        # List of (resource version, api version, plural, namespace, event) tuples
+        self.events = []
+        # Set, and replaced, whenever an event is recorded
+        self._changed = asyncio.Event()
+        self.route("GET", r"/api/(?P<api_version>v1)", "discovery", self.discovery)
+        self.route(
+            "GET", r"/apis/(?P<api_version>[^/]+/[^/]+)", "discovery", self.discovery
+        )
+        for method in ["GET", "POST", "PUT", "PATCH", "DELETE"]:
+            self.route(method, OBJECT_PATH, None, self.handle_object)
+
+    def client(self):
+        """Returns a client for the fake, configured as for the real API server."""
+        return easykube.AsyncClient(
+            base_url="http://kubernetes.fake",
+            transport=metrics.InstrumentedTransport(
+                httpx.ASGITransport(app=self), "kubernetes", k8s.request_operation
+            ),
+            json_encoder=pydantic_encoder,
+            default_field_manager=k8s.FIELD_MANAGER_NAME,
+        )
+
+    def _next_resource_version(self):
+        return str(next(self._resource_versions))
+
+    def _record(self, key, event_type, obj):
+        api_version, plural, namespace, _ = key
+        self.events.append(
+            (
+                int(obj["metadata"]["resourceVersion"]),
+                api_version,
+                plural,
+                namespace,
+                {"type": event_type, "object": copy.deepcopy(obj)},
+            )
+        )
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def add(self, obj):
+        """Adds the given object to the fake, as if it had been created."""
+        api_version = obj["apiVersion"]
+        kind = obj["kind"]
+        plural = next(p for p, k in self._resources[api_version].items() if k == kind)
+        metadata = obj.setdefault("metadata", {})
+        metadata.setdefault("uid", str(uuid.uuid4()))
+        metadata.setdefault(
+            "creationTimestamp",
+            clock.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+        metadata["resourceVersion"] = self._next_resource_version()
+        key = (api_version, plural, metadata.get("namespace"), metadata["name"])
+        self._record(key, "MODIFIED" if key in self.objects else "ADDED", obj)
+        self.objects[key] = obj
+        return obj
+
+    def get(self, api_version, plural, namespace, name):
+        """Returns the object with the given name, if it exists."""
+        return self.objects.get((api_version, plural, namespace, name))
+
+    def list(self, api_version, plural, namespace=None, labels=None):
+        """
+        Returns the objects for the given resource, optionally in a namespace and
+        with the given labels.
+        """
+        return [
+            obj
+            for (av, p, ns, _), obj in self.objects.items()
+            if av == api_version
+            and p == plural
+            and (namespace is None or ns == namespace)
+            and (labels or {}).items() <= obj["metadata"].get("labels", {}).items()
+        ]
+
+    async def discovery(self, request, api_version):
+        if api_version not in self._resources:
+            return self.not_found(request)
+        resources = []
+        for plural, kind in self._resources[api_version].items():
+            resource = {
+                "name": plural,
+                "singularName": plural[:-1],
+                "namespaced": kind not in CLUSTER_SCOPED_KINDS,
+                "kind": kind,
+            }
+            resources.extend([resource, {**resource, "name": f"{plural}/status"}])
+        return asgi.Response(
+            200,
+            {
+                "kind": "APIResourceList",
+                "groupVersion": api_version,
+                "resources": resources,
+            },
+        )
+
+    async def handle_object(
+        self,
+        request,
+        core_version,
+        group,
+        version,
+        namespace,
+        plural,
+        name,
+        subresource,
+    ):
+        api_version = core_version or f"{group}/{version}"
+        resource = f"{plural}/{subresource}" if subresource else plural
+        watch = request.method == "GET" and name is None and "watch" in request.query
+        self.calls[f"{'WATCH' if watch else request.method} {resource}"] += 1
+        if plural not in self._resources.get(api_version, {}):
+            return self.not_found(request)
+        if name is None:
+            if request.method == "GET":
+                selector = request.query.get("labelSelector", [""])[0]
+                if watch:
+                    resource_version = int(request.query["resourceVersion"][0])
+                    return await self._watch(
+                        api_version, plural, namespace, selector, resource_version
+                    )
+                return self._list(api_version, plural, namespace, selector)
+            elif request.method == "POST":
+                return self._create(api_version, plural, namespace, request.json())
+            else:
+                return status(405, "MethodNotAllowed", "method not allowed")
+        key = (api_version, plural, namespace, name)
+        obj = self.objects.get(key)
+        if obj is None:
+            return status(404, "NotFound", f'{plural} "{name}" not found')
+        if request.method == "GET":
+            return asgi.Response(200, obj)
+        elif request.method == "DELETE":
+            del self.objects[key]
+            deleted = copy.deepcopy(obj)
+            deleted["metadata"]["resourceVersion"] = self._next_resource_version()
+            self._record(key, "DELETED", deleted)
+            return asgi.Response(200, obj)
+        elif request.method == "PUT":
+            data = request.json()
+            resource_version = data.get("metadata", {}).get("resourceVersion")
+            if (
+                resource_version
+                and resource_version != obj["metadata"]["resourceVersion"]
+            ):
+                return status(409, "Conflict", "the object has been modified")
+            if subresource:
+                updated = {**obj, "status": data.get("status", {})}
+            else:
+                updated = {**data, "status": obj.get("status", {})}
+                updated["metadata"] = {**obj["metadata"], **data.get("metadata", {})}
+        elif request.method == "PATCH":
+            patch = request.json()
+            if subresource:
+                patch = {"status": patch.get("status", {})}
+            updated = merge_patch(obj, patch)
+        else:
+            return status(405, "MethodNotAllowed", "method not allowed")
+        updated = copy.deepcopy(updated)
+        updated["metadata"]["resourceVersion"] = self._next_resource_version()
+        self._record(key, "MODIFIED", updated)
+        self.objects[key] = updated
+        return asgi.Response(200, updated)
+
+    def _list(self, api_version, plural, namespace, selector):
+        # Only equality-based label selectors are supported
+        labels = dict(term.split("=", 1) for term in selector.split(",") if term)
+        return asgi.Response(
+            200,
+            {
+                "apiVersion": api_version,
+                "kind": f"{self._resources[api_version][plural]}List",
+                "metadata": {"resourceVersion": self._next_resource_version()},
+                "items": self.list(api_version, plural, namespace, labels),
+            },
+        )
+
+    async def _watch(self, api_version, plural, namespace, selector, resource_version):
+        labels = dict(term.split("=", 1) for term in selector.split(",") if term)
+        while True:
+            changed = self._changed
+            events = [
+                event
+                for rv, av, p, ns, event in self.events
+                if rv > resource_version
+                and av == api_version
+                and p == plural
+                and (namespace is None or ns == namespace)
+                and labels.items()
+                <= event["object"]["metadata"].get("labels", {}).items()
+            ]
+            if events:
+                content = "".join(json.dumps(event) + "\n" for event in events)
+                return asgi.Response(200, content=content.encode())
+            await changed.wait()
+
+    def _create(self, api_version, plural, namespace, data):
+        metadata = data.setdefault("metadata", {})
+        metadata["namespace"] = namespace
+        if (api_version, plural, namespace, metadata.get("name")) in self.objects:
+            return status(409, "AlreadyExists", f'{plural} "{metadata["name"]}" exists')
+        data["apiVersion"] = api_version
+        data["kind"] = self._resources[api_version][plural]
+        return asgi.Response(201, self.add(data))
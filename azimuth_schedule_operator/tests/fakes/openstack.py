@@ -0,0 +1,295 @@
+import base64
+import datetime
+import itertools
+import json
+import time
+import uuid
+
+import yaml
+
+from azimuth_schedule_operator.utils import clock
+
+from . import asgi
+
+# The base URL that the fake cloud is served at
+BASE_URL = "http://openstack.fake"
+# The lifetime that is reported for tokens when no TTL is given, as for Keystone
+DEFAULT_TOKEN_TTL = 3600
+
+
+def parse_blazar_date(value):
+    """Parses a date in the format used by the Blazar API."""
+    if value == "now":
+        return clock.now()
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M").replace(
+        tzinfo=datetime.timezone.utc
+    )
+
+
+class FakeOpenStack(asgi.App):
+    """
+    In-process stand-in for an OpenStack cloud with Keystone, Blazar and Nova.
+
+    Keystone issues tokens for application credentials and serves the catalog.
+    Blazar leases are reported as PENDING, ACTIVE or TERMINATED depending on the
+    current time, and each reservation creates a Nova flavor for the reserved
+    machines, as Blazar does.
+
+    Tokens expire after the given TTL, if given, and lists of flavors and leases
+    are paginated using the given page size, if given. The remaining arguments are
+    used to inject latency and errors, as for the base application.
+    """
+
+    def __init__(self, flavors=None, token_ttl=None, page_size=None, **kwargs):
+        super().__init__(**kwargs)
+        self.token_ttl = token_ttl
+        self.page_size = page_size
+        # Map of flavor ID -> flavor
+        self.flavors = {
+            flavor["id"]: flavor
+            for flavor in (flavors or [{"id": "id1", "name": "flavor1"}])
+        }
+        # Map of Blazar lease ID -> lease
+        self.leases = {}
+        # Map of application credential ID -> user ID
+        self.application_credentials = {}
+        # Map of token -> time that the token was issued
+        self.tokens = {}
+        self._token_ids = itertools.count(1)
+        self.route(
+            "POST", r"/identity/v3/auth/tokens", "identity/tokens", self.issue_token
+        )
+        self.route(
+            "GET", r"/identity/v3/auth/catalog", "identity/catalog", self.catalog
+        )
+        self.route(
+            "DELETE",
+            r"/identity/v3/users/(?P<user_id>[^/]+)/application_credentials/(?P<id>[^/]+)",
+            "identity/application_credentials",
+            self.delete_application_credential,
+        )
+        self.route("GET", r"/compute/v2.1/flavors", "compute/flavors", self.flavor_list)
+        self.route(
+            "GET", r"/reservation/v1/leases", "reservation/leases", self.lease_list
+        )
+        self.route(
+            "POST", r"/reservation/v1/leases", "reservation/leases", self.lease_create
+        )
+        self.route(
+            "GET",
+            r"/reservation/v1/leases/(?P<id>[^/]+)",
+            "reservation/leases",
+            self.lease_fetch,
+        )
+        self.route(
+            "PUT",
+            r"/reservation/v1/leases/(?P<id>[^/]+)",
+            "reservation/leases",
+            self.lease_update,
+        )
+        self.route(
+            "DELETE",
+            r"/reservation/v1/leases/(?P<id>[^/]+)",
+            "reservation/leases",
+            self.lease_delete,
+        )
+
+    def add_application_credential(self, user_id="user1"):
+        """Adds an application credential and returns the (id, secret)."""
+        credential_id = str(uuid.uuid4())
+        self.application_credentials[credential_id] = user_id
+        return credential_id, "secret"
+
+    def clouds_yaml(self, credential_id, secret):
+        """Returns the clouds.yaml content for the given application credential."""
+        return yaml.safe_dump(
+            {
+                "clouds": {
+                    "openstack": {
+                        "auth_type": "v3applicationcredential",
+                        "auth": {
+                            "auth_url": f"{BASE_URL}/identity/v3",
+                            "application_credential_id": credential_id,
+                            "application_credential_secret": secret,
+                        },
+                        "interface": "public",
+                        "region_name": "RegionOne",
+                    },
+                },
+            }
+        )
+
+    def secret_data(self, credential_id, secret):
+        """Returns the data for a Kubernetes secret for the given credential."""
+        clouds_yaml = self.clouds_yaml(credential_id, secret)
+        return {"clouds.yaml": base64.b64encode(clouds_yaml.encode()).decode()}
+
+    def _authenticate(self, request):
+        issued_at = self.tokens.get(request.headers.get("x-auth-token"))
+        if issued_at is None:
+            return False
+        if (
+            self.token_ttl is not None
+            and time.monotonic() - issued_at >= self.token_ttl
+        ):
+            return False
+        return True
+
+    def _paginate(self, request, items, plural):
+        """Returns the response for a page of items, with a link to the next page."""
+        try:
+            limit = int(request.query["limit"][0])
+        except KeyError:
+            limit = self.page_size
+        if "marker" in request.query:
+            marker = request.query["marker"][0]
+            ids = [item["id"] for item in items]
+            if marker not in ids:
+                return asgi.Response(400, {"error": f"marker {marker} not found"})
+            items = items[ids.index(marker) + 1 :]
+        data = {plural: items[:limit] if limit else items}
+        if limit and len(items) > limit:
+            # Like real clouds, the links use the public URL
+            marker = items[limit - 1]["id"]
+            next_url = f"{BASE_URL}{request.path}?limit={limit}&marker={marker}"
+            data[f"{plural}_links"] = [{"rel": "next", "href": next_url}]
+        return asgi.Response(200, data)
+
+    async def issue_token(self, request):
+        credential = request.json()["auth"]["identity"]["application_credential"]
+        user_id = self.application_credentials.get(credential["id"])
+        if not user_id:
+            return asgi.Response(401, {"error": {"message": "invalid credential"}})
+        token = f"token-{next(self._token_ids)}"
+        self.tokens[token] = time.monotonic()
+        expires_at = clock.now() + datetime.timedelta(
+            seconds=self.token_ttl or DEFAULT_TOKEN_TTL
+        )
+        return asgi.Response(
+            201,
+            {
+                "token": {
+                    "user": {"id": user_id},
+                    "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                },
+            },
+            headers={"x-subject-token": token},
+        )
+
+    async def catalog(self, request):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        return asgi.Response(
+            200,
+            {
+                "catalog": [
+                    {
+                        "type": service_type,
+                        "endpoints": [
+                            {
+                                "interface": "public",
+                                "region": "RegionOne",
+                                "url": f"{BASE_URL}/{path}",
+                            },
+                        ],
+                    }
+                    for service_type, path in [
+                        ("identity", "identity"),
+                        ("compute", "compute/v2.1"),
+                        ("reservation", "reservation/v1"),
+                    ]
+                ],
+            },
+        )
+
+    async def delete_application_credential(self, request, user_id, id):
+        if self.application_credentials.get(id) != user_id:
+            return asgi.Response(404)
+        del self.application_credentials[id]
+        return asgi.Response(204)
+
+    async def flavor_list(self, request):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        return self._paginate(request, list(self.flavors.values()), "flavors")
+
+    def _lease_status(self, lease):
+        now = clock.now()
+        if now >= parse_blazar_date(lease["end_date"]):
+            return "TERMINATED"
+        elif now >= parse_blazar_date(lease["start_date"]):
+            return "ACTIVE"
+        else:
+            return "PENDING"
+
+    def _lease_view(self, lease):
+        return {**lease, "status": self._lease_status(lease)}
+
+    async def lease_list(self, request):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        leases = [self._lease_view(lease) for lease in self.leases.values()]
+        return self._paginate(request, leases, "leases")
+
+    async def lease_create(self, request):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        data = request.json()
+        lease_id = str(uuid.uuid4())
+        reservations = []
+        for reservation in data["reservations"]:
+            # Blazar creates a flavor for each reservation with the reservation ID
+            reservation_id = str(uuid.uuid4())
+            self.flavors[reservation_id] = {
+                "id": reservation_id,
+                "name": f"reservation:{reservation_id}",
+            }
+            reservations.append(
+                {
+                    **reservation,
+                    "id": reservation_id,
+                    "lease_id": lease_id,
+                    "resource_properties": json.dumps({"id": reservation["flavor_id"]}),
+                }
+            )
+        start_date = data["start_date"]
+        if start_date == "now":
+            start_date = clock.now().strftime("%Y-%m-%d %H:%M")
+        lease = {
+            "id": lease_id,
+            "name": data["name"],
+            "start_date": start_date,
+            "end_date": data["end_date"],
+            "reservations": reservations,
+        }
+        self.leases[lease_id] = lease
+        return asgi.Response(201, {"lease": self._lease_view(lease)})
+
+    async def lease_fetch(self, request, id):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        if id not in self.leases:
+            return asgi.Response(404)
+        return asgi.Response(200, {"lease": self._lease_view(self.leases[id])})
+
+    async def lease_update(self, request, id):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        if id not in self.leases:
+            return asgi.Response(404)
+        data = request.json()
+        lease = self.leases[id]
+        for key in ["name", "start_date", "end_date"]:
+            if key in data:
+                lease[key] = data[key]
+        return asgi.Response(200, {"lease": self._lease_view(lease)})
+
+    async def lease_delete(self, request, id):
+        if not self._authenticate(request):
+            return asgi.Response(401)
+        lease = self.leases.pop(id, None)
+        if lease is None:
+            return asgi.Response(404)
+        for reservation in lease["reservations"]:
+            self.flavors.pop(reservation["id"], None)
+        return asgi.Response(204)
@@ -0,0 +1,125 @@
+import asyncio
+import unittest
+
+import easykube
+import httpx
+
+from azimuth_schedule_operator.models import registry
+from azimuth_schedule_operator.tests.fakes import kubernetes
+
+
+class TestFakeKubernetes(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fake = kubernetes.FakeKubernetes()
+        self.client = easykube.AsyncClient(
+            base_url="http://kubernetes.fake",
+            transport=httpx.ASGITransport(app=self.fake),
+        )
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    def test_merge_patch(self):
+        self.assertEqual(
+            kubernetes.merge_patch(
+                {"a": {"b": 1, "c": 2}, "d": 3}, {"a": {"b": None, "e": 4}, "d": 5}
+            ),
+            {"a": {"c": 2, "e": 4}, "d": 5},
+        )
+
+    async def test_crud(self):
+        configmaps = await self.client.api("v1").resource("configmaps")
+        created = await configmaps.create(
+            {"metadata": {"name": "cm1"}, "data": {"key": "value"}}, namespace="ns1"
+        )
+        self.assertEqual(created.kind, "ConfigMap")
+        fetched = await configmaps.fetch("cm1", namespace="ns1")
+        self.assertEqual(fetched.data, {"key": "value"})
+        for params, expected in [
+            ({"namespace": "ns1"}, ["cm1"]),
+            ({"namespace": "ns2"}, []),
+            ({"all_namespaces": True}, ["cm1"]),
+        ]:
+            listed = [cm.metadata.name async for cm in configmaps.list(**params)]
+            self.assertEqual(listed, expected)
+
+        await configmaps.delete("cm1", namespace="ns1")
+        with self.assertRaises(easykube.ApiError) as ctx:
+            await configmaps.fetch("cm1", namespace="ns1")
+        self.assertEqual(ctx.exception.status_code, 404)
+
+        self.assertEqual(self.fake.calls["GET configmaps"], 5)
+        self.assertEqual(self.fake.calls["DELETE configmaps"], 1)
+
+    async def test_watch(self):
+        configmaps = await self.client.api("v1").resource("configmaps")
+        await configmaps.create({"metadata": {"name": "cm1"}}, namespace="ns1")
+
+        initial, events = await configmaps.watch_list(all_namespaces=True)
+        self.assertEqual([cm["metadata"]["name"] for cm in initial], ["cm1"])
+        received = []
+
+        async def watch():
+            async for event in events:
+                received.append((event["type"], event["object"]["metadata"]["name"]))
+                if len(received) == 3:
+                    break
+
+        task = asyncio.create_task(watch())
+        await configmaps.create({"metadata": {"name": "cm2"}}, namespace="ns2")
+        await configmaps.patch("cm1", {"data": {"key": "value"}}, namespace="ns1")
+        await configmaps.delete("cm2", namespace="ns2")
+        await asyncio.wait_for(task, 1)
+
+        self.assertEqual(
+            received, [("ADDED", "cm2"), ("MODIFIED", "cm1"), ("DELETED", "cm2")]
+        )
+        self.assertGreaterEqual(self.fake.calls["WATCH configmaps"], 1)
+
+    async def test_status(self):
+        lease = self.fake.add(
+            {
+                "apiVersion": registry.API_VERSION,
+                "kind": "Lease",
+                "metadata": {"name": "lease1", "namespace": "ns1"},
+                "spec": {"cloudCredentialsSecretName": "creds"},
+            }
+        )
+        resource_version = lease["metadata"]["resourceVersion"]
+        api = self.client.api(registry.API_VERSION)
+        leases_status = await api.resource("leases/status")
+
+        replaced = await leases_status.replace(
+            "lease1",
+            {
+                "metadata": {"resourceVersion": resource_version},
+                "status": {"phase": "Active"},
+            },
+            namespace="ns1",
+        )
+        self.assertEqual(replaced.status, {"phase": "Active"})
+        self.assertNotEqual(replaced.metadata.resourceVersion, resource_version)
+
+        # A replace with a stale resource version should conflict
+        with self.assertRaises(easykube.ApiError) as ctx:
+            await leases_status.replace(
+                "lease1",
+                {
+                    "metadata": {"resourceVersion": resource_version},
+                    "status": {"phase": "Error"},
+                },
+                namespace="ns1",
+            )
+        self.assertEqual(ctx.exception.status_code, 409)
+
+        # Patching the status should not change the spec
+        patched = await leases_status.patch(
+            "lease1",
+            {"spec": {"cloudCredentialsSecretName": "other"}, "status": {"x": 1}},
+            namespace="ns1",
+        )
+        self.assertEqual(patched.status, {"phase": "Active", "x": 1})
+        self.assertEqual(
+            self.fake.get(registry.API_VERSION, "leases", "ns1", "lease1")["spec"],
+            {"cloudCredentialsSecretName": "creds"},
+        )
@@ -0,0 +1,153 @@
+import unittest
+from unittest import mock
+
+import freezegun
+import httpx
+
+from azimuth_schedule_operator import openstack
+from azimuth_schedule_operator.tests.fakes import asgi
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+
+FLAVORS = [{"id": f"id{i}", "name": f"flavor{i}"} for i in range(1, 6)]
+
+
+class TestFakeOpenStack(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.setup_cloud()
+
+    def setup_cloud(self, **kwargs):
+        self.fake = fake_openstack.FakeOpenStack(**kwargs)
+        credential = self.fake.add_application_credential("user1")
+        self.cloud = openstack.from_secret_data(
+            self.fake.secret_data(*credential),
+            transport=httpx.ASGITransport(app=self.fake),
+        )
+
+    async def test_authenticate(self):
+        async with self.cloud as cloud:
+            self.assertTrue(cloud.is_authenticated)
+            self.assertEqual(cloud.current_user_id, "user1")
+            compute = cloud.api_client("compute")
+            flavors = [f.name async for f in compute.resource("flavors").list()]
+
+        self.assertEqual(flavors, ["flavor1"])
+        self.assertEqual(self.fake.calls["POST identity/tokens"], 1)
+
+    async def test_invalid_credential(self):
+        self.fake.application_credentials.clear()
+        with self.assertRaises(httpx.HTTPStatusError):
+            async with self.cloud:
+                pass
+
+    async def test_blazar_leases(self):
+        async with self.cloud as cloud:
+            leases = cloud.api_client("reservation").resource("leases")
+            with freezegun.freeze_time("2024-08-21T14:00:00Z"):
+                lease = await leases.create(
+                    {
+                        "name": "lease1",
+                        "start_date": "2024-08-21 15:00",
+                        "end_date": "2024-08-21 16:00",
+                        "reservations": [
+                            {"amount": 1, "flavor_id": "id1"},
+                        ],
+                    }
+                )
+            self.assertEqual(lease["status"], "PENDING")
+            reservation_id = lease["reservations"][0]["id"]
+            self.assertIn(reservation_id, self.fake.flavors)
+
+            for now, status in [
+                ("2024-08-21T15:30:00Z", "ACTIVE"),
+                ("2024-08-21T16:30:00Z", "TERMINATED"),
+            ]:
+                with freezegun.freeze_time(now):
+                    (listed,) = [lease async for lease in leases.list()]
+                self.assertEqual(listed["status"], status)
+
+            await leases.delete(lease["id"])
+
+        self.assertEqual(self.fake.leases, {})
+        self.assertNotIn(reservation_id, self.fake.flavors)
+
+    async def test_blazar_lease_fetch_update(self):
+        async with self.cloud as cloud:
+            leases = cloud.api_client("reservation").resource("leases")
+            lease = await leases.create(
+                {
+                    "name": "lease1",
+                    "start_date": "now",
+                    "end_date": "2099-01-01 00:00",
+                    "reservations": [{"amount": 1, "flavor_id": "id1"}],
+                }
+            )
+            fetched = await leases.fetch(lease["id"])
+            self.assertEqual(fetched["status"], "ACTIVE")
+
+            updated = await leases.replace(
+                lease["id"], {"end_date": "2000-01-01 00:00"}
+            )
+            self.assertEqual(updated["status"], "TERMINATED")
+            self.assertEqual(self.fake.calls["PUT reservation/leases"], 1)
+
+    async def test_pagination(self):
+        self.setup_cloud(flavors=FLAVORS, page_size=2)
+        async with self.cloud as cloud:
+            compute = cloud.api_client("compute")
+            flavors = [f.id async for f in compute.resource("flavors").list()]
+
+        self.assertEqual(flavors, [f["id"] for f in FLAVORS])
+        # 5 flavors with 2 per page are returned in 3 pages
+        self.assertEqual(self.fake.calls["GET compute/flavors"], 3)
+
+    async def test_token_expiry(self):
+        self.setup_cloud(token_ttl=60)
+        async with self.cloud as cloud:
+            flavors = cloud.api_client("compute").resource("flavors")
+            self.assertEqual([f.id async for f in flavors.list()], ["id1"])
+            # Age the token past its expiry
+            for token in self.fake.tokens:
+                self.fake.tokens[token] -= 60
+            with self.assertRaises(httpx.HTTPStatusError) as ctx:
+                [f async for f in flavors.list()]
+
+        self.assertEqual(ctx.exception.response.status_code, 401)
+
+    async def test_latency(self):
+        self.setup_cloud(latency={"*": 0.5, "GET compute/flavors": 2})
+        with mock.patch.object(asgi.asyncio, "sleep") as sleep:
+            async with self.cloud as cloud:
+                flavors = cloud.api_client("compute").resource("flavors")
+                [f async for f in flavors.list()]
+
+        # Token, catalog and flavors
+        self.assertEqual(
+            [call.args[0] for call in sleep.await_args_list], [0.5, 0.5, 2]
+        )
+
+    async def test_error_injection(self):
+        self.setup_cloud(error_rates={"GET compute/flavors": 1})
+        async with self.cloud as cloud:
+            flavors = cloud.api_client("compute").resource("flavors")
+            with self.assertRaises(httpx.HTTPStatusError) as ctx:
+                [f async for f in flavors.list()]
+
+        self.assertEqual(ctx.exception.response.status_code, 503)
+
+    async def test_error_injection_seeded(self):
+        async def statuses(seed):
+            fake = fake_openstack.FakeOpenStack(error_rates={"*": 0.5}, seed=seed)
+            async with httpx.AsyncClient(
+                base_url=fake_openstack.BASE_URL,
+                transport=httpx.ASGITransport(app=fake),
+            ) as client:
+                return [
+                    (await client.get("/compute/v2.1/flavors")).status_code
+                    for _ in range(20)
+                ]
+
+        # Requests without a token are rejected unless an error is injected first
+        first = await statuses(1)
+        self.assertEqual(set(first), {401, 503})
+        # The same seed produces the same errors
+        self.assertEqual(await statuses(1), first)
@@ -253,6 +253,26 @@ class TestModels(base.TestCase):
                     "description": "Mapping of original size name to reserved size name.",
                     "type": "object",
                     "x-kubernetes-preserve-unknown-fields": true
+                  },
+                  "phaseTransitions": {
+                    "additionalProperties": {
+                      "format": "date-time",
+                      "type": "string"
+                    },
+                    "description": "The time at which the lease first entered each phase.",
+                    "type": "object",
+                    "x-kubernetes-preserve-unknown-fields": true
+                  },
+                  "ownersDeleteRequestedAt": {
+                    "description": "The time at which the deletion of the owners of the lease was requested.",
+                    "format": "date-time",
+                    "nullable": true,
+                    "type": "string"
+                  },
+                  "blazarLeaseId": {
+                    "description": "The ID of the Blazar lease for the lease, if known.",
+                    "nullable": true,
+                    "type": "string"
                   }
                 },
                 "type": "object",
@@ -0,0 +1,89 @@
+import unittest
+
+from dateutil.parser import isoparse
+
+from azimuth_schedule_operator import aggregates
+
+from . import util
+
+
+def fake_schedule(uid, namespace="ns1", delete_triggered=False):
+    return {
+        "metadata": {"uid": uid, "namespace": namespace},
+        "status": {"refDeleteTriggered": delete_triggered},
+    }
+
+
+class TestLeaseAggregates(unittest.TestCase):
+    def setUp(self):
+        self.leases = aggregates.LeaseAggregates()
+
+    def test_phase_counts(self):
+        self.leases.update(util.lease_body(uid="1", phase="Active"))
+        self.leases.update(util.lease_body(uid="2", phase="Active"))
+        self.leases.update(util.lease_body(uid="3"))
+        self.leases.update(util.lease_body(uid="4", namespace="ns2", phase="Pending"))
+
+        self.assertEqual(
+            set(self.leases.phase_counts()),
+            {("ns1", "Active", 2), ("ns1", "Unknown", 1), ("ns2", "Pending", 1)},
+        )
+
+    def test_phase_counts_update_and_remove(self):
+        self.leases.update(util.lease_body(uid="1", phase="Pending"))
+        self.leases.update(util.lease_body(uid="2", phase="Pending"))
+        self.leases.update(util.lease_body(uid="1", phase="Active"))
+        self.leases.remove(util.lease_body(uid="2"))
+        # Removing an unknown lease should be a no-op
+        self.leases.remove(util.lease_body(uid="3"))
+
+        self.assertEqual(set(self.leases.phase_counts()), {("ns1", "Active", 1)})
+        self.assertEqual(len(self.leases), 1)
+
+    def test_ending_between(self):
+        self.leases.update(util.lease_body(uid="1", ends_at="2024-08-21T15:30:00Z"))
+        self.leases.update(util.lease_body(uid="2", ends_at="2024-08-21T16:00:00Z"))
+        self.leases.update(util.lease_body(uid="3", ends_at="2024-08-21T17:00:00Z"))
+        self.leases.update(util.lease_body(uid="4", namespace="ns2"))
+        self.leases.update(util.lease_body(uid="5", ends_at="2024-08-21T15:45:00Z"))
+        self.leases.remove(util.lease_body(uid="5"))
+
+        start = isoparse("2024-08-21T15:00:00Z").timestamp()
+        self.assertEqual(
+            dict(self.leases.ending_between(start, start + 3600)), {"ns1": 2}
+        )
+
+    def test_remove_namespaces(self):
+        self.leases.update(util.lease_body(uid="1", ends_at="2024-08-21T15:30:00Z"))
+        self.leases.update(util.lease_body(uid="2", namespace="ns2", phase="Active"))
+        self.leases.update(util.lease_body(uid="3", namespace="ns3"))
+
+        self.leases.remove_namespaces({"ns1", "ns2"})
+
+        self.assertEqual(set(self.leases.phase_counts()), {("ns3", "Unknown", 1)})
+        self.assertEqual(dict(self.leases.ending_between(0, 1e12)), {})
+        self.assertEqual(len(self.leases), 1)
+
+
+class TestScheduleAggregates(unittest.TestCase):
+    def test_pending_delete_counts(self):
+        schedules = aggregates.ScheduleAggregates()
+        schedules.update(fake_schedule("1"))
+        schedules.update(fake_schedule("2"))
+        schedules.update(fake_schedule("3", namespace="ns2"))
+        schedules.update(fake_schedule("2", delete_triggered=True))
+        schedules.update(fake_schedule("3", namespace="ns2", delete_triggered=True))
+        schedules.remove(fake_schedule("1"))
+
+        self.assertEqual(dict(schedules.pending_delete_counts()), {"ns1": 0, "ns2": 0})
+        self.assertEqual(len(schedules), 2)
+
+    def test_remove_namespaces(self):
+        schedules = aggregates.ScheduleAggregates()
+        schedules.update(fake_schedule("1"))
+        schedules.update(fake_schedule("2", namespace="ns2"))
+
+        schedules.remove_namespaces({"ns1"})
+
+        self.assertEqual(dict(schedules.pending_delete_counts()), {"ns2": 1})
+        self.assertEqual(len(schedules), 1)
@@ -0,0 +1,86 @@
+import unittest
+from unittest import mock
+
+from azimuth_schedule_operator import cache
+
+
+class TestCache(unittest.TestCase):
+    @mock.patch.object(cache.time, "monotonic")
+    def test_get_and_set(self, monotonic):
+        monotonic.return_value = 100
+        values = cache.Cache("test", ttl=60)
+        self.assertIn(values, cache.CACHES)
+
+        self.assertIsNone(values.get("key"))
+        values["key"] = "value"
+        monotonic.return_value = 159
+        self.assertIn("key", values)
+        self.assertEqual(values.get("key"), "value")
+        # Once the TTL has passed, the value is removed
+        monotonic.return_value = 160
+        self.assertNotIn("key", values)
+        self.assertEqual(values.get("key", "default"), "default")
+        self.assertEqual(len(values), 0)
+
+        self.assertEqual((values.hits, values.misses), (1, 2))
+
+    def test_pop_and_clear(self):
+        values = cache.Cache("test")
+        values["key1"] = "value1"
+        values["key2"] = "value2"
+
+        self.assertEqual(values.pop("key1"), "value1")
+        self.assertIsNone(values.pop("key1"))
+        values.clear()
+        self.assertEqual(len(values), 0)
+
+    @mock.patch.object(cache.time, "monotonic")
+    def test_bounded(self, monotonic):
+        monotonic.return_value = 100
+        values = cache.Cache("test", ttl=60, max_size=2)
+        values["key1"] = "value1"
+        values["key2"] = "value2"
+        # Replacing a value makes it the newest
+        values["key1"] = "value1"
+        # Once the cache is full, the oldest value is removed
+        values["key3"] = "value3"
+        self.assertEqual(len(values), 2)
+        self.assertIsNone(values.get("key2"))
+        self.assertEqual(values.get("key1"), "value1")
+
+        # Expired values are removed when a value is stored, even if not looked up
+        monotonic.return_value = 160
+        values["key4"] = "value4"
+        self.assertEqual(len(values), 1)
+
+    @mock.patch.object(cache.time, "monotonic")
+    def test_stats(self, monotonic):
+        values = cache.Cache("test", ttl=60)
+        self.assertEqual(
+            values.stats(),
+            {
+                "name": "test",
+                "size": 0,
+                "ttl": 60,
+                "maxSize": None,
+                "hits": 0,
+                "misses": 0,
+                "hitRatio": None,
+                "oldestAge": None,
+                "newestAge": None,
+            },
+        )
+
+        monotonic.return_value = 100
+        values["key1"] = "value1"
+        monotonic.return_value = 110
+        values["key2"] = "value2"
+        values.get("key1")
+        values.get("key3")
+        values.get("key2")
+        monotonic.return_value = 120
+        stats = values.stats()
+
+        self.assertEqual(stats["size"], 2)
+        self.assertAlmostEqual(stats["hitRatio"], 2 / 3)
+        self.assertEqual((stats["oldestAge"], stats["newestAge"]), (20, 10))
@@ -0,0 +1,312 @@
+import datetime
+import difflib
+import json
+import logging
+import os
+import pathlib
+import unittest
+from unittest import mock
+
+import httpx
+
+from azimuth_schedule_operator import openstack, operator
+from azimuth_schedule_operator.models import registry
+from azimuth_schedule_operator.tests import util
+from azimuth_schedule_operator.tests.fakes import kubernetes as fake_kubernetes
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+
+# The checked-in budget for the API calls made in each scenario
+BUDGETS_FILE = pathlib.Path(__file__).parent / "call_budgets.json"
+
+# Set this to rewrite the budgets file using the calls that are made
+UPDATE_BUDGETS = os.environ.get("UPDATE_CALL_BUDGETS", "").lower() in ("1", "true")
+
+SECRET_NAME = "cloud-credentials"
+NAMESPACE = "ns1"
+
+
+def blazar_date(value):
+    return value.strftime("%Y-%m-%d %H:%M")
+
+
+def load_budgets():
+    if BUDGETS_FILE.exists():
+        return json.loads(BUDGETS_FILE.read_text())
+    else:
+        return {}
+
+
+class TestCallBudgets(unittest.IsolatedAsyncioTestCase):
+    """
+    Checks the Kubernetes and OpenStack API calls made by each handler against the
+    budgets in call_budgets.json, so that changes that add calls to a hot path fail.
+
+    When the calls for a scenario change intentionally, regenerate the budgets with
+    UPDATE_CALL_BUDGETS=1 and review the diff.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.budgets = load_budgets()
+        cls.recorded = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if UPDATE_BUDGETS:
+            budgets = {**cls.budgets, **cls.recorded}
+            BUDGETS_FILE.write_text(
+                json.dumps(budgets, indent=2, sort_keys=True) + "\n"
+            )
+
+    async def asyncSetUp(self):
+        self.now = datetime.datetime.now(datetime.timezone.utc)
+        self.logger = logging.getLogger(__name__)
+        self.k8s_fake = fake_kubernetes.FakeKubernetes()
+        self.cloud_fake = fake_openstack.FakeOpenStack()
+        credential = self.cloud_fake.add_application_credential()
+        self.add(
+            "v1", "Secret", SECRET_NAME, data=self.cloud_fake.secret_data(*credential)
+        )
+        self.owner = self.add("v1", "ConfigMap", "platform1")
+
+        self.k8s_client = self.k8s_fake.client()
+        self.addAsyncCleanup(self.k8s_client.aclose)
+        from_secret_data = openstack.from_secret_data
+
+        def fake_from_secret_data(secret_data):
+            transport = httpx.ASGITransport(app=self.cloud_fake)
+            return from_secret_data(secret_data, transport=transport)
+
+        for patcher in [
+            mock.patch.object(operator, "K8S_CLIENT", self.k8s_client),
+            mock.patch.object(openstack, "from_secret_data", fake_from_secret_data),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # Discovery is cached by the long-lived client, so it is not part of the budget
+        for api_version, plural, _ in fake_kubernetes.DEFAULT_RESOURCES:
+            await self.k8s_client.api(api_version).resource(plural)
+        self.k8s_fake.calls.clear()
+
+    def add(self, api_version, kind, name, **fields):
+        return self.k8s_fake.add(
+            {
+                "apiVersion": api_version,
+                "kind": kind,
+                "metadata": {"name": name, "namespace": NAMESPACE},
+                **fields,
+            }
+        )
+
+    def add_lease(self, starts_at, ends_at, phase=None):
+        status = {"phase": phase} if phase else {}
+        return self.add(
+            registry.API_VERSION,
+            "Lease",
+            "lease1",
+            spec={
+                "cloudCredentialsSecretName": SECRET_NAME,
+                "startsAt": util.isoformat(starts_at),
+                "endsAt": util.isoformat(ends_at),
+                "resources": {"machines": [{"sizeId": "id1", "count": 1}]},
+            },
+            status=status,
+        )
+
+    def add_blazar_lease(self, starts_at, ends_at):
+        lease_id = "blazar1"
+        self.cloud_fake.leases[lease_id] = {
+            "id": lease_id,
+            "name": "az-lease1",
+            "start_date": blazar_date(starts_at),
+            "end_date": blazar_date(ends_at),
+            "reservations": [],
+        }
+
+    def add_schedule(self, not_after, status=None):
+        return self.add(
+            registry.API_VERSION,
+            "Schedule",
+            "schedule1",
+            spec={
+                "ref": {"apiVersion": "v1", "kind": "ConfigMap", "name": "platform1"},
+                "notAfter": util.isoformat(not_after),
+            },
+            status=status or {},
+        )
+
+    def check_budget(self, scenario):
+        recorded = {
+            "kubernetes": dict(sorted(self.k8s_fake.calls.items())),
+            "openstack": dict(sorted(self.cloud_fake.calls.items())),
+        }
+        self.recorded[scenario] = recorded
+        if UPDATE_BUDGETS:
+            return
+        budget = self.budgets.get(scenario)
+        if budget is None:
+            self.fail(f"no call budget for {scenario} - set UPDATE_CALL_BUDGETS=1")
+        if recorded != budget:
+            diff = "\n".join(
+                difflib.unified_diff(
+                    json.dumps(budget, indent=2, sort_keys=True).splitlines(),
+                    json.dumps(recorded, indent=2, sort_keys=True).splitlines(),
+                    "budget",
+                    "recorded",
+                    lineterm="",
+                )
+            )
+            self.fail(
+                f"API calls for {scenario} do not match the budget in "
+                f"{BUDGETS_FILE.name} - if this is intended, regenerate the budgets "
+                f"with UPDATE_CALL_BUDGETS=1\n{diff}"
+            )
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
+    async def test_reconcile_lease_no_blazar(self):
+        body = self.add_lease(
+            self.now - datetime.timedelta(hours=1),
+            self.now + datetime.timedelta(days=1),
+        )
+
+        await operator.reconcile_lease(body=body, logger=self.logger)
+
+        self.check_budget("reconcile_lease/no_blazar")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "yes")
+    async def test_reconcile_lease_blazar_create(self):
+        body = self.add_lease(
+            self.now - datetime.timedelta(hours=1),
+            self.now + datetime.timedelta(days=1),
+        )
+
+        await operator.reconcile_lease(body=body, logger=self.logger)
+
+        self.assertEqual(len(self.cloud_fake.leases), 1)
+        self.check_budget("reconcile_lease/blazar_create")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
+    async def test_check_lease_no_blazar(self):
+        body = self.add_lease(
+            self.now - datetime.timedelta(hours=1),
+            self.now + datetime.timedelta(days=1),
+            phase="Active",
+        )
+
+        await operator.check_lease(body=body, logger=self.logger, memo={})
+
+        self.check_budget("check_lease/no_blazar")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "yes")
+    async def test_check_lease_blazar_active(self):
+        starts_at = self.now - datetime.timedelta(hours=1)
+        ends_at = self.now + datetime.timedelta(days=1)
+        body = self.add_lease(starts_at, ends_at, phase="Active")
+        self.add_blazar_lease(starts_at, ends_at)
+
+        await operator.check_lease(body=body, logger=self.logger, memo={})
+
+        self.check_budget("check_lease/blazar_active")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
+    async def test_check_lease_ending(self):
+        body = self.add_lease(
+            self.now - datetime.timedelta(days=1),
+            self.now + datetime.timedelta(minutes=1),
+            phase="Active",
+        )
+        body["metadata"]["ownerReferences"] = [
+            {
+                "apiVersion": "v1",
+                "kind": "ConfigMap",
+                "name": "platform1",
+                "uid": self.owner["metadata"]["uid"],
+            },
+        ]
+
+        await operator.check_lease(body=body, logger=self.logger, memo={})
+
+        self.assertIsNone(self.k8s_fake.get("v1", "configmaps", NAMESPACE, "platform1"))
+        self.check_budget("check_lease/ending")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
+    async def test_check_lease_deleting(self):
+        body = self.add_lease(
+            self.now - datetime.timedelta(days=1),
+            self.now + datetime.timedelta(minutes=1),
+            phase="Active",
+        )
+        body["metadata"]["ownerReferences"] = [
+            {
+                "apiVersion": "v1",
+                "kind": "ConfigMap",
+                "name": "platform1",
+                "uid": self.owner["metadata"]["uid"],
+            },
+        ]
+        await operator.check_lease(body=body, logger=self.logger, memo={})
+        body = self.k8s_fake.get(registry.API_VERSION, "leases", NAMESPACE, "lease1")
+        self.k8s_fake.calls.clear()
+        self.cloud_fake.calls.clear()
+
+        # Later ticks only check that the deletion is progressing
+        await operator.check_lease(body=body, logger=self.logger, memo={})
+
+        self.check_budget("check_lease/deleting")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "yes")
+    async def test_delete_lease_blazar(self):
+        starts_at = self.now - datetime.timedelta(days=1)
+        ends_at = self.now - datetime.timedelta(hours=1)
+        body = self.add_lease(starts_at, ends_at, phase="Terminated")
+        self.add_blazar_lease(starts_at, ends_at)
+
+        # The fake deletes the lease straight away, so there is no need to wait
+        with mock.patch.object(operator, "BLAZAR_DELETE_POLL_INITIAL_SECONDS", 0):
+            await operator.delete_lease(body=body, logger=self.logger)
+
+        self.assertEqual(self.cloud_fake.leases, {})
+        self.assertEqual(self.cloud_fake.application_credentials, {})
+        self.assertIsNone(self.k8s_fake.get("v1", "secrets", NAMESPACE, SECRET_NAME))
+        self.check_budget("delete_lease/blazar")
+
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "yes")
+    async def test_delete_lease_credential(self):
+        body = self.add_lease(
+            self.now - datetime.timedelta(days=1),
+            self.now - datetime.timedelta(hours=1),
+            phase="Deleting",
+        )
+
+        await operator.delete_lease(body=body, logger=self.logger)
+
+        self.assertEqual(self.cloud_fake.application_credentials, {})
+        self.assertIsNone(self.k8s_fake.get("v1", "secrets", NAMESPACE, SECRET_NAME))
+        self.check_budget("delete_lease/credential")
+
+    async def test_schedule_check_new(self):
+        body = self.add_schedule(self.now + datetime.timedelta(days=1))
+
+        await operator.schedule_check(body=body, namespace=NAMESPACE)
+
+        self.check_budget("schedule_check/new")
+
+    async def test_schedule_check_waiting(self):
+        body = self.add_schedule(
+            self.now + datetime.timedelta(days=1), status={"refExists": True}
+        )
+
+        await operator.schedule_check(body=body, namespace=NAMESPACE)
+
+        self.check_budget("schedule_check/waiting")
+
+    async def test_schedule_check_expired(self):
+        body = self.add_schedule(
+            self.now - datetime.timedelta(hours=1), status={"refExists": True}
+        )
+
+        await operator.schedule_check(body=body, namespace=NAMESPACE)
+
+        self.assertIsNone(self.k8s_fake.get("v1", "configmaps", NAMESPACE, "platform1"))
+        self.check_budget("schedule_check/expired")
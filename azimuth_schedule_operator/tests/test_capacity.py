@@ -0,0 +1,120 @@
+import random
+import unittest
+
+from dateutil.parser import isoparse
+
+from azimuth_schedule_operator import capacity
+
+from . import util
+
+
+def ts(value):
+    return isoparse(value).timestamp()
+
+
+class TestReservationTimeline(unittest.TestCase):
+    def test_against_brute_force(self):
+        rng = random.Random(1)
+        timeline = capacity.ReservationTimeline(seed=1)
+        intervals = []
+        for _ in range(200):
+            start = rng.randrange(1000)
+            end = start + rng.randrange(1, 200)
+            count = rng.randrange(1, 5)
+            intervals.append((start, end, count))
+            timeline.add(start, count)
+            timeline.add(end, -count)
+        # Remove some of the intervals again
+        for start, end, count in intervals[:50]:
+            timeline.add(start, -count)
+            timeline.add(end, count)
+        intervals = intervals[50:]
+
+        def reserved_at(t):
+            return sum(c for s, e, c in intervals if s <= t < e)
+
+        for _ in range(100):
+            a = rng.randrange(1200)
+            b = a + rng.randrange(300)
+            self.assertEqual(timeline.reserved_at(a), reserved_at(a))
+            self.assertEqual(
+                timeline.peak_between(a, b),
+                max(reserved_at(t) for t in range(a, b + 1)),
+            )
+
+
+class TestCapacityIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = capacity.CapacityIndex()
+        self.index.update(
+            util.lease_body(
+                uid="1",
+                machines=[("small", 2), ("large", 1)],
+                starts_at="2024-08-21T15:00:00Z",
+                ends_at="2024-08-21T16:00:00Z",
+            )
+        )
+        self.index.update(
+            util.lease_body(
+                uid="2",
+                machines=[("small", 3)],
+                starts_at="2024-08-21T15:30:00Z",
+                ends_at="2024-08-21T17:00:00Z",
+            )
+        )
+        # No start means the creation timestamp and no end means forever
+        self.index.update(util.lease_body(uid="3", machines=[("small", 1)]))
+        # Leases in the error phase reserve nothing
+        self.index.update(
+            util.lease_body(uid="4", machines=[("small", 10)], phase="Error")
+        )
+
+    def test_reserved_at(self):
+        self.assertEqual(self.index.reserved_at("small", ts("2024-08-21T11:00:00Z")), 0)
+        self.assertEqual(self.index.reserved_at("small", ts("2024-08-21T14:00:00Z")), 1)
+        self.assertEqual(self.index.reserved_at("small", ts("2024-08-21T15:45:00Z")), 6)
+        self.assertEqual(self.index.reserved_at("small", ts("2024-08-21T16:00:00Z")), 4)
+        self.assertEqual(self.index.reserved_at("large", ts("2024-08-21T15:00:00Z")), 1)
+        self.assertEqual(self.index.reserved_at("other", ts("2024-08-21T15:00:00Z")), 0)
+
+    def test_peak_between(self):
+        self.assertEqual(
+            self.index.peak_between(
+                "small", ts("2024-08-21T13:00:00Z"), ts("2024-08-21T18:00:00Z")
+            ),
+            6,
+        )
+        self.assertEqual(
+            self.index.peak_between(
+                "small", ts("2024-08-21T16:00:00Z"), ts("2024-08-21T18:00:00Z")
+            ),
+            4,
+        )
+
+    def test_update_and_remove(self):
+        # Moving the lease to the error phase removes the reservation
+        self.index.update(
+            util.lease_body(
+                uid="2",
+                machines=[("small", 3)],
+                starts_at="2024-08-21T15:30:00Z",
+                ends_at="2024-08-21T17:00:00Z",
+                phase="Error",
+            )
+        )
+        self.index.remove(util.lease_body(uid="1", machines=[]))
+        self.index.remove(util.lease_body(uid="3", machines=[]))
+
+        self.assertEqual(self.index.size_ids(), [])
+        self.assertEqual(self.index.reserved_at("small", ts("2024-08-21T15:45:00Z")), 0)
+
+    def test_remove_namespaces(self):
+        self.index.update(
+            util.lease_body(uid="5", namespace="ns2", machines=[("large", 2)])
+        )
+
+        self.index.remove_namespaces({"ns1"})
+
+        self.assertEqual(self.index.size_ids(), ["large"])
+        self.assertEqual(self.index.reserved_at("large", ts("2024-08-21T15:45:00Z")), 2)
+        self.assertEqual(len(self.index), 1)
@@ -0,0 +1,171 @@
+import base64
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import httpx
+import yaml
+
+from azimuth_schedule_operator import cassette, openstack
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+
+CACERT = "-----BEGIN CERTIFICATE-----\nabc\n-----END CERTIFICATE-----\n"
+
+
+def b64encode(value):
+    return base64.b64encode(value.encode()).decode()
+
+
+class TestCassette(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cassette = cassette.Cassette(pathlib.Path(directory.name) / "test.jsonl")
+        self.fake = fake_openstack.FakeOpenStack()
+        self.credential = self.fake.add_application_credential("user1")
+
+    def test_scrub(self):
+        scrubbed = cassette.scrub(
+            {
+                "auth": {"application_credential": {"id": "id1", "secret": "abc"}},
+                "token": {"user": {"id": "user1"}},
+                "items": [{"password": "abc", "name": "item1"}],
+                "cloudCredentialsSecretName": "secret1",
+            }
+        )
+
+        self.assertEqual(
+            scrubbed,
+            {
+                "auth": {"application_credential": {"id": "id1", "secret": "REDACTED"}},
+                "token": {"user": {"id": "user1"}},
+                "items": [{"password": "REDACTED", "name": "item1"}],
+                "cloudCredentialsSecretName": "secret1",
+            },
+        )
+
+    def test_scrub_secret(self):
+        secret_data = self.fake.secret_data(*self.credential)
+        scrubbed = cassette.scrub(
+            {
+                "kind": "Secret",
+                "data": {
+                    **secret_data,
+                    "cacert": b64encode(CACERT),
+                    "ssh-key": b64encode("private"),
+                },
+                "stringData": {"password": "abc"},
+            }
+        )
+
+        clouds = yaml.safe_load(base64.b64decode(scrubbed["data"]["clouds.yaml"]))
+        auth = clouds["clouds"]["openstack"]["auth"]
+        self.assertEqual(auth["application_credential_id"], self.credential[0])
+        self.assertEqual(auth["application_credential_secret"], "REDACTED")
+        self.assertEqual(scrubbed["data"]["cacert"], b64encode(CACERT))
+        self.assertEqual(scrubbed["data"]["ssh-key"], b64encode("REDACTED"))
+        self.assertEqual(scrubbed["stringData"], {"password": "REDACTED"})
+
+    def test_scrub_secret_list(self):
+        secret_data = self.fake.secret_data(*self.credential)
+        scrubbed = cassette.scrub(
+            {
+                "kind": "SecretList",
+                "items": [
+                    {"metadata": {"name": "secret1"}, "data": secret_data},
+                    {"metadata": {"name": "secret2"}, "data": {"key": b64encode("x")}},
+                ],
+            }
+        )
+
+        clouds = yaml.safe_load(
+            base64.b64decode(scrubbed["items"][0]["data"]["clouds.yaml"])
+        )
+        auth = clouds["clouds"]["openstack"]["auth"]
+        self.assertEqual(auth["application_credential_secret"], "REDACTED")
+        self.assertEqual(scrubbed["items"][1]["data"], {"key": b64encode("REDACTED")})
+        self.assertEqual(scrubbed["items"][0]["metadata"], {"name": "secret1"})
+
+    def test_scrub_url(self):
+        self.assertEqual(
+            cassette.scrub_url("http://test/v1/leases?limit=2&token=abc"),
+            "http://test/v1/leases?limit=2&token=REDACTED",
+        )
+        self.assertEqual(cassette.scrub_url("http://test/v1"), "http://test/v1")
+
+    async def list_flavors(self, transport):
+        cloud = openstack.from_secret_data(
+            self.fake.secret_data(*self.credential), transport=transport
+        )
+        async with cloud:
+            compute = cloud.api_client("compute")
+            return [f.name async for f in compute.resource("flavors").list()]
+
+    async def test_record_and_replay(self):
+        transport = cassette.RecordingTransport(
+            httpx.ASGITransport(app=self.fake), self.cassette
+        )
+        recorded = await self.list_flavors(transport)
+
+        content = self.cassette.path.read_text()
+        self.assertNotIn("token-1", content)
+        self.assertNotIn('"secret": "secret"', content)
+        interactions = self.cassette.load()
+        self.assertEqual(
+            [i["request"]["method"] for i in interactions], ["POST", "GET", "GET"]
+        )
+        self.assertEqual(interactions[0]["response"]["status"], 201)
+        self.assertGreaterEqual(interactions[0]["durationSeconds"], 0)
+
+        # Replaying should not touch the fake
+        self.fake.calls.clear()
+        transport = cassette.ReplayTransport(self.cassette, timing=False)
+        replayed = await self.list_flavors(transport)
+
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(sum(self.fake.calls.values()), 0)
+        self.assertEqual(transport.calls["GET /compute/v2.1/flavors"], 1)
+
+    async def test_replay_repeats_last_response(self):
+        self.cassette.append(
+            {
+                "durationSeconds": 0.5,
+                "request": {"method": "GET", "url": "http://test/v1/things"},
+                "response": {"status": 200, "headers": {}, "json": {"things": [1]}},
+            }
+        )
+        self.cassette.append(
+            {
+                "durationSeconds": 1.5,
+                "request": {"method": "GET", "url": "http://test/v1/things"},
+                "response": {"status": 200, "headers": {}, "json": {"things": [2]}},
+            }
+        )
+        transport = cassette.ReplayTransport(self.cassette)
+        with mock.patch.object(cassette.asyncio, "sleep") as sleep:
+            async with httpx.AsyncClient(transport=transport) as client:
+                responses = [
+                    (await client.get("http://test/v1/things")).json()["things"]
+                    for _ in range(3)
+                ]
+                with self.assertRaises(cassette.InteractionNotFoundError):
+                    await client.get("http://test/v1/others")
+
+        self.assertEqual(responses, [[1], [2], [2]])
+        self.assertEqual([c.args[0] for c in sleep.await_args_list], [0.5, 1.5, 1.5])
+
+    def test_record(self):
+        transport = httpx.ASGITransport(app=self.fake)
+        with mock.patch.object(cassette, "CASSETTE_RECORD_DIR", None):
+            self.assertIs(cassette.record("test", transport), transport)
+        with (
+            mock.patch.object(cassette, "CASSETTE_RECORD_DIR", "/tmp/cassettes"),
+            mock.patch.object(cassette, "CASSETTES", {}),
+        ):
+            recording = cassette.record("test", transport)
+            self.assertIsInstance(recording, cassette.RecordingTransport)
+            self.assertEqual(
+                cassette.CASSETTES["test"].path,
+                pathlib.Path("/tmp/cassettes/test.jsonl"),
+            )
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import marshal
+import sys
+import time
+import tracemalloc
+import unittest
+from unittest import mock
+
+from aiohttp import test_utils, web
+
+from azimuth_schedule_operator import cache, debug, metrics
+
+
+def busy_handler():
+    # Keep the thread busy so that the sampler sees this frame
+    deadline = time.monotonic() + 0.2
+    while time.monotonic() < deadline:
+        pass
+
+
+class TestDebug(unittest.IsolatedAsyncioTestCase):
+    async def request(self, query):
+        request = test_utils.make_mocked_request("GET", f"/debug/profile{query}")
+        return await debug.profile_handler(request)
+
+    def test_collapse_stack(self):
+        frame = sys._getframe()
+        stack = debug.collapse_stack(frame)
+        self.assertTrue(
+            stack.endswith(f"{__name__}:TestDebug.test_collapse_stack"), stack
+        )
+        self.assertNotIn("handler:", stack)
+
+    def test_collapse_stack_handler(self):
+        original = debug.HANDLER_MODULE
+        debug.HANDLER_MODULE = __name__
+        try:
+            stack = debug.collapse_stack(sys._getframe())
+        finally:
+            debug.HANDLER_MODULE = original
+        self.assertTrue(stack.startswith("handler:"), stack)
+
+    async def test_profile_text(self):
+        response = await self.request("?seconds=0.1")
+        self.assertEqual(response.status, 200)
+        self.assertIn("function calls", response.text)
+
+    async def test_profile_pstats(self):
+        response = await self.request("?seconds=0.1&format=pstats")
+        self.assertEqual(response.content_type, "application/octet-stream")
+        self.assertIsInstance(marshal.loads(response.body), dict)
+
+    async def test_profile_collapsed(self):
+        task = asyncio.create_task(
+            self.request("?seconds=0.1&format=collapsed&interval=0.001")
+        )
+        # Block the event loop so that the sampler records this frame
+        await asyncio.sleep(0)
+        busy_handler()
+        response = await task
+        self.assertIn(f"{__name__}:busy_handler", response.text)
+        for line in response.text.splitlines():
+            _, count = line.rsplit(" ", 1)
+            self.assertGreater(int(count), 0)
+
+    async def test_profile_invalid(self):
+        for query in [
+            "?seconds=0",
+            "?seconds=1000",
+            "?seconds=abc",
+            "?format=flamegraph",
+            "?sort=nonsense",
+            "?interval=2",
+        ]:
+            with self.subTest(query=query):
+                with self.assertRaises(web.HTTPBadRequest):
+                    await self.request(query)
+
+    async def test_profile_conflict(self):
+        async with debug.PROFILE_LOCK:
+            with self.assertRaises(web.HTTPConflict):
+                await self.request("?seconds=0.1")
+
+    async def test_await_stack(self):
+        event = asyncio.Event()
+
+        async def inner():
+            await event.wait()
+
+        async def outer():
+            await inner()
+
+        task = asyncio.create_task(outer())
+        await asyncio.sleep(0)
+        stack = debug.await_stack(task)
+        event.set()
+        await task
+
+        self.assertRegex(stack[0], r"test_await_stack.<locals>.outer:\d+$")
+        self.assertRegex(stack[1], r"test_await_stack.<locals>.inner:\d+$")
+        self.assertRegex(stack[2], r"^asyncio.locks:Event.wait:\d+$")
+
+    async def test_tasks(self):
+        event = asyncio.Event()
+        values = cache.Cache("test-tasks")
+        values["key"] = "value"
+
+        @metrics.instrument_handler
+        async def handler(**kwargs):
+            await event.wait()
+
+        body = {"kind": "Lease", "metadata": {"namespace": "ns1", "name": "lease1"}}
+        task = asyncio.create_task(handler(body=body), name="handler-task")
+        await asyncio.sleep(0)
+        request = test_utils.make_mocked_request("GET", "/debug/tasks")
+        response = await debug.tasks_handler(request)
+        event.set()
+        await task
+
+        data = json.loads(response.text)
+        (handler_task,) = [t for t in data["tasks"] if t["name"] == "handler-task"]
+        self.assertEqual(handler_task["handler"], "handler")
+        self.assertIn("wrapper", handler_task["stack"][0])
+        (invocation,) = data["handlers"]
+        self.assertEqual(invocation["task"], "handler-task")
+        self.assertEqual(
+            (invocation["kind"], invocation["namespace"], invocation["name"]),
+            ("Lease", "ns1", "lease1"),
+        )
+        self.assertGreaterEqual(invocation["age"], 0)
+        self.assertIn("test-tasks", [c["name"] for c in data["caches"]])
+        self.assertIn("timeline", data["indexes"])
+
+    @mock.patch.object(debug, "MEMORY_SNAPSHOT", None)
+    async def test_memory(self):
+        tracemalloc.start()
+        try:
+            request = test_utils.make_mocked_request("GET", "/debug/memory?limit=5")
+            response = await debug.memory_handler(request)
+            baseline = json.loads(response.text)
+            # Allocate some memory that is retained between the snapshots
+            retained = [bytearray(1024) for _ in range(1000)]
+            response = await debug.memory_handler(request)
+            data = json.loads(response.text)
+        finally:
+            tracemalloc.stop()
+
+        self.assertTrue(baseline["baseline"])
+        self.assertFalse(data["baseline"])
+        self.assertEqual(len(data["statistics"]), 5)
+        # The largest growth should be the retained memory
+        top = data["statistics"][0]
+        self.assertIn(f"{__file__}:", top["traceback"][0])
+        self.assertGreaterEqual(top["sizeDiff"], len(retained) * 1024)
+
+    async def test_memory_not_tracing(self):
+        request = test_utils.make_mocked_request("GET", "/debug/memory")
+        with self.assertRaises(web.HTTPConflict):
+            await debug.memory_handler(request)
+
+    async def test_memory_invalid_key(self):
+        tracemalloc.start()
+        try:
+            request = test_utils.make_mocked_request("GET", "/debug/memory?key=bad")
+            with self.assertRaises(web.HTTPBadRequest):
+                await debug.memory_handler(request)
+        finally:
+            tracemalloc.stop()
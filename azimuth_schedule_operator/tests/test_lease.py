@@ -1,3 +1,4 @@
+import asyncio
 import json
 import unittest
 from unittest import mock
@@ -6,7 +7,13 @@ import freezegun
 import kopf
 from easykube.rest.util import PropertyDict
 
-from azimuth_schedule_operator import openstack, operator
+from azimuth_schedule_operator import (
+    aggregates,
+    capacity,
+    metrics,
+    openstack,
+    operator,
+)
 from azimuth_schedule_operator.models.v1alpha1 import lease as lease_crd
 
 from . import util
@@ -243,6 +250,23 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
 
         cloud.api_client.assert_not_called()
 
+    def test_lease_deadline(self):
+        lease = fake_lease()
+        lease["spec"]["gracePeriod"] = 600
+
+        deadline = operator.lease_deadline(body=lease)
+
+        self.assertEqual(deadline.isoformat(), "2024-08-21T15:50:00+00:00")
+
+    @mock.patch.object(operator, "LEASE_DEFAULT_GRACE_PERIOD_SECONDS", 60)
+    def test_lease_deadline_default_grace_period(self):
+        deadline = operator.lease_deadline(body=fake_lease())
+
+        self.assertEqual(deadline.isoformat(), "2024-08-21T15:59:00+00:00")
+
+    def test_lease_deadline_no_end(self):
+        self.assertIsNone(operator.lease_deadline(body=fake_lease(end=False)))
+
     def test_blazar_enabled_auto_blazar_available(self):
         cloud = util.mock_openstack_cloud()
 
@@ -409,6 +433,70 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(lease.status.size_map, {})
         self.assertEqual(lease.status.size_name_map, {})
 
+    def test_set_phase_records_transitions(self):
+        lease = lease_crd.Lease.model_validate(fake_lease())
+        with freezegun.freeze_time("2024-08-21T14:30:00Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.PENDING)
+        with freezegun.freeze_time("2024-08-21T15:00:00Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.PENDING)
+            lease.status.set_phase(lease_crd.LeasePhase.ACTIVE)
+        with freezegun.freeze_time("2024-08-21T15:30:00Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.PENDING)
+
+        # Only the first time that each phase is entered is recorded
+        self.assertEqual(
+            {
+                phase: entered_at.isoformat()
+                for phase, entered_at in lease.status.phase_transitions.items()
+            },
+            {
+                "Pending": "2024-08-21T14:30:00+00:00",
+                "Active": "2024-08-21T15:00:00+00:00",
+            },
+        )
+
+    @mock.patch.object(metrics, "LEASE_PHASE_LATENCY")
+    def test_observe_phase_transitions(self, lease_phase_latency):
+        lease_data = fake_lease()
+        lease_data["metadata"]["creationTimestamp"] = "2024-08-21T14:00:00Z"
+        lease = lease_crd.Lease.model_validate(lease_data)
+        with freezegun.freeze_time("2024-08-21T14:00:05Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.PENDING)
+        previous = dict(lease.status.phase_transitions)
+        with freezegun.freeze_time("2024-08-21T15:01:00Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.ACTIVE)
+        with freezegun.freeze_time("2024-08-21T16:02:00Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.TERMINATED)
+
+        operator.observe_phase_transitions(lease, previous, True)
+
+        # The pending phase was entered before the previous transitions
+        lease_phase_latency.observe.assert_has_calls(
+            [
+                mock.call(60, lease_namespace="fake-ns", phase="Active", path="blazar"),
+                mock.call(
+                    120, lease_namespace="fake-ns", phase="Terminated", path="blazar"
+                ),
+            ]
+        )
+        self.assertEqual(lease_phase_latency.observe.call_count, 2)
+
+    @mock.patch.object(metrics, "LEASE_PHASE_LATENCY")
+    def test_observe_phase_transitions_deleted_before_end(self, lease_phase_latency):
+        lease_data = fake_lease()
+        lease_data["metadata"]["creationTimestamp"] = "2024-08-21T14:00:00Z"
+        lease = lease_crd.Lease.model_validate(lease_data)
+        with freezegun.freeze_time("2024-08-21T14:30:00Z"):
+            lease.status.set_phase(lease_crd.LeasePhase.PENDING)
+            lease.status.set_phase(lease_crd.LeasePhase.DELETING)
+
+        operator.observe_phase_transitions(lease, {}, False)
+
+        # Deleting a lease before it ends does not count towards the latency
+        lease_phase_latency.observe.assert_called_once_with(
+            1800, lease_namespace="fake-ns", phase="Pending", path="no_blazar"
+        )
+
     def k8s_client_config_common(self, k8s_client):
         k8s_secrets = k8s_client.apis["v1"].resources["secrets"]
         k8s_secrets.fetch.return_value = PropertyDict(fake_credential())
@@ -432,6 +520,20 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
             ]
         )
 
+    @mock.patch.object(capacity, "CAPACITY", new_callable=capacity.CapacityIndex)
+    @mock.patch.object(aggregates, "LEASES", new_callable=aggregates.LeaseAggregates)
+    async def test_lease_event(self, leases, capacity_index):
+        lease_data = fake_lease(phase=lease_crd.LeasePhase.ACTIVE)
+        lease_data["metadata"]["uid"] = "fake-uid"
+
+        await operator.lease_event("ADDED", lease_data)
+        self.assertEqual(set(leases.phase_counts()), {("fake-ns", "Active", 1)})
+        self.assertEqual(capacity_index.size_ids(), ["id1", "id2"])
+
+        await operator.lease_event("DELETED", lease_data)
+        self.assertEqual(len(leases), 0)
+        self.assertEqual(len(capacity_index), 0)
+
     @mock.patch.object(openstack, "from_secret_data")
     @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
     @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
@@ -758,6 +860,11 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
         k8s_client.apis["v1"].resources["ConfigMap"].delete.assert_called_once_with(
             "fake-lease-owner", propagation_policy="Foreground", namespace="fake-ns"
         )
+        # The deletion is recorded in the single write of the status of the lease
+        replace = k8s_client.apis[API_VERSION].resources["leases/status"].replace
+        replace.assert_called_once()
+        _, data = replace.call_args.args
+        self.assertIn("ownersDeleteRequestedAt", data["status"])
 
     def assert_lease_owner_not_deleted(self, k8s_client):
         k8s_client.apis["v1"].resources["ConfigMap"].delete.assert_not_called()
@@ -1239,10 +1346,6 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
         with freezegun.freeze_time("2024-08-21T15:55:00Z"):
             await operator.check_lease(lease_data, mock.Mock())
 
-        k8s_client.apis[API_VERSION].resources[
-            "leases/status"
-        ].replace.assert_not_called()
-
         self.assert_lease_owner_deleted(k8s_client)
 
     @mock.patch.object(openstack, "from_secret_data")
@@ -1262,12 +1365,96 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
         with freezegun.freeze_time("2024-08-21T16:30:00Z"):
             await operator.check_lease(lease_data, mock.Mock())
 
-        k8s_client.apis[API_VERSION].resources[
-            "leases/status"
-        ].replace.assert_not_called()
-
         self.assert_lease_owner_deleted(k8s_client)
 
+    @mock.patch.object(metrics, "DELETION_LATENESS")
+    @mock.patch.object(openstack, "from_secret_data")
+    @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
+    async def test_check_lease_records_deletion_lateness(
+        self, k8s_client, openstack_from_secret_data, deletion_lateness
+    ):
+        self.k8s_client_config_common(k8s_client)
+        os_cloud = openstack_from_secret_data.return_value = util.mock_openstack_cloud()
+        self.os_cloud_config_common(os_cloud)
+
+        configmaps = k8s_client.apis["v1"].resources["ConfigMap"]
+        configmaps.fetch.side_effect = util.k8s_api_error(404)
+
+        lease_data = fake_lease(start=True, end=True)
+        with freezegun.freeze_time("2024-08-21T16:30:00Z"):
+            await operator.check_lease(lease_data, mock.Mock())
+            # The next tick sees that the deletion was requested and that the owner
+            # is gone
+            lease_data["status"] = {"ownersDeleteRequestedAt": "2024-08-21T16:30:00Z"}
+            await operator.check_lease(lease_data, mock.Mock())
+
+        # The lateness is only recorded for the first delete
+        deletion_lateness.observe.assert_called_once_with(2400, kind="lease")
+        configmaps.fetch.assert_awaited_once_with(
+            "fake-lease-owner", namespace="fake-ns"
+        )
+        configmaps.delete.assert_called_once()
+
+    @mock.patch.object(openstack, "from_secret_data")
+    @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
+    async def test_check_lease_owners_delete_requested(
+        self, k8s_client, openstack_from_secret_data
+    ):
+        self.k8s_client_config_common(k8s_client)
+        os_cloud = openstack_from_secret_data.return_value = util.mock_openstack_cloud()
+        self.os_cloud_config_common(os_cloud)
+        configmaps = k8s_client.apis["v1"].resources["ConfigMap"]
+
+        lease_data = fake_lease(start=True, end=True)
+        lease_data["status"] = {"ownersDeleteRequestedAt": "2024-08-21T16:30:00Z"}
+        owner_uid = lease_data["metadata"]["ownerReferences"][0]["uid"]
+        with freezegun.freeze_time("2024-08-21T16:31:00Z"):
+            # The owner is being deleted, so the delete is not issued again
+            configmaps.fetch.return_value = PropertyDict(
+                {"metadata": {"uid": owner_uid, "deletionTimestamp": "now"}}
+            )
+            await operator.check_lease(lease_data, mock.Mock())
+            self.assert_lease_owner_not_deleted(k8s_client)
+
+            # The owner is gone
+            configmaps.fetch.side_effect = util.k8s_api_error(404)
+            await operator.check_lease(lease_data, mock.Mock())
+            self.assert_lease_owner_not_deleted(k8s_client)
+
+            # The delete was lost, so it is issued again
+            configmaps.fetch.side_effect = None
+            configmaps.fetch.return_value = PropertyDict(
+                {"metadata": {"uid": owner_uid}}
+            )
+            await operator.check_lease(lease_data, mock.Mock())
+            configmaps.delete.assert_called_once_with(
+                "fake-lease-owner", propagation_policy="Foreground", namespace="fake-ns"
+            )
+
+    @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
+    async def test_for_each_owner_waits_for_all_calls(self, k8s_client):
+        lease_data = fake_lease()
+        owner = lease_data["metadata"]["ownerReferences"][0]
+        lease_data["metadata"]["ownerReferences"] = [
+            {**owner, "name": f"owner{i}", "uid": f"owner{i}"} for i in range(3)
+        ]
+        lease = lease_crd.Lease.model_validate(lease_data)
+        finished = []
+
+        async def func(resource, owner):
+            if owner.name == "owner0":
+                raise RuntimeError("boom")
+            await asyncio.sleep(0)
+            finished.append(owner.name)
+
+        with self.assertRaises(RuntimeError):
+            await operator.for_each_owner(lease, func)
+
+        # The other calls are not left running after the error
+        self.assertEqual(sorted(finished), ["owner1", "owner2"])
+
     @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
     @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no")
     async def test_delete_lease_finalizer_present(self, k8s_client):
@@ -1413,11 +1600,12 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
             "fake-credential", namespace="fake-ns"
         )
 
+    @mock.patch.object(asyncio, "sleep")
     @mock.patch.object(openstack, "from_secret_data")
     @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
     @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "yes")
     async def test_delete_lease_blazar_lease_exists(
-        self, k8s_client, openstack_from_secret_data
+        self, k8s_client, openstack_from_secret_data, sleep
     ):
         # Configure the Kubernetes client
         self.k8s_client_config_common(k8s_client)
@@ -1427,15 +1615,77 @@ class TestLease(unittest.IsolatedAsyncioTestCase):
         self.os_cloud_config_common(os_cloud)
         os_leases = os_cloud.clients["reservation"].resources["leases"]
         os_leases.list.return_value = util.as_async_iterable([fake_blazar_lease()])
+        # The lease is gone on the second check
+        os_leases.fetch.side_effect = [
+            fake_blazar_lease("DELETING"),
+            util.httpx_status_error(404),
+        ]
 
         lease = fake_lease()
-        # This should raise a temporary error after the lease has been deleted to
-        # force a requeue
-        with self.assertRaises(kopf.TemporaryError):
-            await operator.delete_lease(lease, mock.Mock())
+        await operator.delete_lease(lease, mock.Mock())
 
-        # Assert that the lease was deleted
+        # Assert that the lease was deleted and waited for with a growing delay
         os_leases.delete.assert_called_once_with("blazarleaseid")
+        os_leases.fetch.assert_called_with("blazarleaseid")
+        self.assertEqual([c.args[0] for c in sleep.await_args_list], [1, 2])
+
+        # Assert that the app cred and secret were deleted once the lease was gone
+        os_cloud.clients["identity"].resources[
+            "application_credentials"
+        ].delete.assert_called_once_with("appcredid")
+        os_cloud.forget_session.assert_called_once_with()
+        k8s_client.apis["v1"].resources["secrets"].delete.assert_called_once_with(
+            "fake-credential", namespace="fake-ns"
+        )
+
+    @mock.patch.object(asyncio, "sleep")
+    @mock.patch.object(openstack, "from_secret_data")
+    @mock.patch.object(operator, "K8S_CLIENT", new_callable=util.mock_k8s_client)
+    @mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "yes")
+    async def test_delete_lease_blazar_lease_slow_to_delete(
+        self, k8s_client, openstack_from_secret_data, sleep
+    ):
+        # Configure the Kubernetes client
+        self.k8s_client_config_common(k8s_client)
+
+        # Configure the OpenStack cloud
+        os_cloud = openstack_from_secret_data.return_value = util.mock_openstack_cloud()
+        self.os_cloud_config_common(os_cloud)
+        os_leases = os_cloud.clients["reservation"].resources["leases"]
+        os_leases.list.side_effect = lambda *args, **kwargs: util.as_async_iterable(
+            [fake_blazar_lease("DELETING")]
+        )
+        os_leases.fetch.return_value = fake_blazar_lease("DELETING")
+
+        lease = fake_lease()
+        # This should raise a temporary error if the lease is not deleted in time to
+        # force a requeue, so that the handler does not wait indefinitely
+        with mock.patch.object(operator, "BLAZAR_DELETE_WAIT_SECONDS", 30):
+            with self.assertRaises(kopf.TemporaryError) as ctx:
+                await operator.delete_lease(lease, mock.Mock())
+
+        # Assert that the delete in progress was not repeated
+        os_leases.delete.assert_not_called()
+        os_leases.list.assert_called_once_with()
+        self.assertEqual([c.args[0] for c in sleep.await_args_list], [1, 2, 4, 8, 15])
+        self.assertEqual(ctx.exception.delay, 15)
+
+        # Assert that the ID of the Blazar lease was recorded for the retry
+        k8s_leases_status = k8s_client.apis[API_VERSION].resources["leases/status"]
+        status = k8s_leases_status.replace.call_args.args[1]["status"]
+        self.assertEqual(status["blazarLeaseId"], "blazarleaseid")
+
+        # Assert that the retry fetches the lease directly and checks less often
+        lease["status"] = status
+        sleep.reset_mock()
+        os_leases.list.reset_mock()
+        k8s_leases_status.replace.reset_mock()
+        with mock.patch.object(operator, "BLAZAR_DELETE_WAIT_SECONDS", 30):
+            with self.assertRaises(kopf.TemporaryError):
+                await operator.delete_lease(lease, mock.Mock(), retry=1)
+        os_leases.list.assert_not_called()
+        self.assertEqual([c.args[0] for c in sleep.await_args_list], [15, 15])
+        k8s_leases_status.replace.assert_not_called()
 
         # Assert that the appcred was retained
         os_cloud.clients["identity"].resources[
@@ -0,0 +1,430 @@
+import asyncio
+import tracemalloc
+import unittest
+from unittest import mock
+
+import freezegun
+import httpx
+import kopf
+from aiohttp import test_utils, web
+from easykube.rest.util import PropertyDict
+
+from azimuth_schedule_operator import aggregates, capacity, metrics
+
+from . import util
+
+API_VERSION = "scheduling.azimuth.stackhpc.com/v1alpha1"
+
+# The fields for the leases used in the tests
+LEASE_FIELDS = {
+    "created_at": "2024-08-21T14:00:00Z",
+    "starts_at": "2024-08-21T15:00:00Z",
+    "ends_at": "2024-08-21T16:00:00Z",
+    "machines": [("small", 2)],
+}
+
+
+def fake_schedule(namespace, name):
+    return PropertyDict(
+        {
+            "metadata": {
+                "namespace": namespace,
+                "name": name,
+                "uid": f"{namespace}-{name}",
+            },
+            "spec": {"ref": {"kind": "Cluster", "name": name}},
+            "status": {"refExists": True},
+        }
+    )
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.ekclient = util.mock_k8s_client()
+        ekapi = self.ekclient.apis[API_VERSION]
+        self.ekclient.api_preferred_version.return_value = ekapi
+        objs = {
+            "leases": [
+                PropertyDict(
+                    util.lease_body("lease1", "ns1", phase="Active", **LEASE_FIELDS)
+                ),
+                PropertyDict(
+                    util.lease_body("lease2", "ns1", phase="Active", **LEASE_FIELDS)
+                ),
+                PropertyDict(
+                    util.lease_body("lease3", "ns2", phase="Active", **LEASE_FIELDS)
+                ),
+            ],
+            "schedules": [fake_schedule("ns1", "sched1")],
+        }
+        for resource, resource_objs in objs.items():
+            ekapi.resources[resource].list.side_effect = (
+                lambda namespace=None, all_namespaces=False, objs=resource_objs: (
+                    util.as_async_iterable(
+                        o
+                        for o in objs
+                        if all_namespaces or o.metadata.namespace == namespace
+                    )
+                )
+            )
+
+    async def get_metrics(self, query=""):
+        request = test_utils.make_mocked_request("GET", f"/metrics{query}")
+        response = await metrics.metrics_handler(self.ekclient, request)
+        return response.body.decode().splitlines()
+
+    def samples(self, lines, family):
+        return [line for line in lines if line.startswith(f"{family}{{")]
+
+    async def test_metrics_all(self):
+        lines = await self.get_metrics()
+
+        self.assertEqual(len(self.samples(lines, "azimuth_lease_phase")), 3)
+        self.assertEqual(len(self.samples(lines, "azimuth_schedule_ref_found")), 1)
+        self.assertEqual(lines[-1], "# EOF")
+
+    async def test_metrics_namespace(self):
+        lines = await self.get_metrics("?namespace=ns1")
+
+        self.assertEqual(len(self.samples(lines, "azimuth_lease_phase")), 2)
+        leases = self.ekclient.apis[API_VERSION].resources["leases"]
+        leases.list.assert_called_once_with(namespace="ns1")
+
+    async def test_metrics_family(self):
+        lines = await self.get_metrics("?family=azimuth_lease_ends_at")
+
+        self.assertEqual(len(self.samples(lines, "azimuth_lease_ends_at")), 3)
+        self.assertEqual(self.samples(lines, "azimuth_lease_phase"), [])
+        self.assertNotIn("# TYPE azimuth_schedule_ref_found gauge", lines)
+        # The schedules should not have been listed at all
+        schedules = self.ekclient.apis[API_VERSION].resources["schedules"]
+        schedules.list.assert_not_called()
+
+    async def test_metrics_shard(self):
+        shards = [
+            self.samples(
+                await self.get_metrics(f"?shard={i}/3&family=azimuth_lease_phase"),
+                "azimuth_lease_phase",
+            )
+            for i in range(3)
+        ]
+
+        # Each lease should appear in exactly one shard
+        all_samples = [sample for shard in shards for sample in shard]
+        self.assertEqual(len(all_samples), 3)
+        self.assertEqual(len(set(all_samples)), 3)
+
+    async def test_metrics_shard_invalid(self):
+        for shard in ["1", "a/b", "3/3", "0/0"]:
+            with self.assertRaises(web.HTTPBadRequest):
+                await self.get_metrics(f"?shard={shard}")
+
+    @mock.patch.object(aggregates, "LEASES", new_callable=aggregates.LeaseAggregates)
+    async def test_metrics_aggregates(self, leases):
+        leases.update(
+            PropertyDict(
+                util.lease_body("lease1", "ns1", phase="Active", **LEASE_FIELDS)
+            )
+        )
+        leases.update(
+            PropertyDict(
+                util.lease_body("lease2", "ns1", phase="Active", **LEASE_FIELDS)
+            )
+        )
+        leases.update(
+            PropertyDict(
+                util.lease_body("lease3", "ns2", phase="Pending", **LEASE_FIELDS)
+            )
+        )
+
+        lines = await self.get_metrics("?family=azimuth_lease_phase_count")
+
+        self.assertEqual(
+            self.samples(lines, "azimuth_lease_phase_count"),
+            [
+                'azimuth_lease_phase_count{lease_namespace="ns1",phase="Active"} 2',
+                'azimuth_lease_phase_count{lease_namespace="ns2",phase="Pending"} 1',
+            ],
+        )
+
+    @mock.patch.object(aggregates, "LEASES", new_callable=aggregates.LeaseAggregates)
+    async def test_metrics_aggregates_namespace(self, leases):
+        leases.update(
+            PropertyDict(
+                util.lease_body("lease1", "ns1", phase="Active", **LEASE_FIELDS)
+            )
+        )
+        leases.update(
+            PropertyDict(
+                util.lease_body("lease3", "ns2", phase="Active", **LEASE_FIELDS)
+            )
+        )
+
+        lines = await self.get_metrics("?namespace=ns2")
+
+        self.assertEqual(
+            self.samples(lines, "azimuth_lease_phase_count"),
+            ['azimuth_lease_phase_count{lease_namespace="ns2",phase="Active"} 1'],
+        )
+
+    @mock.patch.object(metrics, "PER_OBJECT_METRICS_ENABLED", False)
+    async def test_metrics_per_object_disabled(self):
+        lines = await self.get_metrics()
+
+        self.assertEqual(self.samples(lines, "azimuth_lease_phase"), [])
+        self.assertIn("# TYPE azimuth_lease_phase_count gauge", lines)
+        leases = self.ekclient.apis[API_VERSION].resources["leases"]
+        leases.list.assert_not_called()
+
+    @mock.patch.object(metrics, "ROLE", "standby")
+    @mock.patch.object(metrics, "OPERATOR_METRICS", [])
+    @mock.patch.object(aggregates, "LEASES", new_callable=aggregates.LeaseAggregates)
+    async def test_metrics_standby(self, leases):
+        leases.update(
+            PropertyDict(
+                util.lease_body("lease1", "ns1", phase="Active", **LEASE_FIELDS)
+            )
+        )
+        metrics.Gauge("leader", "Whether this replica is the leader").set(0)
+
+        lines = await self.get_metrics()
+
+        # Only the leader reports the metrics for the objects
+        self.assertEqual(self.samples(lines, "azimuth_lease_phase"), [])
+        self.assertEqual(self.samples(lines, "azimuth_lease_phase_count"), [])
+        leases = self.ekclient.apis[API_VERSION].resources["leases"]
+        leases.list.assert_not_called()
+        # The operator metrics are labelled with the role of the replica
+        self.assertEqual(
+            self.samples(lines, "azimuth_schedule_operator_leader"),
+            ['azimuth_schedule_operator_leader{role="standby"} 0'],
+        )
+
+    @mock.patch.object(capacity, "CAPACITY", new_callable=capacity.CapacityIndex)
+    async def test_metrics_capacity(self, capacity_index):
+        capacity_index.update(
+            PropertyDict(
+                util.lease_body("lease1", "ns1", phase="Active", **LEASE_FIELDS)
+            )
+        )
+        capacity_index.update(
+            PropertyDict(
+                util.lease_body("lease2", "ns2", phase="Active", **LEASE_FIELDS)
+            )
+        )
+
+        with freezegun.freeze_time("2024-08-21T14:00:00Z"):
+            lines = await self.get_metrics()
+            namespaced_lines = await self.get_metrics("?namespace=ns1")
+            shard_lines = await self.get_metrics("?shard=1/2")
+
+        self.assertEqual(
+            self.samples(lines, "azimuth_capacity_reserved_machines"),
+            ['azimuth_capacity_reserved_machines{size_id="small"} 0'],
+        )
+        self.assertEqual(
+            self.samples(lines, "azimuth_capacity_peak_reserved_machines"),
+            ['azimuth_capacity_peak_reserved_machines{size_id="small"} 4'],
+        )
+        # Metrics that are not namespaced are only in the unfiltered first shard
+        self.assertEqual(
+            self.samples(namespaced_lines, "azimuth_capacity_reserved_machines"), []
+        )
+        self.assertEqual(
+            self.samples(shard_lines, "azimuth_capacity_reserved_machines"), []
+        )
+
+
+class TestOperatorMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Make sure the metrics do not leak into the global list
+        patcher = mock.patch.object(metrics, "OPERATOR_METRICS", [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self, *metrics_):
+        _, content = metrics.render_openmetrics(*metrics_)
+        return content.decode().splitlines()
+
+    def test_counter(self):
+        counter = metrics.Counter("requests", "The number of requests")
+        counter.inc(service="compute")
+        counter.inc(2, service="compute")
+        counter.inc(service="identity")
+
+        self.assertEqual(
+            self.render(counter),
+            [
+                "# HELP azimuth_schedule_operator_requests The number of requests",
+                "# TYPE azimuth_schedule_operator_requests counter",
+                'azimuth_schedule_operator_requests_total{service="compute"} 3',
+                'azimuth_schedule_operator_requests_total{service="identity"} 1',
+                "# EOF",
+            ],
+        )
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("duration", "The duration", buckets=[1, 0.5])
+        histogram.observe(0.25, handler="h")
+        histogram.observe(0.75, handler="h")
+        histogram.observe(5, handler="h")
+
+        self.assertEqual(
+            self.render(histogram)[2:-1],
+            [
+                'azimuth_schedule_operator_duration_bucket{handler="h",le="0.5"} 1',
+                'azimuth_schedule_operator_duration_bucket{handler="h",le="1"} 2',
+                'azimuth_schedule_operator_duration_bucket{handler="h",le="+Inf"} 3',
+                'azimuth_schedule_operator_duration_count{handler="h"} 3',
+                'azimuth_schedule_operator_duration_sum{handler="h"} 6.0',
+            ],
+        )
+
+    @mock.patch.object(metrics, "API_REQUEST_DURATION")
+    @mock.patch.object(metrics, "API_REQUESTS")
+    async def test_instrumented_transport(self, api_requests, api_request_duration):
+        transport = metrics.InstrumentedTransport(
+            httpx.MockTransport(lambda request: httpx.Response(404)),
+            "compute",
+            lambda request: "GET flavors",
+        )
+        async with httpx.AsyncClient(transport=transport) as client:
+            await client.get("http://compute/flavors")
+
+        labels = dict(service="compute", operation="GET flavors", status="404")
+        api_requests.inc.assert_called_once_with(**labels)
+        api_request_duration.observe.assert_called_once_with(mock.ANY, **labels)
+
+    @mock.patch.object(metrics, "API_REQUEST_DURATION")
+    @mock.patch.object(metrics, "API_REQUESTS")
+    async def test_instrumented_transport_errors(
+        self, api_requests, api_request_duration
+    ):
+        def handler(request):
+            if request.url.path == "/flavors":
+                raise httpx.ConnectError("connection refused", request=request)
+            else:
+                raise httpx.ReadTimeout("timed out", request=request)
+
+        transport = metrics.InstrumentedTransport(
+            httpx.MockTransport(handler), "compute", lambda request: request.url.path
+        )
+        async with httpx.AsyncClient(transport=transport) as client:
+            with self.assertRaises(httpx.ConnectError):
+                await client.get("http://compute/flavors")
+            with self.assertRaises(httpx.ReadTimeout):
+                await client.get("http://compute/servers")
+
+        calls = [
+            mock.call(service="compute", operation="/flavors", status="error"),
+            mock.call(service="compute", operation="/servers", status="timeout"),
+        ]
+        api_requests.inc.assert_has_calls(calls)
+        api_request_duration.observe.assert_has_calls(
+            [mock.call(mock.ANY, **c.kwargs) for c in calls]
+        )
+
+    @mock.patch.object(metrics, "HANDLER_DURATION")
+    async def test_instrument_handler(self, handler_duration):
+        @metrics.instrument_handler
+        async def handler(value, fail=None):
+            if fail:
+                raise fail
+            return value
+
+        self.assertEqual(await handler(1), 1)
+        with self.assertRaises(kopf.TemporaryError):
+            await handler(1, fail=kopf.TemporaryError("retry"))
+        with self.assertRaises(ValueError):
+            await handler(1, fail=ValueError)
+
+        handler_duration.observe.assert_has_calls(
+            [
+                mock.call(mock.ANY, handler="handler", status="success"),
+                mock.call(mock.ANY, handler="handler", status="retry"),
+                mock.call(mock.ANY, handler="handler", status="error"),
+            ]
+        )
+
+    @mock.patch.object(metrics, "HANDLERS_IN_FLIGHT")
+    async def test_instrument_handler_in_flight(self, handlers_in_flight):
+        @metrics.instrument_handler
+        async def handler():
+            handlers_in_flight.inc.assert_called_once_with(handler="handler")
+            handlers_in_flight.dec.assert_not_called()
+
+        await handler()
+
+        handlers_in_flight.dec.assert_called_once_with(handler="handler")
+
+    async def test_instrument_handler_invocations(self):
+        @metrics.instrument_handler
+        async def handler(**kwargs):
+            (invocation,) = metrics.HANDLER_INVOCATIONS.values()
+            self.assertEqual(invocation["handler"], "handler")
+            self.assertIs(invocation["task"], asyncio.current_task())
+            self.assertEqual(
+                (invocation["kind"], invocation["namespace"], invocation["name"]),
+                ("Lease", "ns1", "lease1"),
+            )
+
+        body = {"kind": "Lease", "metadata": {"namespace": "ns1", "name": "lease1"}}
+        await handler(body=body)
+
+        self.assertEqual(metrics.HANDLER_INVOCATIONS, {})
+
+    @mock.patch.object(metrics, "TIMER_LAG")
+    async def test_instrument_timer(self, timer_lag):
+        @metrics.instrument_timer(60)
+        async def handler(**kwargs):
+            pass
+
+        memo = {}
+        with mock.patch.object(metrics.time, "monotonic") as monotonic:
+            # The first invocation has nothing to compare to
+            monotonic.return_value = 100
+            await handler(memo=memo)
+            timer_lag.observe.assert_not_called()
+            self.assertEqual(memo["timer_finished_at"], 100)
+            # The second invocation is 5s later than it should have been
+            monotonic.return_value = 165
+            await handler(memo=memo)
+            timer_lag.observe.assert_called_once_with(5, handler="handler")
+        # Handlers called without a memo should still work
+        await handler()
+
+    @mock.patch.object(metrics, "EVENT_LOOP_LAG")
+    async def test_monitor_event_loop(self, event_loop_lag):
+        task = asyncio.create_task(metrics.monitor_event_loop(0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        event_loop_lag.set.assert_called()
+        self.assertGreaterEqual(event_loop_lag.set.call_args.args[0], 0)
+
+    @mock.patch.object(metrics, "read_rss", return_value=1024)
+    @mock.patch.object(metrics, "MEMORY_PYTHON_HEAP")
+    @mock.patch.object(metrics, "MEMORY_RSS")
+    @mock.patch.object(metrics.gc, "get_objects")
+    def test_sample_memory(self, get_objects, rss, python_heap, read_rss):
+        # Use a known set of objects, as the live objects depend on the other tests
+        get_objects.return_value = [{}] * 4 + [[]] * 3 + [()] * 2 + ["a"]
+        objects = metrics.Gauge("objects", "The objects")
+        objects.set(1, type="stale")
+
+        tracemalloc.start()
+        try:
+            with mock.patch.object(metrics, "MEMORY_OBJECTS", objects):
+                metrics.sample_memory(top_types=3)
+        finally:
+            tracemalloc.stop()
+
+        rss.set.assert_called_once_with(1024)
+        python_heap.set.assert_called_once()
+        # The previous types are replaced by the most common types
+        self.assertEqual(
+            {labels["type"]: value for labels, value in objects.records()},
+            {"builtins.dict": 4, "builtins.list": 3, "builtins.tuple": 2},
+        )
@@ -0,0 +1,367 @@
+import asyncio
+import datetime
+import time
+import unittest
+from unittest import mock
+
+import httpx
+import kopf
+
+from azimuth_schedule_operator import metrics, openstack, workqueue
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+from azimuth_schedule_operator.utils import clock
+
+
+class TestOpenStack(unittest.TestCase):
+    def test_request_operation(self):
+        for method, url, expected in [
+            ("POST", "https://keystone/v3/auth/tokens", "POST auth/tokens"),
+            (
+                "DELETE",
+                "https://keystone/v3/users/abc123/application_credentials/def456",
+                "DELETE users/application_credentials",
+            ),
+            ("GET", "https://blazar/v1/leases", "GET leases"),
+            ("GET", "https://nova/v2.1/flavors/detail", "GET flavors/detail"),
+        ]:
+            request = httpx.Request(method, url)
+            self.assertEqual(openstack.request_operation(request), expected)
+
+
+class TestHostLimiter(unittest.IsolatedAsyncioTestCase):
+    async def run_requests(self, limiter, count):
+        in_flight = 0
+        peak = 0
+
+        async def request():
+            nonlocal in_flight, peak
+            async with limiter.limit("host1"):
+                in_flight += 1
+                peak = max(peak, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+
+        await asyncio.gather(*[request() for _ in range(count)])
+        return peak
+
+    @mock.patch.object(metrics, "OPENSTACK_REQUESTS_WAITING")
+    @mock.patch.object(metrics, "OPENSTACK_REQUEST_WAIT")
+    async def test_concurrency(self, request_wait, requests_waiting):
+        peak = await self.run_requests(openstack.HostLimiter(max_concurrency=2), 6)
+
+        self.assertEqual(peak, 2)
+        self.assertEqual(request_wait.observe.call_count, 6)
+        # The later requests had to wait for the earlier ones
+        waits = sorted(c.args[0] for c in request_wait.observe.call_args_list)
+        self.assertGreaterEqual(waits[-1], 0.02)
+        request_wait.observe.assert_called_with(mock.ANY, host="host1")
+        self.assertEqual(requests_waiting.inc.call_count, 6)
+        self.assertEqual(requests_waiting.dec.call_count, 6)
+
+    async def test_rate(self):
+        limiter = openstack.HostLimiter(rate=100, burst=2)
+        started_at = time.monotonic()
+        peak = await self.run_requests(limiter, 6)
+
+        # 2 requests are allowed immediately, then the rest at 100/s
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.04)
+        self.assertGreaterEqual(peak, 2)
+
+    async def test_no_limits(self):
+        peak = await self.run_requests(openstack.HostLimiter(), 10)
+
+        self.assertEqual(peak, 10)
+
+    @mock.patch.object(openstack, "MAX_CONCURRENCY", 3)
+    @mock.patch.dict(openstack.LIMITERS, clear=True)
+    async def test_limited_transport(self):
+        fake = fake_openstack.FakeOpenStack()
+        credential = fake.add_application_credential("user1")
+        cloud = openstack.from_secret_data(
+            fake.secret_data(*credential), transport=httpx.ASGITransport(app=fake)
+        )
+        async with cloud:
+            compute = cloud.api_client("compute")
+            flavors = [f.id async for f in compute.resource("flavors").list()]
+
+        self.assertEqual(flavors, ["id1"])
+        self.assertEqual(list(openstack.LIMITERS), ["openstack.fake"])
+
+
+@mock.patch.object(metrics, "OPENSTACK_CIRCUIT_REJECTED")
+@mock.patch.object(metrics, "OPENSTACK_CIRCUIT_STATE")
+@mock.patch.object(openstack.time, "monotonic", return_value=100)
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_after_failures(self, monotonic, circuit_state, circuit_rejected):
+        breaker = openstack.CircuitBreaker("https://keystone", 3, 60)
+        for _ in range(2):
+            breaker.before_request()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        # A success resets the count
+        breaker.before_request()
+        breaker.record_success()
+        for _ in range(3):
+            breaker.before_request()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        circuit_state.set.assert_called_with(breaker.OPEN, auth_url="https://keystone")
+
+        monotonic.return_value = 130
+        with self.assertRaises(openstack.CircuitOpenError) as ctx:
+            breaker.before_request()
+        self.assertIsInstance(ctx.exception, kopf.TemporaryError)
+        self.assertEqual(ctx.exception.delay, 30)
+        circuit_rejected.inc.assert_called_once_with(auth_url="https://keystone")
+
+    def test_half_open(self, monotonic, circuit_state, circuit_rejected):
+        breaker = openstack.CircuitBreaker("https://keystone", 1, 60)
+        breaker.before_request()
+        breaker.record_failure()
+
+        # After the reset time, only a single probe is allowed
+        monotonic.return_value = 160
+        breaker.before_request()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        with self.assertRaises(openstack.CircuitOpenError):
+            breaker.before_request()
+
+        # If the probe fails, the circuit opens again
+        breaker.record_failure()
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(openstack.CircuitOpenError):
+            breaker.before_request()
+
+        # If the next probe succeeds, the circuit closes
+        monotonic.return_value = 220
+        breaker.before_request()
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.before_request()
+
+
+class TestCircuitBreakerTransport(unittest.IsolatedAsyncioTestCase):
+    @mock.patch.object(openstack, "RETRY_ATTEMPTS", 0)
+    @mock.patch.object(openstack, "CIRCUIT_FAILURE_THRESHOLD", 2)
+    @mock.patch.dict(openstack.BREAKERS, clear=True)
+    async def test_transport(self):
+        fake = fake_openstack.FakeOpenStack(error_rates={"POST identity/tokens": 1})
+        credential = fake.add_application_credential("user1")
+
+        for _ in range(2):
+            cloud = openstack.from_secret_data(
+                fake.secret_data(*credential), transport=httpx.ASGITransport(app=fake)
+            )
+            with self.assertRaises(httpx.HTTPStatusError):
+                async with cloud:
+                    pass
+        cloud = openstack.from_secret_data(
+            fake.secret_data(*credential), transport=httpx.ASGITransport(app=fake)
+        )
+        with self.assertRaises(openstack.CircuitOpenError):
+            async with cloud:
+                pass
+
+        # The open circuit means the cloud is not contacted
+        self.assertEqual(fake.calls["POST identity/tokens"], 2)
+        breaker = openstack.BREAKERS[f"{fake_openstack.BASE_URL}/identity"]
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+
+class TestSessions(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.fake = fake_openstack.FakeOpenStack()
+        self.credential = self.fake.add_application_credential("user1")
+        self.addCleanup(openstack.SESSIONS.clear)
+
+    def cloud(self):
+        return openstack.from_secret_data(
+            self.fake.secret_data(*self.credential),
+            transport=httpx.ASGITransport(app=self.fake),
+        )
+
+    async def list_flavors(self, cloud):
+        compute = cloud.api_client("compute")
+        return [f.name async for f in compute.resource("flavors").list()]
+
+    async def test_saved_session(self):
+        async with self.cloud() as cloud:
+            cloud.save_session()
+        self.fake.calls.clear()
+
+        async with self.cloud() as cloud:
+            self.assertTrue(cloud.is_authenticated)
+            self.assertEqual(cloud.current_user_id, "user1")
+            self.assertEqual(await self.list_flavors(cloud), ["flavor1"])
+
+        # The token and catalog from the saved session are used
+        self.assertEqual(dict(self.fake.calls), {"GET compute/flavors": 1})
+
+    async def test_revoked_session(self):
+        async with self.cloud() as cloud:
+            cloud.save_session()
+        self.fake.tokens.clear()
+        self.fake.calls.clear()
+
+        async with self.cloud() as cloud:
+            self.assertEqual(await self.list_flavors(cloud), ["flavor1"])
+
+        # The request is retried with a new token, and the session is forgotten
+        self.assertEqual(self.fake.calls["GET compute/flavors"], 2)
+        self.assertEqual(self.fake.calls["POST identity/tokens"], 1)
+        self.assertEqual(len(openstack.SESSIONS), 0)
+
+    async def test_expiring_session(self):
+        virtual_clock = clock.VirtualClock(datetime.datetime.now(datetime.timezone.utc))
+        with mock.patch.object(clock, "CLOCK", virtual_clock):
+            async with self.cloud() as cloud:
+                cloud.save_session()
+            self.fake.calls.clear()
+
+            # Sessions are not used when the token is about to expire
+            virtual_clock.advance(datetime.timedelta(minutes=58))
+            async with self.cloud():
+                pass
+
+        self.assertEqual(self.fake.calls["POST identity/tokens"], 1)
+        # The expiring session is not kept
+        self.assertEqual(len(openstack.SESSIONS), 0)
+
+    async def test_forget_session(self):
+        async with self.cloud() as cloud:
+            cloud.save_session()
+            self.assertEqual(len(openstack.SESSIONS), 1)
+            cloud.forget_session()
+
+        self.assertEqual(len(openstack.SESSIONS), 0)
+
+
+class TestRetries(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Map of method -> list of statuses to return, with None for a connect error
+        self.outcomes = {}
+        self.requests = []
+        self.sleep = mock.AsyncMock()
+        patcher = mock.patch.object(openstack.asyncio, "sleep", self.sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(openstack.BREAKERS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self, request):
+        self.requests.append(request.method)
+        outcomes = self.outcomes.get(request.method, [])
+        outcome = outcomes.pop(0) if outcomes else (200, {})
+        if outcome is None:
+            raise httpx.ConnectError("connection refused", request=request)
+        status, headers = outcome
+        return httpx.Response(status, headers=headers, json={"thing": {"id": "1"}})
+
+    def client(self):
+        return openstack.Client(
+            base_url="http://openstack.test/v1",
+            transport=httpx.MockTransport(self.handle),
+        )
+
+    async def test_retries_idempotent_requests(self):
+        self.outcomes["GET"] = [None, (503, {}), (200, {})]
+        self.outcomes["DELETE"] = [(502, {})]
+
+        client = self.client()
+        thing = await client.resource("things").fetch("1")
+        await client.resource("things").delete("1")
+
+        self.assertEqual(thing.id, "1")
+        self.assertEqual(self.requests, ["GET", "GET", "GET", "DELETE", "DELETE"])
+        self.assertEqual(self.sleep.await_count, 3)
+
+    async def test_does_not_retry_other_requests(self):
+        self.outcomes["POST"] = [(503, {})]
+        self.outcomes["GET"] = [(404, {})]
+
+        client = self.client()
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.resource("things").create({"name": "thing1"})
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.resource("things").fetch("1")
+
+        self.assertEqual(self.requests, ["POST", "GET"])
+        self.sleep.assert_not_awaited()
+
+    @mock.patch.object(openstack, "RETRY_ATTEMPTS", 2)
+    async def test_gives_up(self):
+        self.outcomes["GET"] = [(503, {})] * 3
+
+        with self.assertRaises(httpx.HTTPStatusError) as ctx:
+            await self.client().resource("things").fetch("1")
+
+        self.assertEqual(ctx.exception.response.status_code, 503)
+        self.assertEqual(self.requests, ["GET"] * 3)
+
+    @mock.patch.object(openstack, "RETRY_ATTEMPTS", 2)
+    async def test_one_breaker_outcome_per_request(self):
+        self.outcomes["GET"] = [(503, {})] * 3 + [None, (200, {})]
+
+        breaker = openstack.CircuitBreaker("http://openstack.test", 2, 60)
+        client = openstack.Client(
+            base_url="http://openstack.test/v1",
+            transport=openstack.CircuitBreakerTransport(
+                httpx.MockTransport(self.handle), breaker
+            ),
+        )
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.resource("things").fetch("1")
+        # Only the final attempt of a request that gives up counts as a failure
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertEqual(breaker._failures, 1)
+
+        # A request that succeeds after a retry counts as a success
+        await client.resource("things").fetch("1")
+        self.assertEqual(breaker._failures, 0)
+
+    async def test_releases_work_queue_slot(self):
+        queue = workqueue.DeadlineQueue(concurrency=1, max_wait=60)
+        self.outcomes["GET"] = [(503, {})]
+        order = []
+
+        async def sleep(delay):
+            # Other work can run while the request waits to retry
+            async with queue.slot():
+                order.append("other")
+
+        self.sleep.side_effect = sleep
+        async with queue.slot():
+            await self.client().resource("things").fetch("1")
+            order.append("request")
+
+        self.assertEqual(order, ["other", "request"])
+        self.assertEqual(queue._running, 0)
+
+    @mock.patch.object(openstack, "RETRY_BACKOFF_MAX", 30)
+    async def test_retry_after(self):
+        self.outcomes["GET"] = [
+            (429, {"Retry-After": "7"}),
+            (429, {"Retry-After": "60"}),
+        ]
+
+        await self.client().resource("things").fetch("1")
+
+        self.assertEqual([c.args[0] for c in self.sleep.await_args_list], [7, 30])
+
+    @mock.patch.object(openstack, "RETRY_BACKOFF_BASE", 1)
+    @mock.patch.object(openstack, "RETRY_BACKOFF_MAX", 5)
+    def test_retry_delay(self):
+        with mock.patch.object(openstack.random, "uniform", side_effect=max):
+            delays = [openstack.retry_delay(attempt) for attempt in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        response = httpx.Response(
+            503, headers={"Retry-After": "Mon, 01 Jan 2024 00:00:03 GMT"}
+        )
+        with mock.patch.object(openstack.clock, "now", return_value=now):
+            self.assertEqual(openstack.retry_delay(0, response), 3)
+        response = httpx.Response(503, headers={"Retry-After": "soon"})
+        with mock.patch.object(openstack.random, "uniform", side_effect=max):
+            self.assertEqual(openstack.retry_delay(0, response), 1)
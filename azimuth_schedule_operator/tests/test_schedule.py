@@ -2,8 +2,9 @@ import datetime
 import unittest
 from unittest import mock
 
-from azimuth_schedule_operator import operator
+from azimuth_schedule_operator import metrics, operator
 from azimuth_schedule_operator.models.v1alpha1 import schedule as schedule_crd
+from azimuth_schedule_operator.utils import clock
 
 
 class TestSchedule(unittest.IsolatedAsyncioTestCase):
@@ -27,6 +28,8 @@ class TestSchedule(unittest.IsolatedAsyncioTestCase):
             },
         }
 
+    @mock.patch.object(operator, "CRDS_APPLIED", False)
+    @mock.patch.object(operator, "K8S_CLIENT", None)
     @mock.patch("azimuth_schedule_operator.utils.k8s.get_k8s_client")
     async def test_startup_register_crds(self, mock_get):
         mock_client = mock.AsyncMock()
@@ -85,14 +88,32 @@ class TestSchedule(unittest.IsolatedAsyncioTestCase):
         mock_check_for_delete.assert_not_called()
         mock_update_schedule.assert_not_called()
 
+    def test_schedule_deadline(self):
+        body = schedule_crd.get_fake_dict()
+        body["spec"]["notAfter"] = "2024-08-21T16:00:00Z"
+
+        deadline = operator.schedule_deadline(body=body)
+
+        self.assertEqual(deadline, schedule_crd.Schedule(**body).spec.not_after)
+
+        body["status"] = {"refExists": True, "refDeleteTriggered": True}
+        self.assertIsNone(operator.schedule_deadline(body=body))
+
+    @mock.patch.object(metrics, "DELETION_LATENESS")
     @mock.patch.object(operator, "update_schedule")
     @mock.patch.object(operator, "delete_reference")
-    async def test_check_for_delete(self, mock_delete_reference, mock_update_schedule):
+    async def test_check_for_delete(
+        self, mock_delete_reference, mock_update_schedule, mock_deletion_lateness
+    ):
         namespace = "ns1"
         schedule = schedule_crd.get_fake()
 
         await operator.check_for_delete(namespace, schedule)
 
+        mock_deletion_lateness.observe.assert_called_once_with(
+            mock.ANY, kind="schedule"
+        )
+
         mock_delete_reference.assert_awaited_once_with(namespace, schedule.spec.ref)
         mock_update_schedule.assert_awaited_once_with(
             namespace, schedule.metadata.name, ref_delete_triggered=True
@@ -113,6 +134,25 @@ class TestSchedule(unittest.IsolatedAsyncioTestCase):
         mock_delete_reference.assert_not_called()
         mock_update_schedule.assert_not_called()
 
+    @mock.patch.object(operator, "update_schedule")
+    @mock.patch.object(operator, "delete_reference")
+    async def test_check_for_delete_virtual_clock(
+        self, mock_delete_reference, mock_update_schedule
+    ):
+        namespace = "ns1"
+        schedule = schedule_crd.get_fake()
+        virtual = clock.VirtualClock(schedule.spec.not_after)
+        virtual.advance(datetime.timedelta(days=-1))
+
+        with mock.patch.object(clock, "CLOCK", virtual):
+            await operator.check_for_delete(namespace, schedule)
+            mock_delete_reference.assert_not_called()
+
+            virtual.advance(datetime.timedelta(days=1))
+            await operator.check_for_delete(namespace, schedule)
+
+        mock_delete_reference.assert_awaited_once_with(namespace, schedule.spec.ref)
+
     @mock.patch.object(operator, "update_schedule_status")
     async def test_update_schedule(self, mock_update_schedule_status):
         name = "schedule1"
@@ -0,0 +1,285 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from azimuth_schedule_operator import (
+    aggregates,
+    capacity,
+    metrics,
+    sharding,
+    timeline,
+)
+from azimuth_schedule_operator.tests import util
+from azimuth_schedule_operator.tests.fakes import kubernetes as fake_kubernetes
+from azimuth_schedule_operator.utils import clock
+
+NAMESPACES = [f"ns{i}" for i in range(50)]
+
+
+class TestHashRing(unittest.TestCase):
+    def test_owner(self):
+        ring = sharding.HashRing(["a", "b", "c"])
+        keys = [f"key{i}" for i in range(3000)]
+
+        owners = [ring.owner(key) for key in keys]
+
+        # The keys are spread between the members
+        for member in ["a", "b", "c"]:
+            self.assertGreater(owners.count(member), 500)
+        # The assignment is deterministic
+        self.assertEqual(
+            owners, [sharding.HashRing(["c", "b", "a"]).owner(k) for k in keys]
+        )
+
+    def test_owner_moves_minimal_keys(self):
+        keys = [f"key{i}" for i in range(3000)]
+        before = sharding.HashRing(["a", "b", "c"])
+        after = sharding.HashRing(["a", "b", "c", "d"])
+
+        moved = [k for k in keys if before.owner(k) != after.owner(k)]
+
+        # Only the keys taken by the new member move
+        self.assertTrue(all(after.owner(k) == "d" for k in moved))
+        self.assertLess(len(moved), len(keys) / 2)
+
+    def test_no_members(self):
+        self.assertIsNone(sharding.HashRing([]).owner("key"))
+
+
+class TestCoordinator(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clock = clock.VirtualClock(
+            datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        )
+        patcher = mock.patch.object(clock, "CLOCK", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(sharding, "CONTINUING_NAMESPACES", frozenset())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake = fake_kubernetes.FakeKubernetes(
+            resources=[
+                ("v1", "namespaces", "Namespace"),
+                ("coordination.k8s.io/v1", "leases", "Lease"),
+            ]
+        )
+        for name in NAMESPACES:
+            self.fake.add(
+                {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": name}}
+            )
+        self.client = self.fake.client()
+        self.addAsyncCleanup(self.client.aclose)
+        # Map of identity -> list of the namespaces that each operator run was for
+        self.runs = {}
+
+    def coordinator(self, identity):
+        self.runs[identity] = []
+
+        async def operator(namespaces, stop_flag):
+            self.runs[identity].append(namespaces)
+            await stop_flag.wait()
+
+        coordinator = sharding.Coordinator(
+            self.client,
+            operator,
+            identity=identity,
+            group="test",
+            namespace="system",
+            lease_duration=30,
+        )
+        self.addAsyncCleanup(coordinator._stop)
+        return coordinator
+
+    def assert_disjoint(self, *coordinators):
+        handled = [ns for c in coordinators for ns in c.running]
+        self.assertEqual(len(handled), len(set(handled)))
+
+    async def test_single_replica(self):
+        coordinator = self.coordinator("a")
+
+        await coordinator.step()
+        await asyncio.sleep(0)
+
+        self.assertEqual(coordinator.running, set(NAMESPACES))
+        self.assertEqual(self.runs["a"], [sorted(NAMESPACES)])
+        lease = self.fake.get("coordination.k8s.io/v1", "leases", "system", "test-a")
+        self.assertEqual(lease["spec"]["holderIdentity"], "a")
+        self.assertEqual(
+            lease["metadata"]["annotations"][sharding.VIEW_ANNOTATION],
+            sharding.view_name(["a"]),
+        )
+
+    async def test_rebalance(self):
+        a = self.coordinator("a")
+        b = self.coordinator("b")
+        await a.step()
+
+        # b waits for a to hand off its namespaces before starting
+        await b.step()
+        self.assertEqual(b.running, set())
+        self.assert_disjoint(a, b)
+
+        # a hands off the namespaces it no longer owns, then starts on the rest
+        await a.step()
+        self.assertTrue(0 < len(a.running) < len(NAMESPACES))
+        self.assert_disjoint(a, b)
+
+        await b.step()
+        self.assert_disjoint(a, b)
+        self.assertEqual(a.running | b.running, set(NAMESPACES))
+
+        # Once balanced, further steps do not restart the operators
+        await a.step()
+        await b.step()
+        await asyncio.sleep(0)
+        self.assertEqual(len(self.runs["a"]), 2)
+        self.assertEqual(len(self.runs["b"]), 1)
+
+    async def test_rebalance_forgets_namespaces(self):
+        for patcher in [
+            mock.patch.object(aggregates, "LEASES", aggregates.LeaseAggregates()),
+            mock.patch.object(aggregates, "SCHEDULES", aggregates.ScheduleAggregates()),
+            mock.patch.object(capacity, "CAPACITY", capacity.CapacityIndex()),
+            mock.patch.object(timeline, "TIMELINE", timeline.LeaseTimeline()),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        a = self.coordinator("a")
+        b = self.coordinator("b")
+        await a.step()
+        # The operator for a indexes the objects in all the namespaces
+        for namespace in NAMESPACES:
+            lease = util.lease_body(
+                namespace=namespace,
+                starts_at="2023-12-31T00:00:00Z",
+                machines=[("small", 1)],
+            )
+            for index in [aggregates.LEASES, capacity.CAPACITY, timeline.TIMELINE]:
+                index.update(lease)
+            aggregates.SCHEDULES.update(
+                {"metadata": {"uid": f"{namespace}-schedule1", "namespace": namespace}}
+            )
+
+        await b.step()
+        await a.step()
+
+        # The namespaces that were handed off to b are no longer reported by a
+        self.assertTrue(0 < len(a.running) < len(NAMESPACES))
+        self.assertEqual(
+            {
+                labels["lease_namespace"]
+                for labels, _ in metrics.LeasePhaseCount().records()
+            },
+            a.running,
+        )
+        self.assertEqual(
+            {
+                labels["schedule_namespace"]
+                for labels, _ in metrics.ScheduleDeletePendingCount().records()
+            },
+            a.running,
+        )
+        self.assertEqual(
+            list(metrics.ReservedMachines().records()),
+            [({"size_id": "small"}, len(a.running))],
+        )
+        self.assertEqual(len(timeline.TIMELINE), len(a.running))
+
+    async def test_resume_skipped_for_continuing_namespaces(self):
+        a = self.coordinator("a")
+        await a.step()
+        self.assertTrue(sharding.needs_resume(namespace="ns0"))
+
+        self.add_namespace("new1")
+        await a.step()
+        self.clock.advance(datetime.timedelta(seconds=61))
+        await a.step()
+        await asyncio.sleep(0)
+
+        # Only the objects in the new namespace are resumed after the restart
+        self.assertEqual(len(self.runs["a"]), 2)
+        self.assertFalse(sharding.needs_resume(namespace="ns0"))
+        self.assertTrue(sharding.needs_resume(namespace="new1"))
+
+    async def test_member_leaves(self):
+        a = self.coordinator("a")
+        b = self.coordinator("b")
+        for coordinator in [a, b, a, b]:
+            await coordinator.step()
+
+        # b stops renewing its lease, so a takes over once it expires
+        self.clock.advance(datetime.timedelta(seconds=31))
+        await a.step()
+
+        self.assertEqual(a.running, set(NAMESPACES))
+
+    def add_namespace(self, name):
+        self.fake.add(
+            {"apiVersion": "v1", "kind": "Namespace", "metadata": {"name": name}}
+        )
+
+    async def test_new_namespaces(self):
+        a = self.coordinator("a")
+        await a.step()
+
+        # New namespaces are collected before the operator is restarted
+        self.add_namespace("new1")
+        await a.step()
+        self.assertNotIn("new1", a.running)
+        self.clock.advance(datetime.timedelta(seconds=30))
+        self.add_namespace("new2")
+        await a.step()
+        self.assertNotIn("new1", a.running)
+
+        self.clock.advance(datetime.timedelta(seconds=30))
+        await a.step()
+        await asyncio.sleep(0)
+
+        self.assertLessEqual({"new1", "new2"}, a.running)
+        self.assertEqual(len(self.runs["a"]), 2)
+
+    async def test_removed_namespace(self):
+        a = self.coordinator("a")
+        await a.step()
+
+        self.fake.objects.pop(("v1", "namespaces", None, "ns0"))
+        await a.step()
+        await asyncio.sleep(0)
+
+        # Removed namespaces are handed off straight away
+        self.assertEqual(a.running, set(NAMESPACES) - {"ns0"})
+        self.assertEqual(len(self.runs["a"]), 2)
+
+    async def test_fences_when_renew_fails(self):
+        a = self.coordinator("a")
+        await a.step()
+
+        with mock.patch.object(a, "renew", side_effect=RuntimeError("boom")):
+            # The lease is still valid for a while, so the namespaces are kept
+            self.clock.advance(datetime.timedelta(seconds=10))
+            await a.step()
+            self.assertEqual(a.running, set(NAMESPACES))
+
+            # Handling stops before the lease expires
+            self.clock.advance(datetime.timedelta(seconds=10))
+            await a.step()
+            self.assertEqual(a.running, set())
+
+    async def test_run_leaves_group(self):
+        async def operator(namespaces, stop_flag):
+            return "stopped"
+
+        coordinator = sharding.Coordinator(
+            self.client, operator, identity="a", group="test", namespace="system"
+        )
+
+        # Let the operator run between the steps, without waiting for the interval
+        sleep = asyncio.sleep
+        with mock.patch.object(sharding.asyncio, "sleep", lambda _: sleep(0)):
+            result = await coordinator.run()
+
+        self.assertEqual(result, "stopped")
+        self.assertIsNone(
+            self.fake.get("coordination.k8s.io/v1", "leases", "system", "test-a")
+        )
@@ -0,0 +1,349 @@
+import asyncio
+import base64
+import datetime
+import unittest
+from unittest import mock
+
+import httpx
+
+from azimuth_schedule_operator import (
+    aggregates,
+    capacity,
+    metrics,
+    openstack,
+    operator,
+    standby,
+    timeline,
+    workers,
+)
+from azimuth_schedule_operator.models import registry
+from azimuth_schedule_operator.tests import util
+from azimuth_schedule_operator.tests.fakes import kubernetes as fake_kubernetes
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+from azimuth_schedule_operator.utils import clock
+
+NOW = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+NAMESPACE = "ns1"
+SECRET_NAME = "cloud-credentials"
+
+
+class TestStandby(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.clock = clock.VirtualClock(NOW)
+        self.k8s_fake = fake_kubernetes.FakeKubernetes(
+            resources=[
+                *fake_kubernetes.DEFAULT_RESOURCES,
+                ("coordination.k8s.io/v1", "leases", "Lease"),
+            ]
+        )
+        self.cloud_fake = fake_openstack.FakeOpenStack()
+        credential = self.cloud_fake.add_application_credential()
+        self.add(
+            "v1", "Secret", SECRET_NAME, data=self.cloud_fake.secret_data(*credential)
+        )
+        self.k8s_client = self.k8s_fake.client()
+        self.addAsyncCleanup(self.k8s_client.aclose)
+        from_secret_data = openstack.from_secret_data
+
+        def fake_from_secret_data(secret_data):
+            transport = httpx.ASGITransport(app=self.cloud_fake)
+            return from_secret_data(secret_data, transport=transport)
+
+        for patcher in [
+            mock.patch.object(clock, "CLOCK", self.clock),
+            mock.patch.object(operator, "K8S_CLIENT", self.k8s_client),
+            mock.patch.object(operator, "CRDS_APPLIED", True),
+            mock.patch.object(openstack, "from_secret_data", fake_from_secret_data),
+            mock.patch.object(aggregates, "LEASES", aggregates.LeaseAggregates()),
+            mock.patch.object(aggregates, "SCHEDULES", aggregates.ScheduleAggregates()),
+            mock.patch.object(capacity, "CAPACITY", capacity.CapacityIndex()),
+            mock.patch.object(timeline, "TIMELINE", timeline.LeaseTimeline()),
+            mock.patch.object(metrics, "ROLE", None),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for values in [operator.CREDENTIALS, operator.FLAVOR_NAMES, openstack.SESSIONS]:
+            self.addCleanup(values.clear)
+        # Map of identity -> number of times that the operator was started
+        self.runs = {}
+
+    def add(self, api_version, kind, name, **fields):
+        return self.k8s_fake.add(
+            {
+                "apiVersion": api_version,
+                "kind": kind,
+                "metadata": {"name": name, "namespace": NAMESPACE},
+                **fields,
+            }
+        )
+
+    def add_lease(self, name, ends_at, owner=None, secret_name=SECRET_NAME):
+        lease = self.add(
+            registry.API_VERSION,
+            "Lease",
+            name,
+            spec={
+                "cloudCredentialsSecretName": secret_name,
+                "startsAt": util.isoformat(NOW - datetime.timedelta(days=1)),
+                "endsAt": util.isoformat(ends_at),
+                "gracePeriod": 0,
+                "resources": {"machines": [{"sizeId": "id1", "count": 1}]},
+            },
+            status={"phase": "Active"},
+        )
+        if owner:
+            lease["metadata"]["ownerReferences"] = [
+                {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "name": owner["metadata"]["name"],
+                    "uid": owner["metadata"]["uid"],
+                },
+            ]
+        return lease
+
+    def add_schedule(self, name, not_after, ref):
+        return self.add(
+            registry.API_VERSION,
+            "Schedule",
+            name,
+            spec={
+                "ref": {"apiVersion": "v1", "kind": "ConfigMap", "name": ref},
+                "notAfter": util.isoformat(not_after),
+            },
+            status={"refExists": True},
+        )
+
+    def get_lease(self):
+        return self.k8s_fake.get(
+            "coordination.k8s.io/v1", "leases", "system", "operator"
+        )
+
+    def standby(self, identity):
+        self.runs[identity] = 0
+
+        async def run_operator(stop_flag):
+            self.runs[identity] += 1
+            await stop_flag.wait()
+
+        replica = standby.Standby(
+            self.k8s_client,
+            run_operator,
+            identity=identity,
+            name="operator",
+            namespace="system",
+            lease_duration=15,
+        )
+        self.addAsyncCleanup(replica._stop)
+        return replica
+
+    async def test_first_replica_leads(self):
+        a = self.standby("a")
+
+        await a.step()
+        await asyncio.sleep(0)
+
+        self.assertTrue(a.is_leader)
+        self.assertEqual(self.runs["a"], 1)
+        self.assertEqual(self.get_lease()["spec"]["holderIdentity"], "a")
+
+    async def test_standby_warms_caches(self):
+        self.add_lease("lease1", NOW + datetime.timedelta(days=1))
+        a = self.standby("a")
+        b = self.standby("b")
+        await a.step()
+
+        await b.step()
+
+        self.assertFalse(b.is_leader)
+        self.assertEqual(self.runs["b"], 0)
+        self.assertEqual(len(b.leases), 1)
+        self.assertEqual(len(aggregates.LEASES), 1)
+        self.assertEqual(len(operator.CREDENTIALS), 1)
+        self.assertEqual(len(operator.FLAVOR_NAMES), 1)
+        self.assertEqual(len(openstack.SESSIONS), 1)
+
+        # The handlers use the warm caches instead of the APIs
+        self.k8s_fake.calls.clear()
+        self.cloud_fake.calls.clear()
+        body = next(iter(b.leases.values()))
+        with mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", "no"):
+            await operator.check_lease(body=body, logger=standby.LOG, memo={})
+        self.assertNotIn("GET secrets", self.k8s_fake.calls)
+        self.assertEqual(dict(self.cloud_fake.calls), {})
+
+    async def wait_for(self, condition):
+        # Let the watches process the events that are waiting for them
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0)
+        self.fail("condition not met")
+
+    async def test_standby_watches(self):
+        self.add_lease("lease1", NOW + datetime.timedelta(days=1))
+        a = self.standby("a")
+        b = self.standby("b")
+        await a.step()
+        await b.step()
+
+        # Changes are seen by the watches
+        self.add_lease("lease2", NOW + datetime.timedelta(days=1))
+        await self.wait_for(lambda: len(b.leases) == 2)
+        self.assertEqual(len(aggregates.LEASES), 2)
+        leases = await self.k8s_client.api(registry.API_VERSION).resource("leases")
+        await leases.delete("lease1", namespace=NAMESPACE)
+        await self.wait_for(lambda: len(b.leases) == 1)
+        self.assertEqual(len(aggregates.LEASES), 1)
+        # Only the secrets with cloud credentials are used
+        self.add(
+            "v1", "Secret", "other", data={"key": base64.b64encode(b"value").decode()}
+        )
+        self.add_lease("lease3", NOW + datetime.timedelta(days=1), secret_name="other")
+        self.add_lease(
+            "lease4", NOW + datetime.timedelta(days=1), secret_name="missing"
+        )
+        await self.wait_for(lambda: len(b.leases) == 3)
+        operator.CREDENTIALS.clear()
+        self.k8s_fake.calls.clear()
+        self.cloud_fake.calls.clear()
+
+        # Later refreshes only use the watched state and the saved sessions
+        self.clock.advance(datetime.timedelta(seconds=standby.REFRESH_INTERVAL_SECONDS))
+        await a.step()
+        await b.step()
+        self.assertIn((NAMESPACE, SECRET_NAME), operator.CREDENTIALS)
+        self.assertNotIn((NAMESPACE, "other"), operator.CREDENTIALS)
+        self.assertNotIn((NAMESPACE, "missing"), operator.CREDENTIALS)
+        # Other than the watches, the only requests are for the leader lease and the
+        # secrets that are referenced by the leases
+        self.assertEqual(
+            {
+                call: count
+                for call, count in self.k8s_fake.calls.items()
+                if not call.startswith("WATCH ")
+            },
+            {"GET leases": 2, "GET secrets": 3, "PUT leases": 1},
+        )
+        self.assertEqual(dict(self.cloud_fake.calls), {})
+
+        # The flavors are fetched again at a longer interval
+        self.clock.advance(
+            datetime.timedelta(seconds=standby.FLAVOR_REFRESH_INTERVAL_SECONDS)
+        )
+        await a.step()
+        await b.step()
+        self.assertEqual(dict(self.cloud_fake.calls), {"GET compute/flavors": 1})
+
+    async def test_standby_warms_workers(self):
+        self.add_lease("lease1", NOW + datetime.timedelta(days=1))
+        self.add_lease("lease2", NOW + datetime.timedelta(days=1))
+        pool = mock.Mock()
+        pool.worker_for.side_effect = lambda uid: 0
+        pool.call = mock.AsyncMock()
+        a = self.standby("a")
+        b = self.standby("b")
+        await a.step()
+
+        with mock.patch.object(workers, "POOL", pool):
+            await b.step()
+
+        # The caches are warmed once for each credential in each worker
+        secret = self.k8s_fake.get("v1", "secrets", NAMESPACE, SECRET_NAME)
+        pool.call.assert_awaited_once_with(
+            mock.ANY,
+            "warm_credentials",
+            namespace=NAMESPACE,
+            name=SECRET_NAME,
+            secret_data=secret["data"],
+            refresh_flavors=True,
+        )
+        self.assertEqual(len(operator.CREDENTIALS), 0)
+
+    async def test_takeover(self):
+        lease_owner = self.add("v1", "ConfigMap", "platform1")
+        self.add_lease("lease1", NOW + datetime.timedelta(seconds=10), lease_owner)
+        self.add("v1", "ConfigMap", "platform2")
+        self.add_schedule(
+            "schedule1", NOW + datetime.timedelta(seconds=10), "platform2"
+        )
+        self.add("v1", "ConfigMap", "platform3")
+        self.add_schedule("schedule2", NOW + datetime.timedelta(days=1), "platform3")
+        a = self.standby("a")
+        b = self.standby("b")
+        await a.step()
+        await b.step()
+
+        # a stops renewing the lease, so b takes over once it expires
+        self.clock.advance(datetime.timedelta(seconds=16))
+        await b.step()
+        await asyncio.sleep(0)
+
+        self.assertTrue(b.is_leader)
+        self.assertEqual(self.runs["b"], 1)
+        self.assertEqual(self.get_lease()["spec"]["holderIdentity"], "b")
+        self.assertEqual(self.get_lease()["spec"]["leaseTransitions"], 1)
+        self.assertEqual(metrics.ROLE, "leader")
+        # The deletions that were due are issued before the operator starts
+        self.assertIsNone(self.k8s_fake.get("v1", "configmaps", NAMESPACE, "platform1"))
+        self.assertIsNone(self.k8s_fake.get("v1", "configmaps", NAMESPACE, "platform2"))
+        self.assertIsNotNone(
+            self.k8s_fake.get("v1", "configmaps", NAMESPACE, "platform3")
+        )
+        self.assertEqual(
+            [value for _, value in metrics.FAILOVER_DURATION.records()], [16]
+        )
+
+        # a notices that it has lost the lease
+        self.assertFalse(await a.step())
+
+    async def test_leader_keeps_lease(self):
+        a = self.standby("a")
+        b = self.standby("b")
+        await a.step()
+
+        for _ in range(3):
+            self.clock.advance(datetime.timedelta(seconds=5))
+            await a.step()
+            await b.step()
+
+        self.assertTrue(a.is_leader)
+        self.assertFalse(b.is_leader)
+
+    async def test_fences_when_renew_fails(self):
+        a = self.standby("a")
+        await a.step()
+
+        with mock.patch.object(a, "acquire", side_effect=RuntimeError("boom")):
+            # The lease is still valid for a while, so the leader keeps running
+            self.clock.advance(datetime.timedelta(seconds=5))
+            self.assertTrue(await a.step())
+
+            # The leader stops before the lease expires
+            self.clock.advance(datetime.timedelta(seconds=5))
+            self.assertFalse(await a.step())
+
+    async def test_run_releases_lease(self):
+        async def run_operator(stop_flag):
+            return "stopped"
+
+        a = standby.Standby(
+            self.k8s_client,
+            run_operator,
+            identity="a",
+            name="operator",
+            namespace="system",
+        )
+        b = self.standby("b")
+
+        # Let the operator run between the steps, without waiting for the interval
+        sleep = asyncio.sleep
+        with mock.patch.object(standby.asyncio, "sleep", lambda _: sleep(0)):
+            result = await a.run()
+
+        self.assertEqual(result, "stopped")
+        self.assertNotIn("holderIdentity", self.get_lease()["spec"])
+        # A standby takes over straight away
+        await b.step()
+        self.assertTrue(b.is_leader)
+        self.assertEqual(b.lost_at, NOW)
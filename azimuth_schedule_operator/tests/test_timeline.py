@@ -0,0 +1,183 @@
+import datetime
+import json
+import random
+import unittest
+from unittest import mock
+
+from aiohttp import test_utils, web
+
+from azimuth_schedule_operator import timeline
+
+from . import util
+
+BASE = datetime.datetime(2024, 8, 21, tzinfo=datetime.timezone.utc)
+
+
+def iso(hours):
+    return (BASE + datetime.timedelta(hours=hours)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def ts(hours):
+    return (BASE + datetime.timedelta(hours=hours)).timestamp()
+
+
+class TestLeaseTimeline(unittest.TestCase):
+    def setUp(self):
+        self.timeline = timeline.LeaseTimeline()
+        rng = random.Random(1)
+        self.leases = {}
+        for i in range(200):
+            start = rng.randrange(100)
+            end = start + rng.randrange(1, 50) if rng.random() < 0.9 else None
+            lease = util.lease_body(
+                f"lease{i}",
+                f"ns{i % 3}",
+                created_at=iso(0),
+                starts_at=iso(start),
+                ends_at=iso(end) if end is not None else None,
+                phase="Active",
+            )
+            self.leases[lease["metadata"]["uid"]] = (start, end, lease)
+            self.timeline.update(lease)
+        # Remove and update some leases
+        for i in range(20):
+            uid = f"ns{i % 3}-lease{i}"
+            self.timeline.remove(self.leases.pop(uid)[2])
+        for i in range(20, 40):
+            uid = f"ns{i % 3}-lease{i}"
+            lease = util.lease_body(
+                f"lease{i}",
+                f"ns{i % 3}",
+                created_at=iso(0),
+                starts_at=iso(5),
+                ends_at=iso(10),
+                phase="Active",
+            )
+            self.leases[uid] = (5, 10, lease)
+            self.timeline.update(lease)
+
+    def search(self, mode, start, end, namespace=None):
+        return [
+            lease["uid"]
+            for _, lease in self.timeline.search(
+                mode, ts(start), ts(end), namespace=namespace
+            )
+        ]
+
+    def brute_force(self, mode, start, end, namespace=None):
+        matches = []
+        for uid, (lease_start, lease_end, lease) in self.leases.items():
+            if namespace and lease["metadata"]["namespace"] != namespace:
+                continue
+            lease_end = float("inf") if lease_end is None else lease_end
+            if mode == "active":
+                matched = lease_start <= end and lease_end >= start
+            elif mode == "starting":
+                matched = start <= lease_start <= end
+            else:
+                matched = start <= lease_end <= end
+            if matched:
+                matches.append(uid)
+        return sorted(matches)
+
+    def test_search_against_brute_force(self):
+        rng = random.Random(2)
+        for _ in range(50):
+            start = rng.randrange(150)
+            end = start + rng.randrange(30)
+            for mode in timeline.MODES:
+                for namespace in [None, "ns1"]:
+                    self.assertEqual(
+                        sorted(self.search(mode, start, end, namespace)),
+                        self.brute_force(mode, start, end, namespace),
+                    )
+
+    def test_remove_namespaces(self):
+        self.timeline.remove_namespaces({"ns0", "ns2"})
+        self.leases = {
+            uid: lease
+            for uid, lease in self.leases.items()
+            if lease[2]["metadata"]["namespace"] == "ns1"
+        }
+
+        self.assertEqual(len(self.timeline), len(self.leases))
+        for mode in timeline.MODES:
+            self.assertEqual(
+                sorted(self.search(mode, 0, 200)), self.brute_force(mode, 0, 200)
+            )
+
+    def test_search_order(self):
+        keys = [key for key, _ in self.timeline.search("active", 0, 1e12)]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), len(self.leases))
+
+    def test_search_after(self):
+        keys = [key for key, _ in self.timeline.search("active", 0, 1e12)]
+        for i in [0, 15, 16, 17, 100]:
+            after = [
+                key for key, _ in self.timeline.search("active", 0, 1e12, None, keys[i])
+            ]
+            self.assertEqual(after, keys[i + 1 :])
+
+
+class TestTimelineHandler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.timeline = timeline.LeaseTimeline()
+        for i in range(5):
+            self.timeline.update(
+                util.lease_body(
+                    f"lease{i}",
+                    created_at=iso(0),
+                    starts_at=iso(i),
+                    ends_at=iso(i + 2),
+                    phase="Active",
+                )
+            )
+        self.timeline.update(
+            util.lease_body(
+                "other",
+                "ns2",
+                created_at=iso(0),
+                starts_at=iso(0),
+                ends_at=iso(10),
+                phase="Active",
+            )
+        )
+        patcher = mock.patch.object(timeline, "TIMELINE", self.timeline)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def get(self, query):
+        request = test_utils.make_mocked_request("GET", f"/timeline/leases?{query}")
+        response = await timeline.timeline_handler(request)
+        return json.loads(response.body)
+
+    async def test_pagination(self):
+        query = f"start={iso(3)}&end={iso(4)}&namespace=ns1&limit=2"
+        page = await self.get(query)
+        self.assertEqual(
+            [lease["name"] for lease in page["items"]], ["lease1", "lease2"]
+        )
+        self.assertIsNotNone(page["continue"])
+
+        page = await self.get(f"{query}&continue={page['continue']}")
+        self.assertEqual(
+            [lease["name"] for lease in page["items"]], ["lease3", "lease4"]
+        )
+        self.assertIsNone(page["continue"])
+
+    async def test_mode_ending(self):
+        page = await self.get(f"start={iso(9)}&end={iso(10)}&mode=ending")
+        self.assertEqual([lease["name"] for lease in page["items"]], ["other"])
+        self.assertEqual(page["items"][0]["endsAt"], iso(10))
+
+    async def test_invalid(self):
+        for query in [
+            f"end={iso(1)}",
+            f"start=notatime&end={iso(1)}",
+            f"start={iso(0)}&end={iso(1)}&mode=unknown",
+            f"start={iso(0)}&end={iso(1)}&limit=0",
+            f"start={iso(0)}&end={iso(1)}&continue=notatoken",
+        ]:
+            with self.assertRaises(web.HTTPBadRequest):
+                await self.get(query)
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+import kopf
+
+from azimuth_schedule_operator import metrics, workers
+
+from . import util
+
+TEST_CALLS = metrics.Counter("test_worker_calls", "Calls made to the test workers")
+
+
+async def setup_worker(metrics_interval):
+    workers.METRICS_INTERVAL_SECONDS = metrics_interval
+
+
+@workers.register
+async def echo(value):
+    TEST_CALLS.inc()
+    return os.getpid(), value
+
+
+@workers.register
+async def fail(kind):
+    if kind == "temporary":
+        raise kopf.TemporaryError("try again", delay=7)
+    elif kind == "permanent":
+        raise kopf.PermanentError("give up")
+    else:
+        raise ValueError("boom")
+
+
+@workers.register
+async def hang():
+    await asyncio.Event().wait()
+
+
+@workers.offload
+async def remember_name(body, memo, retry=0, **_):
+    memo["name"] = body["metadata"]["name"]
+    memo["retry"] = retry
+    if memo.get("fail"):
+        raise kopf.TemporaryError("failed", delay=3)
+
+
+class TestOffload(unittest.IsolatedAsyncioTestCase):
+    async def test_without_pool(self):
+        memo = {}
+
+        await remember_name(
+            body=util.lease_body("lease1", uid="uid1"), memo=memo, logger=None
+        )
+
+        self.assertEqual(memo, {"name": "lease1", "retry": 0})
+
+
+class TestWorkerPool(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pool = workers.WorkerPool(2, setup_worker, (0.05,))
+        self.pool.start()
+        self.addAsyncCleanup(self.pool.stop)
+
+    async def test_call(self):
+        keys = [f"uid{i}" for i in range(20)]
+
+        results = [await self.pool.call(key, "echo", value=key) for key in keys]
+        pids = {key: pid for key, (pid, _) in zip(keys, results)}
+        again = [await self.pool.call(key, "echo", value=key) for key in keys]
+
+        self.assertEqual([value for _, value in results], keys)
+        # Each key always goes to the same worker, and both workers are used
+        self.assertEqual([pid for pid, _ in again], [pids[key] for key in keys])
+        self.assertEqual(len(set(pids.values())), 2)
+        self.assertNotIn(os.getpid(), pids.values())
+        self.assertEqual(len(await self.pool.broadcast("echo", value=None)), 2)
+
+        # The metrics from the workers are reported with the worker as a label
+        await asyncio.sleep(0.2)
+        records = {r["worker"]: value for r, value in TEST_CALLS.records()}
+        self.assertEqual(sum(records.values()), 42)
+        self.assertEqual(set(records), {"0", "1"})
+
+    async def test_errors(self):
+        with self.assertRaises(kopf.TemporaryError) as ctx:
+            await self.pool.call("uid1", "fail", kind="temporary")
+        self.assertEqual(str(ctx.exception), "try again")
+        self.assertEqual(ctx.exception.delay, 7)
+        with self.assertRaises(kopf.PermanentError):
+            await self.pool.call("uid1", "fail", kind="permanent")
+        with self.assertRaisesRegex(workers.WorkerError, "ValueError: boom"):
+            await self.pool.call("uid1", "fail", kind="error")
+
+    async def test_offload(self):
+        memo = {}
+        with mock.patch.object(workers, "POOL", self.pool):
+            await remember_name(
+                body=util.lease_body("lease1", uid="uid1"),
+                memo=memo,
+                logger=None,
+                retry=2,
+                patch={},
+            )
+            # The retry count is sent to the worker, but other arguments are not
+            self.assertEqual(memo, {"name": "lease1", "retry": 2})
+
+            memo["fail"] = True
+            with self.assertRaises(kopf.TemporaryError):
+                await remember_name(
+                    body=util.lease_body("lease2", uid="uid1"), memo=memo
+                )
+
+    async def test_worker_exits(self):
+        index = self.pool.worker_for("uid1")
+        call = asyncio.create_task(self.pool.call("uid1", "hang"))
+        monitor = asyncio.create_task(self.pool.monitor())
+        await asyncio.sleep(0.1)
+
+        self.pool._processes[index].kill()
+
+        with self.assertRaises(workers.WorkerExitedError):
+            await asyncio.wait_for(call, 10)
+        with self.assertRaises(workers.WorkerExitedError):
+            await asyncio.wait_for(monitor, 10)
+        with self.assertRaises(workers.WorkerExitedError):
+            await self.pool.call("uid2", "echo", value=None)
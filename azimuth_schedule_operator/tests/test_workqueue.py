@@ -0,0 +1,209 @@
+import asyncio
+import datetime
+import unittest
+from unittest import mock
+
+from azimuth_schedule_operator import metrics, workqueue
+from azimuth_schedule_operator.utils import clock
+
+NOW = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestDeadlineQueue(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock(NOW)
+        patcher = mock.patch.object(clock, "CLOCK", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = workqueue.DeadlineQueue(concurrency=1, max_wait=60)
+        self.order = []
+
+    async def work(self, name, deadline=None, tenant=""):
+        async with self.queue.slot(deadline, tenant):
+            self.order.append(name)
+
+    async def queue_work(self, *work):
+        """
+        Queues the given (name, deadline[, tenant]) work behind a running piece of
+        work.
+        """
+        release = asyncio.Event()
+
+        async def blocker():
+            async with self.queue.slot():
+                await release.wait()
+
+        tasks = [asyncio.create_task(blocker())]
+        await asyncio.sleep(0)
+        for args in work:
+            tasks.append(asyncio.create_task(self.work(*args)))
+            await asyncio.sleep(0)
+        return release, tasks
+
+    def seconds(self, seconds):
+        return NOW + datetime.timedelta(seconds=seconds)
+
+    async def test_earliest_deadline_first(self):
+        release, tasks = await self.queue_work(
+            ("routine", None),
+            ("later", self.seconds(30)),
+            ("overdue", self.seconds(-10)),
+            ("soon", self.seconds(10)),
+        )
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(self.order, ["overdue", "soon", "later", "routine"])
+
+    async def test_routine_work_not_starved(self):
+        release, tasks = await self.queue_work(("routine", None))
+        # Overdue work that arrives much later does not overtake the routine work
+        self.clock.advance(datetime.timedelta(seconds=121))
+        tasks.append(asyncio.create_task(self.work("overdue", self.seconds(-3600))))
+        await asyncio.sleep(0)
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(self.order, ["routine", "overdue"])
+
+    async def test_limits_concurrency(self):
+        self.queue.concurrency = 2
+        running = []
+        peak = 0
+
+        async def work():
+            nonlocal peak
+            async with self.queue.slot():
+                running.append(None)
+                peak = max(peak, len(running))
+                await asyncio.sleep(0)
+                running.pop()
+
+        await asyncio.gather(*(work() for _ in range(10)))
+
+        self.assertEqual(peak, 2)
+        self.assertEqual(self.queue._running, 0)
+
+    async def test_cancelled_work(self):
+        release, tasks = await self.queue_work(
+            ("cancelled", self.seconds(-10)), ("routine", None)
+        )
+
+        tasks[1].cancel()
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.assertEqual(self.order, ["routine"])
+        self.assertEqual(self.queue._running, 0)
+
+    @mock.patch.object(metrics, "WORK_QUEUE_WAIT")
+    async def test_metrics(self, work_queue_wait):
+        release, tasks = await self.queue_work(
+            ("overdue", self.seconds(-10)),
+            ("imminent", self.seconds(10)),
+            ("routine", self.seconds(3600)),
+        )
+        depths = {
+            (r["tenant"], r["band"]): v
+            for r, v in metrics.WORK_QUEUE_DEPTH.records()
+            if v
+        }
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(
+            depths, {("", "overdue"): 1, ("", "imminent"): 1, ("", "routine"): 1}
+        )
+        self.assertEqual(
+            [c.kwargs["band"] for c in work_queue_wait.observe.call_args_list],
+            ["routine", "overdue", "imminent", "routine"],
+        )
+
+    async def test_fair_between_tenants(self):
+        release, tasks = await self.queue_work(
+            *((f"ns1-{i}", None, "ns1") for i in range(4)),
+            ("ns2-0", None, "ns2"),
+            ("ns2-1", self.seconds(-10), "ns2"),
+        )
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+        # The tenants take turns, with the earliest deadline first for each tenant
+        self.assertEqual(
+            self.order, ["ns1-0", "ns2-1", "ns1-1", "ns2-0", "ns1-2", "ns1-3"]
+        )
+
+    async def test_tenant_weights(self):
+        self.queue = workqueue.DeadlineQueue(
+            concurrency=1, weights={"ns1": 2, "ns2": 0.5}
+        )
+        release, tasks = await self.queue_work(
+            *((f"ns1-{i}", None, "ns1") for i in range(4)),
+            *((f"ns2-{i}", None, "ns2") for i in range(2)),
+            *((f"ns3-{i}", None, "ns3") for i in range(2)),
+        )
+
+        release.set()
+        await asyncio.gather(*tasks)
+
+        # ns2 only gets a slot every other round
+        self.assertEqual(
+            self.order,
+            ["ns1-0", "ns1-1", "ns3-0", "ns1-2", "ns1-3", "ns2-0", "ns3-1", "ns2-1"],
+        )
+
+    def test_invalid_weights(self):
+        with self.assertRaises(ValueError):
+            workqueue.DeadlineQueue(weights={"ns1": 0})
+
+    async def test_unlimited(self):
+        self.queue.concurrency = 0
+        release, tasks = await self.queue_work(("other", None))
+
+        # Nothing waits when there is no limit
+        self.assertEqual(self.order, ["other"])
+        release.set()
+        await asyncio.gather(*tasks)
+
+
+class TestPrioritise(unittest.IsolatedAsyncioTestCase):
+    async def test_prioritise(self):
+        queue = workqueue.DeadlineQueue(concurrency=1)
+        deadlines = []
+
+        def deadline(body, **_):
+            deadlines.append(body["deadline"])
+            return body["deadline"]
+
+        @workqueue.prioritise(deadline)
+        async def handler(body, **_):
+            return body["metadata"]["name"]
+
+        body = {"metadata": {"name": "obj1", "namespace": "ns1"}, "deadline": NOW}
+        with (
+            mock.patch.object(workqueue, "QUEUE", queue),
+            mock.patch.object(queue, "slot", wraps=queue.slot) as slot,
+        ):
+            result = await handler(body=body)
+
+        self.assertEqual(result, "obj1")
+        self.assertEqual(deadlines, [NOW])
+        slot.assert_called_once_with(NOW, "ns1")
+
+    def test_tenant(self):
+        body = {
+            "metadata": {"name": "lease1", "namespace": "ns1"},
+            "spec": {"cloudCredentialsSecretName": "creds"},
+        }
+
+        self.assertEqual(workqueue.tenant(body), "ns1")
+        with mock.patch.object(workqueue, "TENANT_KEY", "credentials"):
+            self.assertEqual(workqueue.tenant(body), "ns1/creds")
+            # Schedules do not have credentials
+            self.assertEqual(
+                workqueue.tenant({"metadata": {"namespace": "ns1"}}), "ns1"
+            )
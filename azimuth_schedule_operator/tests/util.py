@@ -113,6 +113,7 @@ def httpx_status_error(status_code, message=None, text=None, json=None):
 def mock_openstack_cloud():
     cloud = mock.AsyncMock()
     cloud.__aenter__.return_value = cloud
+    cloud.forget_session = mock.Mock()
 
     clients = cloud.clients = collections.defaultdict(mock_openstack_client)
     cloud.api_client = api_client_method = mock.Mock()
@@ -141,3 +142,50 @@ def mock_openstack_resource():
     side_effect_with_return_value(list_method, empty_async_iterator)
 
     return resource
+
+
+def isoformat(value):
+    """Returns the given datetime in the format used for times in Kubernetes."""
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def lease_body(
+    name="lease1",
+    namespace="ns1",
+    uid=None,
+    *,
+    created_at="2024-08-21T12:00:00Z",
+    starts_at=None,
+    ends_at=None,
+    machines=None,
+    phase=None,
+):
+    """
+    Returns the body of a lease for tests that use the body directly rather than
+    going through the handlers.
+
+    Times can be given as datetimes or strings and machines as (size ID, count)
+    tuples. If no UID is given, one is derived from the namespace and name.
+    """
+    spec = {}
+    for key, value in [("startsAt", starts_at), ("endsAt", ends_at)]:
+        if value is not None:
+            spec[key] = value if isinstance(value, str) else isoformat(value)
+    if machines is not None:
+        spec["resources"] = {
+            "machines": [
+                {"sizeId": size_id, "count": count} for size_id, count in machines
+            ],
+        }
+    lease = {
+        "metadata": {
+            "name": name,
+            "namespace": namespace,
+            "uid": uid or f"{namespace}-{name}",
+            "creationTimestamp": created_at,
+        },
+        "spec": spec,
+    }
+    if phase:
+        lease["status"] = {"phase": phase}
+    return lease
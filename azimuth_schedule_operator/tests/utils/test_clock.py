@@ -0,0 +1,25 @@
+import datetime
+import unittest
+from unittest import mock
+
+import freezegun
+
+from azimuth_schedule_operator.utils import clock
+
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class TestClock(unittest.TestCase):
+    @freezegun.freeze_time("2024-08-21T14:30:00Z")
+    def test_now(self):
+        self.assertEqual(
+            clock.now(),
+            datetime.datetime(2024, 8, 21, 14, 30, tzinfo=datetime.timezone.utc),
+        )
+
+    def test_virtual_clock(self):
+        virtual = clock.VirtualClock(START)
+        with mock.patch.object(clock, "CLOCK", virtual):
+            self.assertEqual(clock.now(), START)
+            virtual.advance(datetime.timedelta(days=7))
+            self.assertEqual(clock.now(), START + datetime.timedelta(days=7))
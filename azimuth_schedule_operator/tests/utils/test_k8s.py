@@ -0,0 +1,27 @@
+import unittest
+
+import httpx
+
+from azimuth_schedule_operator.utils import k8s
+
+
+class TestK8s(unittest.TestCase):
+    def test_request_operation(self):
+        for method, path, expected in [
+            ("GET", "/apis/scheduling.azimuth.stackhpc.com", "GET discovery"),
+            ("GET", "/api/v1/namespaces", "GET namespaces"),
+            ("GET", "/api/v1/namespaces/ns1/secrets/creds", "GET secrets"),
+            (
+                "PUT",
+                "/apis/scheduling.azimuth.stackhpc.com/v1alpha1/namespaces/ns1"
+                "/leases/lease1/status",
+                "PUT leases/status",
+            ),
+            (
+                "GET",
+                "/apis/scheduling.azimuth.stackhpc.com/v1alpha1/leases",
+                "GET leases",
+            ),
+        ]:
+            request = httpx.Request(method, f"https://kubernetes{path}")
+            self.assertEqual(k8s.request_operation(request), expected)
@@ -0,0 +1,25 @@
+import unittest
+from unittest import mock
+
+import httpx
+
+from azimuth_schedule_operator.utils import transports
+
+
+class TestWrappingTransport(unittest.IsolatedAsyncioTestCase):
+    async def test_delegates(self):
+        wrapped = mock.AsyncMock(spec=httpx.AsyncBaseTransport)
+        wrapped.handle_async_request.return_value = httpx.Response(204)
+        transport = transports.WrappingTransport(wrapped)
+
+        async with transport as entered:
+            self.assertIs(entered, transport)
+            response = await transport.handle_async_request(
+                httpx.Request("GET", "http://example.test")
+            )
+        await transport.aclose()
+
+        self.assertEqual(response.status_code, 204)
+        wrapped.__aenter__.assert_awaited_once()
+        wrapped.__aexit__.assert_awaited_once_with(None, None, None)
+        wrapped.aclose.assert_awaited_once()
@@ -0,0 +1,52 @@
+import random
+import unittest
+
+from azimuth_schedule_operator.utils import treap
+
+
+class SizeTreap(treap.Treap):
+    def _aggregate(self, node):
+        return (
+            1
+            + (node.left.aggregate if node.left else 0)
+            + (node.right.aggregate if node.right else 0)
+        )
+
+
+class TestTreap(unittest.TestCase):
+    def test_set_get_pop(self):
+        t = treap.Treap(seed=1)
+        t[3] = "c"
+        t[1] = "a"
+        t[2] = "b"
+        t[2] = "bb"
+
+        self.assertEqual(len(t), 3)
+        self.assertIn(1, t)
+        self.assertNotIn(4, t)
+        self.assertEqual(t.get(2), "bb")
+        self.assertEqual(t.get(4, "default"), "default")
+        self.assertEqual(t.pop(1), "a")
+        self.assertEqual(t.pop(1, None), None)
+        with self.assertRaises(KeyError):
+            t.pop(1)
+        self.assertEqual(list(t.items()), [(2, "bb"), (3, "c")])
+
+    def test_items_range(self):
+        t = treap.Treap(seed=1)
+        for key in random.Random(1).sample(range(100), 100):
+            t[key] = key * 2
+
+        self.assertEqual(list(t.items(10, 15)), [(k, k * 2) for k in range(10, 15)])
+        self.assertEqual([k for k, _ in t.items()], list(range(100)))
+
+    def test_aggregate(self):
+        t = SizeTreap(seed=1)
+        keys = random.Random(2).sample(range(1000), 200)
+        for key in keys:
+            t[key] = None
+        for key in keys[:50]:
+            t.pop(key)
+
+        self.assertEqual(t._root.aggregate, 150)
+        self.assertEqual(len(t), 150)
@@ -0,0 +1,221 @@
+import base64
+import datetime
+import heapq
+import itertools
+import json
+import math
+
+from aiohttp import web
+from dateutil.parser import isoparse
+
+from .utils import treap
+
+# The supported query modes
+MODES = {"active", "starting", "ending"}
+# The default and maximum number of leases returned in a single page
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class IntervalTree(treap.Treap):
+    """
+    Interval tree of leases, keyed by (start, end, name).
+
+    Each subtree maintains the maximum and minimum end times of the leases that it
+    contains, which allows subtrees that cannot contain matching leases to be skipped.
+    """
+
+    def _aggregate(self, node):
+        end = node.key[1]
+        max_end, min_end = end, end
+        for child in (node.left, node.right):
+            if child is not None:
+                max_end = max(max_end, child.aggregate[0])
+                min_end = min(min_end, child.aggregate[1])
+        return max_end, min_end
+
+    def _search(self, node, mode, start, end, after):
+        if node is None:
+            return
+        max_end, min_end = node.aggregate
+        if mode != "starting" and max_end < start:
+            return
+        if mode == "ending" and min_end > end:
+            return
+        lease_start, lease_end, _ = node.key
+        if after is None or node.key > after:
+            # When looking for leases that start in the window, the leases in the
+            # left subtree all start before this lease
+            if mode != "starting" or lease_start >= start:
+                yield from self._search(node.left, mode, start, end, after)
+            if mode == "active":
+                matches = lease_start <= end and lease_end >= start
+            elif mode == "starting":
+                matches = start <= lease_start <= end
+            else:
+                matches = start <= lease_end <= end
+            if matches:
+                yield node.key, node.value
+        # The leases in the right subtree all start after this lease
+        if lease_start <= end:
+            yield from self._search(node.right, mode, start, end, after)
+
+    def search(self, mode, start, end, after=None):
+        """
+        Returns the (key, value) pairs for leases that are active, starting or ending
+        in the window [start, end], in key order, optionally only after the given key.
+        """
+        return self._search(self._root, mode, start, end, after)
+
+
+class LeaseTimeline:
+    """
+    Index of leases by time, for each namespace.
+
+    The index is maintained incrementally as leases change.
+    """
+
+    def __init__(self):
+        # Map of lease uid -> (namespace, key)
+        self._keys = {}
+        # Map of namespace -> interval tree
+        self._trees = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def update(self, body):
+        """Update the index with the given lease."""
+        self.remove(body)
+        metadata = body["metadata"]
+        spec = body.get("spec", {})
+        starts_at = spec.get("startsAt") or metadata["creationTimestamp"]
+        ends_at = spec.get("endsAt")
+        key = (
+            isoparse(starts_at).timestamp(),
+            isoparse(ends_at).timestamp() if ends_at else math.inf,
+            metadata["name"],
+        )
+        tree = self._trees.setdefault(metadata["namespace"], IntervalTree())
+        tree[key] = {
+            "namespace": metadata["namespace"],
+            "name": metadata["name"],
+            "uid": metadata["uid"],
+            "startsAt": spec.get("startsAt"),
+            "endsAt": ends_at,
+            "phase": body.get("status", {}).get("phase", "Unknown"),
+        }
+        self._keys[metadata["uid"]] = (metadata["namespace"], key)
+
+    def remove(self, body):
+        """Remove the given lease from the index."""
+        namespace, key = self._keys.pop(body["metadata"]["uid"], (None, None))
+        if namespace is None:
+            return
+        tree = self._trees[namespace]
+        tree.pop(key)
+        if not tree:
+            del self._trees[namespace]
+
+    def remove_namespaces(self, namespaces):
+        """Remove the leases in the given namespaces from the index."""
+        for namespace in namespaces:
+            self._trees.pop(namespace, None)
+        self._keys = {
+            uid: (namespace, key)
+            for uid, (namespace, key) in self._keys.items()
+            if namespace not in namespaces
+        }
+
+    def search(self, mode, start, end, namespace=None, after=None):
+        """
+        Returns the (key, lease) pairs for leases that are active, starting or ending
+        in the window [start, end], optionally restricted to a namespace.
+
+        The keys are (start, end, namespace, name) tuples and are returned in order,
+        optionally only after the given key.
+        """
+        if namespace:
+            namespaces = [namespace] if namespace in self._trees else []
+        else:
+            namespaces = list(self._trees.keys())
+        return heapq.merge(
+            *(self._search_namespace(ns, mode, start, end, after) for ns in namespaces)
+        )
+
+    def _search_namespace(self, namespace, mode, start, end, after):
+        # Leases in other namespaces with the same start and end as the given key may
+        # sort after it, so the tree search includes them and they are filtered here
+        tree = self._trees[namespace]
+        tree_after = after[:2] if after is not None else None
+        for (lease_start, lease_end, name), lease in tree.search(
+            mode, start, end, tree_after
+        ):
+            key = (lease_start, lease_end, namespace, name)
+            if after is None or key > after:
+                yield key, lease
+
+
+TIMELINE = LeaseTimeline()
+
+
+def encode_continue(key):
+    """Encodes a continue token for the given key."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_continue(token):
+    """Decodes the key from the given continue token."""
+    try:
+        start, end, namespace, name = json.loads(base64.urlsafe_b64decode(token))
+        return (float(start), float(end), str(namespace), str(name))
+    except (ValueError, TypeError):
+        raise web.HTTPBadRequest(text="invalid continue token")
+
+
+def parse_time(request, name):
+    """Parses the named time from the request as a timestamp."""
+    value = request.query.get(name)
+    if not value:
+        raise web.HTTPBadRequest(text=f"{name} is required")
+    try:
+        parsed = isoparse(value)
+    except ValueError:
+        raise web.HTTPBadRequest(text=f"invalid time for {name}: {value}")
+    # Times with no timezone are assumed to be UTC
+    if not parsed.tzinfo:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+async def timeline_handler(request):
+    """Returns the leases that are active, starting or ending in a time window.
+
+    The following query parameters are supported:
+
+      * start, end - the window to search, as ISO 8601 times (required)
+      * mode - one of active (the default), starting or ending
+      * namespace - only include leases from the given namespace
+      * limit - the maximum number of leases to return
+      * continue - the continue token from a previous response
+    """
+    start = parse_time(request, "start")
+    end = parse_time(request, "end")
+    mode = request.query.get("mode", "active")
+    if mode not in MODES:
+        raise web.HTTPBadRequest(text=f"invalid mode: {mode}")
+    try:
+        limit = int(request.query.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise web.HTTPBadRequest(text="invalid limit")
+    if not 0 < limit <= MAX_LIMIT:
+        raise web.HTTPBadRequest(text=f"limit must be between 1 and {MAX_LIMIT}")
+    token = request.query.get("continue")
+    after = decode_continue(token) if token else None
+
+    results = TIMELINE.search(mode, start, end, request.query.get("namespace"), after)
+    # Fetch one more lease than the limit to know if there is another page
+    page = list(itertools.islice(results, limit + 1))
+    items = [lease for _, lease in page[:limit]]
+    next_token = encode_continue(page[limit - 1][0]) if len(page) > limit else None
+    return web.json_response({"items": items, "continue": next_token})
@@ -0,0 +1,35 @@
+import datetime
+
+
+class Clock:
+    """The clock used by the operator to get the current time."""
+
+    def now(self):
+        """Returns the current time as a timezone-aware datetime in UTC."""
+        return datetime.datetime.now(datetime.timezone.utc)
+
+
+class VirtualClock(Clock):
+    """
+    Clock that only moves when it is told to, e.g. to simulate weeks of activity
+    in a few minutes.
+    """
+
+    def __init__(self, start):
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def advance(self, delta):
+        """Moves the clock forward by the given timedelta."""
+        self._now += delta
+
+
+# The clock that is in use, which can be replaced with a virtual clock
+CLOCK = Clock()
+
+
+def now():
+    """Returns the current time from the clock that is in use."""
+    return CLOCK.now()
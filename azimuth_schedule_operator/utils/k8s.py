@@ -1,13 +1,45 @@
 import easykube
 from pydantic.json import pydantic_encoder
 
+from azimuth_schedule_operator import cassette, metrics
+
 FIELD_MANAGER_NAME = "azimuth-caas-operator"
 
 
+def request_operation(request):
+    """Returns the name of the operation for the given request."""
+    parts = request.url.path.strip("/").split("/")
+    # Remove the API group and version
+    if parts[0] == "api":
+        parts = parts[2:]
+    elif parts[0] == "apis":
+        parts = parts[3:]
+    # Remove the namespace for namespaced resources
+    if len(parts) > 2 and parts[0] == "namespaces":
+        parts = parts[2:]
+    if not parts:
+        resource = "discovery"
+    elif len(parts) > 2:
+        resource = f"{parts[0]}/{parts[2]}"
+    else:
+        resource = parts[0]
+    return f"{request.method} {resource}"
+
+
 def get_k8s_client():
-    return easykube.Configuration.from_environment(
+    client = easykube.Configuration.from_environment(
         json_encoder=pydantic_encoder
-    ).async_client(default_field_manager=FIELD_MANAGER_NAME)
+    ).async_client(
+        default_field_manager=FIELD_MANAGER_NAME,
+    )
+    # The transport is created from the configuration by the client, so we wrap it
+    # after the client is created to record metrics and, if enabled, the traffic
+    client._transport = metrics.InstrumentedTransport(
+        cassette.record("kubernetes", client._transport),
+        "kubernetes",
+        request_operation,
+    )
+    return client
 
 
 async def get_pod_resource(client):
@@ -0,0 +1,27 @@
+import httpx
+
+
+class WrappingTransport(httpx.AsyncBaseTransport):
+    """
+    Base class for transports that add behaviour to the requests made using a
+    wrapped transport.
+
+    The lifecycle of the wrapped transport is managed along with the wrapper, and
+    requests are passed straight through unless handle_async_request is overridden.
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    async def __aenter__(self):
+        await self._transport.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._transport.__aexit__(exc_type, exc_value, traceback)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+    async def handle_async_request(self, request):
+        return await self._transport.handle_async_request(request)
@@ -0,0 +1,120 @@
+import random
+
+
+class Node:
+    """A node in a treap."""
+
+    __slots__ = ("aggregate", "key", "left", "priority", "right", "value")
+
+    def __init__(self, key, value, priority):
+        self.key = key
+        self.value = value
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.aggregate = None
+
+
+class Treap:
+    """
+    An ordered map implemented as a treap.
+
+    Subclasses can maintain an aggregate for each subtree by overriding
+    _aggregate, which is recomputed from the children whenever a subtree changes.
+    This allows queries over ranges of keys to be answered in logarithmic time.
+    """
+
+    def __init__(self, seed=None):
+        self._root = None
+        self._len = 0
+        self._random = random.Random(seed)
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def _aggregate(self, node):
+        """Returns the aggregate for the subtree rooted at the given node."""
+        return None
+
+    def _pull(self, node):
+        node.aggregate = self._aggregate(node)
+        return node
+
+    def _split(self, node, key, inclusive=False):
+        """
+        Splits the subtree into a subtree with keys less than the key (or equal to,
+        if inclusive is given) and a subtree with the remaining keys.
+        """
+        if node is None:
+            return None, None
+        if node.key < key or (inclusive and node.key == key):
+            node.right, right = self._split(node.right, key, inclusive)
+            return self._pull(node), right
+        else:
+            left, node.left = self._split(node.left, key, inclusive)
+            return left, self._pull(node)
+
+    def _merge(self, left, right):
+        """Merges two subtrees, where all the keys in left are less than in right."""
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            return self._pull(left)
+        else:
+            right.left = self._merge(left, right.left)
+            return self._pull(right)
+
+    def _find(self, key):
+        node = self._root
+        while node is not None and node.key != key:
+            node = node.left if key < node.key else node.right
+        return node
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def get(self, key, default=None):
+        node = self._find(key)
+        return node.value if node is not None else default
+
+    def __setitem__(self, key, value):
+        left, right = self._split(self._root, key)
+        node, right = self._split(right, key, inclusive=True)
+        if node is None:
+            node = Node(key, value, self._random.random())
+            self._len += 1
+        else:
+            node.value = value
+        self._root = self._merge(self._merge(left, self._pull(node)), right)
+
+    def pop(self, key, *default):
+        left, right = self._split(self._root, key)
+        node, right = self._split(right, key, inclusive=True)
+        self._root = self._merge(left, right)
+        if node is not None:
+            self._len -= 1
+            return node.value
+        elif default:
+            return default[0]
+        else:
+            raise KeyError(key)
+
+    def _items(self, node, start, end):
+        if node is None:
+            return
+        if start is None or start < node.key:
+            yield from self._items(node.left, start, end)
+        if (start is None or start <= node.key) and (end is None or node.key < end):
+            yield node.key, node.value
+        if end is None or node.key < end:
+            yield from self._items(node.right, start, end)
+
+    def items(self, start=None, end=None):
+        """Returns the (key, value) pairs in order, optionally in [start, end)."""
+        return self._items(self._root, start, end)
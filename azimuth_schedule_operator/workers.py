@@ -0,0 +1,300 @@
+import asyncio
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import zlib
+
+import kopf
+
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+
+# The number of worker processes that handlers are run in
+# If 0, the handlers are run in the operator process
+WORKERS = int(os.environ.get("AZIMUTH_SCHEDULE_WORKERS", "0"))
+
+# The interval at which the workers report their metrics to the operator process
+METRICS_INTERVAL_SECONDS = 5
+
+# Map of name -> coroutine function that can be called in the workers
+FUNCTIONS = {}
+
+# The pool that handlers are offloaded to, if workers are enabled
+POOL = None
+
+
+class WorkerError(Exception):
+    """Raised when a function called in a worker fails with an unexpected error."""
+
+
+class WorkerExitedError(WorkerError):
+    """Raised for calls that were in progress when their worker exited."""
+
+    def __init__(self, index):
+        super().__init__(f"worker {index} exited")
+
+
+def register(func):
+    """Decorator that allows a coroutine function to be called in the workers."""
+    FUNCTIONS[func.__name__] = func
+    return func
+
+
+def receive_in_thread(conn, loop, callback):
+    """
+    Receives messages from the connection in a thread, passing each message to the
+    callback in the event loop. None is passed when the connection is closed.
+    """
+
+    def receive():
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                message = None
+            loop.call_soon_threadsafe(callback, message)
+            if message is None:
+                return
+
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+    return thread
+
+
+async def call(name, kwargs):
+    """
+    Calls the named function, returning the outcome in a form that can be sent back
+    to the operator process.
+    """
+    try:
+        return "result", await FUNCTIONS[name](**kwargs)
+    except kopf.TemporaryError as exc:
+        return "temporary", (str(exc), exc.delay)
+    except kopf.PermanentError as exc:
+        return "permanent", str(exc)
+    except Exception as exc:
+        LOG.exception("error in worker calling %s", name)
+        return "error", f"{type(exc).__name__}: {exc}"
+
+
+def raise_for_outcome(outcome):
+    """Returns the result for the given outcome, or raises the error."""
+    kind, value = outcome
+    if kind == "result":
+        return value
+    elif kind == "temporary":
+        message, delay = value
+        raise kopf.TemporaryError(message, delay=delay)
+    elif kind == "permanent":
+        raise kopf.PermanentError(value)
+    else:
+        raise WorkerError(value)
+
+
+async def worker_loop(conn, initializer, initargs):
+    """Serves the calls from the operator process until told to stop."""
+    if initializer is not None:
+        await initializer(*initargs)
+    loop = asyncio.get_running_loop()
+    messages = asyncio.Queue()
+    receive_in_thread(conn, loop, messages.put_nowait)
+    tasks = set()
+
+    async def handle(call_id, name, kwargs):
+        conn.send(("call", call_id, await call(name, kwargs)))
+
+    async def report_metrics():
+        while True:
+            conn.send(("metrics", metrics.worker_snapshot()))
+            await asyncio.sleep(METRICS_INTERVAL_SECONDS)
+
+    reporter = asyncio.create_task(report_metrics())
+    try:
+        while (message := await messages.get()) is not None:
+            task = asyncio.create_task(handle(*message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        reporter.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(reporter, *tasks, return_exceptions=True)
+
+
+def worker_main(conn, initializer, initargs):
+    """Entrypoint for worker processes."""
+    # Signals are handled by the operator process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_loop(conn, initializer, initargs))
+
+
+class WorkerPool:
+    """
+    Pool of worker processes, each with its own event loop, that functions are
+    called in.
+
+    Calls are assigned to workers using a key, so that the calls for an object always
+    go to the same worker and can reuse the caches in that worker.
+
+    The initializer, if given, is a coroutine function that is awaited in each
+    worker before it serves any calls. It must be importable by the workers.
+    """
+
+    def __init__(self, size, initializer=None, initargs=()):
+        self.size = size
+        self._initializer = initializer
+        self._initargs = initargs
+        self._processes = []
+        self._connections = []
+        self._call_ids = itertools.count()
+        # Map of call id -> (worker index, future)
+        self._calls = {}
+        self._exited = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._exited = loop.create_future()
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.size):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=worker_main,
+                args=(child_conn, self._initializer, self._initargs),
+                name=f"worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._connections.append(conn)
+            receive_in_thread(
+                conn, loop, functools.partial(self._handle_message, index)
+            )
+
+    def _handle_message(self, index, message):
+        if message is None:
+            self._handle_exit(index)
+        elif message[0] == "metrics":
+            metrics.update_worker_values(str(index), message[1])
+        else:
+            _, call_id, outcome = message
+            _, future = self._calls.pop(call_id, (None, None))
+            if future is not None and not future.done():
+                future.set_result(outcome)
+
+    def _handle_exit(self, index):
+        for call_id, (worker, future) in list(self._calls.items()):
+            if worker == index:
+                del self._calls[call_id]
+                if not future.done():
+                    future.set_exception(WorkerExitedError(index))
+        if not self._exited.done():
+            self._exited.set_result(index)
+
+    def worker_for(self, key):
+        """Returns the index of the worker for the given key."""
+        return zlib.crc32(key.encode()) % self.size
+
+    async def _call(self, index, name, kwargs):
+        if self._exited.done():
+            raise WorkerExitedError(self._exited.result())
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = (index, future)
+        self._connections[index].send((call_id, name, kwargs))
+        return raise_for_outcome(await future)
+
+    async def call(self, key, name, /, **kwargs):
+        """Calls the named function in the worker for the key."""
+        return await self._call(self.worker_for(key), name, kwargs)
+
+    async def broadcast(self, name, /, **kwargs):
+        """Calls the named function in every worker, returning all the results."""
+        return await asyncio.gather(
+            *(self._call(index, name, kwargs) for index in range(self.size))
+        )
+
+    async def monitor(self):
+        """Waits until a worker exits, then raises."""
+        index = await asyncio.shield(self._exited)
+        raise WorkerExitedError(index)
+
+    async def stop(self):
+        """Stops the workers, waiting for them to exit."""
+        for conn in self._connections:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 10)
+            if process.is_alive():
+                process.kill()
+
+
+class ObjectLogger(logging.LoggerAdapter):
+    """Logger for handlers running in workers, prefixing messages with the object."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['namespace']}/{self.extra['name']}] {msg}", kwargs
+
+
+@register
+async def run_handler(handler, body, memo, **kwargs):
+    """
+    Runs the named handler in a worker, returning the updated memo for the object.
+    """
+    metadata = body.get("metadata", {})
+    logger = ObjectLogger(
+        logging.getLogger("kopf.objects"),
+        {"namespace": metadata.get("namespace"), "name": metadata.get("name")},
+    )
+    await HANDLERS[handler](body=body, logger=logger, memo=memo, **kwargs)
+    return memo
+
+
+# Map of name -> handler that can be offloaded to the workers
+HANDLERS = {}
+
+
+def offload(handler):
+    """
+    Decorator for kopf handlers that runs the handler in a worker, if enabled.
+
+    The body, the per-object memo and the given keyword arguments are sent to the
+    worker for the object, and the memo is updated with any changes made by the
+    handler. A logger for the object is created in the worker.
+    """
+    HANDLERS[handler.__name__] = handler
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        # Kopf always passes keyword arguments, so only direct calls are positional
+        if POOL is None or args:
+            return await handler(*args, **kwargs)
+        body = kwargs.pop("body")
+        kwargs.pop("logger", None)
+        memo = kwargs.pop("memo", None)
+        memo_data = dict(memo) if memo is not None else None
+        # Only the keyword arguments that can be sent to the worker are passed
+        kwargs = {
+            k: v for k, v in kwargs.items() if k in {"namespace", "name", "retry"}
+        }
+        memo_data = await POOL.call(
+            body["metadata"]["uid"],
+            "run_handler",
+            handler=handler.__name__,
+            body=dict(body),
+            memo=memo_data,
+            **kwargs,
+        )
+        if memo is not None:
+            memo.update(memo_data)
+
+    return wrapper
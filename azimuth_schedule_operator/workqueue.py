@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import os
+import time
+
+from . import metrics
+from .utils import clock
+
+# The maximum number of handlers that run at once, 0 for no limit
+# When the limit is reached, handlers wait in a queue that is ordered by deadline
+CONCURRENCY = int(os.environ.get("AZIMUTH_SCHEDULE_WORK_QUEUE_CONCURRENCY", "100"))
+# The time, in seconds, that bounds how far work can be reordered by deadline
+# Work with an earlier deadline can only overtake work that was queued up to twice
+# this time before it, so routine work is never starved
+MAX_WAIT_SECONDS = float(
+    os.environ.get("AZIMUTH_SCHEDULE_WORK_QUEUE_MAX_WAIT_SECONDS", "60")
+)
+# What the work is shared fairly between when the queue is contended
+# Either "namespace" or "credentials", in which case the work for leases is shared
+# between the cloud credential secrets in each namespace
+TENANT_KEY = os.environ.get("AZIMUTH_SCHEDULE_WORK_QUEUE_TENANT_KEY", "namespace")
+# JSON object of tenant -> weight, where a tenant gets slots in proportion to its
+# weight when the queue is contended, with a default weight of 1
+TENANT_WEIGHTS = json.loads(
+    os.environ.get("AZIMUTH_SCHEDULE_WORK_QUEUE_TENANT_WEIGHTS") or "{}"
+)
+
+# The priority bands that the queue metrics are reported for
+BAND_OVERDUE = "overdue"
+BAND_IMMINENT = "imminent"
+BAND_ROUTINE = "routine"
+
+
+def tenant(body):
+    """Returns the tenant that the work for the given object belongs to."""
+    # The body is not validated here, as this runs before waiting in the queue
+    namespace = body.get("metadata", {}).get("namespace", "")
+    secret_name = body.get("spec", {}).get("cloudCredentialsSecretName")
+    if TENANT_KEY == "credentials" and secret_name:
+        return f"{namespace}/{secret_name}"
+    return namespace
+
+
+class HeldSlot:
+    """A slot in the queue that is held by a piece of work."""
+
+    def __init__(self, queue, deadline, tenant):
+        self.queue = queue
+        self.deadline = deadline
+        self.tenant = tenant
+        self.held = True
+
+
+# The slot that is held by the current handler, if any
+CURRENT_SLOT = contextvars.ContextVar("work_queue_slot", default=None)
+
+
+class DeadlineQueue:
+    """
+    Limits the number of concurrent handlers, with the waiting handlers shared fairly
+    between tenants and run in order of the earliest deadline first for each tenant.
+
+    When the queue is contended, the slots are shared between the tenants with
+    waiting work using deficit round robin, so a tenant with a lot of work, e.g.
+    because it created many leases at once, cannot delay the work for other tenants
+    by more than one round. Each tenant gets slots in proportion to its weight.
+
+    The deadline used for ordering is clamped to within the max wait of when the work
+    was queued, and work without a deadline is ordered as if its deadline is the max
+    wait after it was queued. This means that work which is overdue can jump ahead of
+    routine work for the same tenant that was queued up to twice the max wait before
+    it, but no further.
+
+    Each piece of work is reported in one of three bands, depending on its deadline
+    when it was queued: overdue, imminent if the deadline is within the max wait, or
+    routine.
+    """
+
+    def __init__(
+        self, concurrency=CONCURRENCY, max_wait=MAX_WAIT_SECONDS, weights=None
+    ):
+        self.concurrency = concurrency
+        self._max_wait = datetime.timedelta(seconds=max_wait)
+        self._weights = TENANT_WEIGHTS if weights is None else weights
+        if any(weight <= 0 for weight in self._weights.values()):
+            raise ValueError("tenant weights must be positive")
+        self._running = 0
+        # Map of tenant -> heap of (key, sequence, future) for the waiting work
+        self._waiting = {}
+        # The tenants with waiting work, in round robin order
+        self._tenants = collections.deque()
+        # Map of tenant -> number of slots that the tenant can take in this round
+        self._deficits = {}
+        self._sequence = itertools.count()
+
+    def band(self, deadline, now):
+        """Returns the band for the given deadline."""
+        if deadline is None:
+            return BAND_ROUTINE
+        elif deadline <= now:
+            return BAND_OVERDUE
+        elif deadline <= now + self._max_wait:
+            return BAND_IMMINENT
+        else:
+            return BAND_ROUTINE
+
+    def _key(self, deadline, now):
+        if deadline is None:
+            return now + self._max_wait
+        return min(max(deadline, now - self._max_wait), now + self._max_wait)
+
+    def _start_round(self):
+        # Give the tenant at the front of the round robin its quantum
+        if self._tenants:
+            tenant = self._tenants[0]
+            self._deficits[tenant] += self._weights.get(tenant, 1)
+
+    def _next(self):
+        # Returns the future for the next waiting work, if any
+        while self._tenants:
+            tenant = self._tenants[0]
+            waiting = self._waiting[tenant]
+            # Discard work that was cancelled while waiting
+            while waiting and waiting[0][2].done():
+                heapq.heappop(waiting)
+            if not waiting:
+                # A tenant that runs out of work does not keep its deficit
+                self._tenants.popleft()
+                del self._waiting[tenant]
+                del self._deficits[tenant]
+                self._start_round()
+            elif self._deficits[tenant] >= 1:
+                self._deficits[tenant] -= 1
+                return heapq.heappop(waiting)[2]
+            else:
+                self._tenants.rotate(-1)
+                self._start_round()
+        return None
+
+    def _release(self):
+        # Pass the slot to the next waiting work, if any
+        future = self._next()
+        if future is not None:
+            future.set_result(None)
+        else:
+            self._running -= 1
+
+    async def _acquire(self, deadline, now, band, tenant):
+        if not self._tenants and self._running < self.concurrency:
+            self._running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        key = self._key(deadline, now)
+        if tenant not in self._waiting:
+            self._waiting[tenant] = []
+            self._deficits[tenant] = 0
+            self._tenants.append(tenant)
+            if len(self._tenants) == 1:
+                self._start_round()
+        heapq.heappush(self._waiting[tenant], (key, next(self._sequence), future))
+        metrics.WORK_QUEUE_DEPTH.inc(band=band, tenant=tenant)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # If the slot was passed to us before we were cancelled, pass it on
+            if not future.cancelled():
+                self._release()
+            raise
+        finally:
+            metrics.WORK_QUEUE_DEPTH.dec(band=band, tenant=tenant)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, deadline=None, tenant=""):
+        """Waits for a slot to run work for the tenant with the given deadline."""
+        if not self.concurrency:
+            yield
+            return
+        now = clock.now()
+        band = self.band(deadline, now)
+        started_at = time.monotonic()
+        await self._acquire(deadline, now, band, tenant)
+        metrics.WORK_QUEUE_WAIT.observe(
+            time.monotonic() - started_at, band=band, tenant=tenant
+        )
+        slot = HeldSlot(self, deadline, tenant)
+        token = CURRENT_SLOT.set(slot)
+        try:
+            yield
+        finally:
+            CURRENT_SLOT.reset(token)
+            # The slot may have been given up by the work and not taken again
+            if slot.held:
+                self._release()
+
+    async def _reacquire(self, slot):
+        now = clock.now()
+        await self._acquire(
+            slot.deadline, now, self.band(slot.deadline, now), slot.tenant
+        )
+        slot.held = True
+
+
+# The queue that the handlers wait in
+QUEUE = DeadlineQueue()
+
+
+@contextlib.asynccontextmanager
+async def released():
+    """
+    Context manager that gives up the slot held by the current handler, if any,
+    while it waits for something other than the work itself, e.g. the delay before a
+    request is retried. The handler waits for a slot again afterwards.
+
+    This only applies to handlers that run in the operator process. When handlers run
+    in workers, the slot is held by the operator process until the handler completes.
+    """
+    slot = CURRENT_SLOT.get()
+    if slot is None or not slot.held:
+        yield
+        return
+    slot.held = False
+    slot.queue._release()
+    # If the wait fails, e.g. because it is cancelled, the slot is not taken again
+    yield
+    await slot.queue._reacquire(slot)
+
+
+def prioritise(deadline=None):
+    """
+    Decorator for kopf handlers that waits for a slot in the queue before running
+    the handler.
+
+    The deadline for the work is given by calling deadline with the keyword arguments
+    for the handler, and may be None for routine work. If no deadline function is
+    given, all the work for the handler is routine. The work is shared fairly
+    between the tenants that the objects belong to.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            # Kopf always passes keyword arguments, so only direct calls are positional
+            if not QUEUE.concurrency or args:
+                return await handler(*args, **kwargs)
+            async with QUEUE.slot(
+                deadline(**kwargs) if deadline else None, tenant(kwargs["body"])
+            ):
+                return await handler(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
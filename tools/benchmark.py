@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+Benchmark for the operator handlers at scale.
+
+The real handlers are run against in-process stand-ins for the Kubernetes and
+OpenStack APIs, so no cluster, cloud or network access is required. The results,
+including the handler throughput and latencies, the API calls made in each tick and
+the peak memory usage, are written as JSON.
+
+Run from the repository root with the operator and its requirements installed, e.g.:
+
+    python tools/benchmark.py --leases 10000 --schedules 50000 --output results.json
+
+Alternatively, the handlers can be run against traffic that was recorded from a real
+deployment using AZIMUTH_SCHEDULE_CASSETTE_RECORD_DIR, e.g.:
+
+    python tools/benchmark.py --replay cassettes --output results.json
+
+In this case, the handlers are run for the latest version of each lease and schedule
+in the recorded responses, and the recorded responses are served with their original
+timings unless --replay-timing no is given.
+
+To measure how the throughput scales with the number of worker processes, the
+handlers can be offloaded to workers as when AZIMUTH_SCHEDULE_WORKERS is set, e.g.:
+
+    for n in 0 1 2 4; do
+        python tools/benchmark.py --workers $n --output results-$n.json
+    done
+
+Each worker has its own copy of the stand-ins for the APIs, so the work done by the
+stand-ins is also spread between the workers.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import pathlib
+import resource
+import sys
+import time
+from unittest import mock
+
+import easykube
+import httpx
+from pydantic.json import pydantic_encoder
+
+from azimuth_schedule_operator import cassette, metrics, openstack, operator, workers
+from azimuth_schedule_operator.models import registry
+from azimuth_schedule_operator.tests import util
+from azimuth_schedule_operator.tests.fakes import kubernetes as fake_kubernetes
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+from azimuth_schedule_operator.utils import k8s
+
+SECRET_NAME = "cloud-credentials"
+
+
+def percentile(values, q):
+    """Returns the given percentile of the values using the nearest rank."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def populate(k8s_fake, cloud_fake, args):
+    """Populates the fakes with the leases, schedules and their owners."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    namespaces = [f"ns-{i}" for i in range(args.namespaces)]
+    for namespace in namespaces:
+        credential = cloud_fake.add_application_credential()
+        k8s_fake.add(
+            {
+                "apiVersion": "v1",
+                "kind": "Secret",
+                "metadata": {"name": SECRET_NAME, "namespace": namespace},
+                "data": cloud_fake.secret_data(*credential),
+            }
+        )
+    for i in range(args.leases):
+        namespace = namespaces[i % len(namespaces)]
+        owner = k8s_fake.add(
+            {
+                "apiVersion": "v1",
+                "kind": "ConfigMap",
+                "metadata": {"name": f"platform-lease-{i}", "namespace": namespace},
+            }
+        )
+        k8s_fake.add(
+            {
+                "apiVersion": registry.API_VERSION,
+                "kind": "Lease",
+                "metadata": {
+                    "name": f"lease-{i}",
+                    "namespace": namespace,
+                    "ownerReferences": [
+                        {
+                            "apiVersion": "v1",
+                            "kind": "ConfigMap",
+                            "name": owner["metadata"]["name"],
+                            "uid": owner["metadata"]["uid"],
+                        },
+                    ],
+                },
+                "spec": {
+                    "cloudCredentialsSecretName": SECRET_NAME,
+                    "startsAt": util.isoformat(now - datetime.timedelta(hours=1)),
+                    "endsAt": util.isoformat(now + datetime.timedelta(days=1)),
+                    "resources": {"machines": [{"sizeId": "id1", "count": 1}]},
+                },
+            }
+        )
+    for i in range(args.schedules):
+        namespace = namespaces[i % len(namespaces)]
+        k8s_fake.add(
+            {
+                "apiVersion": "v1",
+                "kind": "ConfigMap",
+                "metadata": {"name": f"platform-schedule-{i}", "namespace": namespace},
+            }
+        )
+        k8s_fake.add(
+            {
+                "apiVersion": registry.API_VERSION,
+                "kind": "Schedule",
+                "metadata": {"name": f"schedule-{i}", "namespace": namespace},
+                "spec": {
+                    "ref": {
+                        "apiVersion": "v1",
+                        "kind": "ConfigMap",
+                        "name": f"platform-schedule-{i}",
+                    },
+                    "notAfter": util.isoformat(now + datetime.timedelta(days=1)),
+                },
+            }
+        )
+
+
+def replay_objects(k8s_cassette):
+    """
+    Returns the latest version of each lease and schedule in the recorded responses,
+    keyed in the same way as the objects in the fake Kubernetes API.
+    """
+    objects = {}
+    for interaction in k8s_cassette.load():
+        data = interaction["response"].get("json") or {}
+        for obj in data.get("items", [data]):
+            if obj.get("kind") not in {"Lease", "Schedule"}:
+                continue
+            # List items do not have the API version and kind set
+            obj.setdefault("apiVersion", data.get("apiVersion"))
+            metadata = obj["metadata"]
+            key = (
+                obj["apiVersion"],
+                f"{obj['kind'].lower()}s",
+                metadata["namespace"],
+                metadata["name"],
+            )
+            objects[key] = obj
+    return objects
+
+
+class Benchmark:
+    """Runs the handlers for all the given objects and records the results."""
+
+    def __init__(self, objects, k8s_calls, cloud_calls, concurrency, pool=None):
+        # Map of object key -> latest version of the object
+        self.objects = objects
+        # The pool of workers to run the handlers in, if any
+        self.pool = pool
+        # The number of calls made to each API, by operation
+        self.k8s_calls = k8s_calls
+        self.cloud_calls = cloud_calls
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.logger = logging.getLogger("benchmark")
+        # Map of handler name -> list of latencies
+        self.latencies = collections.defaultdict(list)
+        # Map of handler name -> number of errors
+        self.errors = collections.Counter()
+        # Map of object key -> memo, as kopf keeps for each object
+        self.memos = collections.defaultdict(dict)
+        self.ticks = []
+
+    async def _invoke(self, handler, key, **kwargs):
+        async with self.semaphore:
+            started_at = time.perf_counter()
+            try:
+                if self.pool:
+                    # Each worker has its own copy of the objects, so the latest
+                    # version of the object is looked up in the worker
+                    kwargs.pop("logger", None)
+                    self.memos[key] = await self.pool.call(
+                        "/".join(key),
+                        "invoke_handler",
+                        handler=handler.__name__,
+                        key=key,
+                        memo=self.memos[key],
+                        **kwargs,
+                    )
+                else:
+                    # Like kopf, pass the latest version of the object
+                    body = self.objects[key]
+                    await handler(body=body, memo=self.memos[key], **kwargs)
+            except Exception:
+                self.errors[handler.__name__] += 1
+            finally:
+                self.latencies[handler.__name__].append(
+                    time.perf_counter() - started_at
+                )
+
+    async def calls(self):
+        """Returns the number of calls made to each API so far."""
+        if not self.pool:
+            return self.k8s_calls.copy(), self.cloud_calls.copy()
+        k8s_calls, cloud_calls = collections.Counter(), collections.Counter()
+        for worker_k8s_calls, worker_cloud_calls in await self.pool.broadcast(
+            "worker_calls"
+        ):
+            k8s_calls.update(worker_k8s_calls)
+            cloud_calls.update(worker_cloud_calls)
+        return k8s_calls, cloud_calls
+
+    async def tick(self, name, invocations):
+        """Runs the given handler invocations concurrently as a single tick."""
+        k8s_calls, cloud_calls = await self.calls()
+        started_at = time.perf_counter()
+        await asyncio.gather(*invocations)
+        duration = time.perf_counter() - started_at
+        k8s_calls_after, cloud_calls_after = await self.calls()
+        self.ticks.append(
+            {
+                "name": name,
+                "invocations": len(invocations),
+                "durationSeconds": duration,
+                "throughput": len(invocations) / duration,
+                "calls": {
+                    "kubernetes": dict(k8s_calls_after - k8s_calls),
+                    "openstack": dict(cloud_calls_after - cloud_calls),
+                },
+            }
+        )
+
+    def invocations(self, handler, plural, **kwargs):
+        return [
+            self._invoke(handler, key, namespace=key[2], **kwargs)
+            for key in list(self.objects)
+            if key[0] == registry.API_VERSION and key[1] == plural
+        ]
+
+    async def run(self, ticks):
+        # The first tick reconciles the leases, as on creation or operator restart
+        await self.tick(
+            "reconcile",
+            self.invocations(operator.reconcile_lease, "leases", logger=self.logger),
+        )
+        # The remaining ticks run the timers for every lease and schedule
+        for i in range(ticks):
+            await self.tick(
+                f"tick-{i + 1}",
+                self.invocations(operator.check_lease, "leases", logger=self.logger)
+                + self.invocations(operator.schedule_check, "schedules"),
+            )
+
+    def results(self):
+        handlers = {}
+        for name, latencies in self.latencies.items():
+            handlers[name] = {
+                "invocations": len(latencies),
+                "errors": self.errors[name],
+                "latencySeconds": {
+                    "p50": percentile(latencies, 50),
+                    "p99": percentile(latencies, 99),
+                    "max": max(latencies),
+                },
+            }
+        return {
+            "throughput": (
+                sum(tick["invocations"] for tick in self.ticks)
+                / sum(tick["durationSeconds"] for tick in self.ticks)
+            ),
+            "handlers": handlers,
+            "ticks": self.ticks,
+            # On Linux, the maximum resident set size is reported in kilobytes
+            "peakMemoryBytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            * 1024,
+            # This is the peak for the largest worker, if any
+            "peakWorkerMemoryBytes": resource.getrusage(
+                resource.RUSAGE_CHILDREN
+            ).ru_maxrss
+            * 1024,
+        }
+
+
+def fake_apis(args):
+    """Returns the objects, clients and call counters for the fakes."""
+    k8s_fake = fake_kubernetes.FakeKubernetes()
+    cloud_fake = fake_openstack.FakeOpenStack(
+        page_size=args.openstack_page_size,
+        latency={"*": args.openstack_latency},
+        error_rates={"*": args.openstack_error_rate},
+        seed=args.seed,
+    )
+    populate(k8s_fake, cloud_fake, args)
+
+    def cloud_transport():
+        return httpx.ASGITransport(app=cloud_fake)
+
+    return (
+        k8s_fake.objects,
+        k8s_fake.client(),
+        cloud_transport,
+        k8s_fake.calls,
+        cloud_fake.calls,
+    )
+
+
+def replay_apis(args):
+    """Returns the objects, clients and call counters for the recorded traffic."""
+    directory = pathlib.Path(args.replay)
+    k8s_cassette = cassette.Cassette(directory / "kubernetes.jsonl")
+    timing = args.replay_timing == "yes"
+    k8s_transport = cassette.ReplayTransport(
+        k8s_cassette, timing, k8s.request_operation
+    )
+    cloud_transport = cassette.ReplayTransport(
+        cassette.Cassette(directory / "openstack.jsonl"),
+        timing,
+        openstack.request_operation,
+    )
+    # The base URL is taken from the recorded requests
+    url = httpx.URL(k8s_cassette.load()[0]["request"]["url"])
+    k8s_client = easykube.AsyncClient(
+        base_url=f"{url.scheme}://{url.netloc.decode()}",
+        transport=metrics.InstrumentedTransport(
+            k8s_transport, "kubernetes", k8s.request_operation
+        ),
+        json_encoder=pydantic_encoder,
+        default_field_manager=k8s.FIELD_MANAGER_NAME,
+    )
+    return (
+        replay_objects(k8s_cassette),
+        k8s_client,
+        lambda: cloud_transport,
+        k8s_transport.calls,
+        cloud_transport.calls,
+    )
+
+
+def patch_operator(k8s_client, cloud_transport, args):
+    """Returns the patches that make the operator use the given APIs."""
+    from_secret_data = openstack.from_secret_data
+
+    def fake_from_secret_data(secret_data):
+        return from_secret_data(secret_data, transport=cloud_transport())
+
+    return [
+        mock.patch.object(operator, "K8S_CLIENT", k8s_client),
+        mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", args.blazar),
+        mock.patch.object(openstack, "from_secret_data", fake_from_secret_data),
+    ]
+
+
+# The objects and call counters for the APIs in a worker
+WORKER_APIS = {}
+
+
+async def setup_worker(args):
+    """Sets up the APIs for the handlers in a worker."""
+    apis = replay_apis(args) if args.replay else fake_apis(args)
+    objects, k8s_client, cloud_transport, k8s_calls, cloud_calls = apis
+    for patcher in patch_operator(k8s_client, cloud_transport, args):
+        patcher.start()
+    WORKER_APIS.update(objects=objects, k8s_calls=k8s_calls, cloud_calls=cloud_calls)
+
+
+@workers.register
+async def invoke_handler(handler, key, memo, **kwargs):
+    """Invokes the named handler for the object with the given key in a worker."""
+    await getattr(operator, handler)(
+        body=WORKER_APIS["objects"][key],
+        memo=memo,
+        logger=logging.getLogger("benchmark"),
+        **kwargs,
+    )
+    return memo
+
+
+@workers.register
+async def worker_calls():
+    """Returns the number of calls made to each API by a worker."""
+    return WORKER_APIS["k8s_calls"], WORKER_APIS["cloud_calls"]
+
+
+async def run(args):
+    apis = replay_apis(args) if args.replay else fake_apis(args)
+    objects, k8s_client, cloud_transport, k8s_calls, cloud_calls = apis
+
+    pool = None
+    if args.workers:
+        pool = workers.WorkerPool(args.workers, setup_worker, (args,))
+        pool.start()
+        # Wait for the workers to start, so that the start up is not measured
+        await pool.broadcast("worker_calls")
+    benchmark = Benchmark(objects, k8s_calls, cloud_calls, args.concurrency, pool)
+    patchers = patch_operator(k8s_client, cloud_transport, args)
+    try:
+        for patcher in patchers:
+            patcher.start()
+        async with k8s_client:
+            await benchmark.run(args.ticks)
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+        if pool:
+            await pool.stop()
+
+    return {
+        "config": {
+            "replay": args.replay,
+            "replayTiming": args.replay_timing,
+            "leases": args.leases,
+            "schedules": args.schedules,
+            "namespaces": args.namespaces,
+            "ticks": args.ticks,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+            "blazar": args.blazar,
+            "openstackLatency": args.openstack_latency,
+            "openstackErrorRate": args.openstack_error_rate,
+            "openstackPageSize": args.openstack_page_size,
+            "seed": args.seed,
+        },
+        **benchmark.results(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--leases", type=int, default=1000)
+    parser.add_argument("--schedules", type=int, default=5000)
+    parser.add_argument("--namespaces", type=int, default=10)
+    parser.add_argument("--ticks", type=int, default=3)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="The maximum number of handlers that run at once.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="The number of worker processes to run the handlers in.",
+    )
+    parser.add_argument("--blazar", choices=["yes", "no"], default="no")
+    parser.add_argument(
+        "--openstack-latency",
+        type=float,
+        default=0,
+        help="The latency in seconds to add to each OpenStack API request.",
+    )
+    parser.add_argument(
+        "--openstack-error-rate",
+        type=float,
+        default=0,
+        help="The fraction of OpenStack API requests that fail.",
+    )
+    parser.add_argument(
+        "--openstack-page-size",
+        type=int,
+        help="The page size for OpenStack API lists.",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="The seed used to decide which requests fail."
+    )
+    parser.add_argument(
+        "--replay",
+        help="Directory of recorded cassettes to replay instead of using the fakes.",
+    )
+    parser.add_argument(
+        "--replay-timing",
+        choices=["yes", "no"],
+        default="yes",
+        help="Whether to delay replayed responses by the recorded durations.",
+    )
+    parser.add_argument("--output", help="File to write the results to.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+Simulator for the lease and schedule lifecycles in virtual time.
+
+The real handlers are run against in-process stand-ins for the Kubernetes and
+OpenStack APIs, with a virtual clock that jumps forward between timer ticks, and past
+the ticks when there are no objects. The handler invocations, API calls and status
+writes that the operator would issue are reported for each simulated day.
+
+Each handler invocation still does the work of the real handler, including the
+requests to the stand-ins, so the time taken is proportional to the number of
+invocations, i.e. the number of live objects multiplied by the number of ticks. As a
+guide, around 500 invocations are simulated per second, and a day with 20 leases and
+20 schedules takes around 40 seconds.
+
+Leases and schedules arrive at random times during the simulation. Leases start
+within a day of arriving and last for a random duration. When the operator deletes
+the owner of a lease, the lease is deleted, and when a schedule deletes the object
+that it references, the schedule is deleted, as the garbage collector would do.
+
+The timers for all objects are run together at each tick, rather than at intervals
+from when each object was created as kopf does, which does not change the number of
+checks that are made.
+
+Run from the repository root with the operator and its requirements installed, e.g.:
+
+    python tools/simulate.py --leases 20 --schedules 20 --days 1
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime
+import heapq
+import json
+import logging
+import random
+import sys
+import time
+from unittest import mock
+
+import httpx
+import kopf
+
+from azimuth_schedule_operator import openstack, operator
+from azimuth_schedule_operator.models import registry
+from azimuth_schedule_operator.tests import util
+from azimuth_schedule_operator.tests.fakes import kubernetes as fake_kubernetes
+from azimuth_schedule_operator.tests.fakes import openstack as fake_openstack
+from azimuth_schedule_operator.utils import clock
+
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+DAY = datetime.timedelta(days=1)
+
+# Status writes are reported separately to the other API calls
+STATUS_WRITES = {"PUT leases/status", "PATCH schedules/status"}
+
+
+class Simulation:
+    """Runs the operator handlers for the simulated objects in virtual time."""
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.clock = clock.VirtualClock(START)
+        self.k8s_fake = fake_kubernetes.FakeKubernetes()
+        self.cloud_fake = fake_openstack.FakeOpenStack()
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.logger = logging.getLogger("simulate")
+        # Heap of (time, sequence, kind, index) for the objects that are yet to arrive
+        self.arrivals = []
+        # Heap of (time, sequence, key) for leases whose deletion is being retried
+        self.deletions = []
+        self.deleting = set()
+        self.sequence = 0
+        # Map of object key -> memo, as kopf keeps for each object
+        self.memos = collections.defaultdict(dict)
+        # The results for each simulated day
+        self.days = []
+        self.invocations = collections.Counter()
+        self.errors = collections.Counter()
+
+    def _push(self, heap, at, *item):
+        self.sequence += 1
+        heapq.heappush(heap, (at, self.sequence, *item))
+
+    def plan(self):
+        """Plans the arrival time for each lease and schedule."""
+        duration = self.args.days * DAY
+        for kind, count in [
+            ("lease", self.args.leases),
+            ("schedule", self.args.schedules),
+        ]:
+            for index in range(count):
+                self._push(
+                    self.arrivals, START + self.random.random() * duration, kind, index
+                )
+
+    def _random_duration(self, minimum, maximum):
+        return minimum + self.random.random() * (maximum - minimum)
+
+    def _add(self, api_version, kind, name, namespace, owner=None, **fields):
+        metadata = {"name": name, "namespace": namespace}
+        if owner:
+            metadata["ownerReferences"] = [
+                {
+                    "apiVersion": owner["apiVersion"],
+                    "kind": owner["kind"],
+                    "name": owner["metadata"]["name"],
+                    "uid": owner["metadata"]["uid"],
+                },
+            ]
+        return self.k8s_fake.add(
+            {"apiVersion": api_version, "kind": kind, "metadata": metadata, **fields}
+        )
+
+    def create_lease(self, index):
+        """Creates a lease, along with its owner and credential, and returns the key."""
+        now = self.clock.now()
+        namespace = f"ns-{index % self.args.namespaces}"
+        credential = self.cloud_fake.add_application_credential()
+        secret = self._add(
+            "v1",
+            "Secret",
+            f"lease-{index}-credential",
+            namespace,
+            data=self.cloud_fake.secret_data(*credential),
+        )
+        owner = self._add("v1", "ConfigMap", f"platform-lease-{index}", namespace)
+        starts_at = now + self._random_duration(datetime.timedelta(), DAY)
+        ends_at = starts_at + self._random_duration(
+            datetime.timedelta(hours=1),
+            datetime.timedelta(hours=self.args.max_lease_hours),
+        )
+        lease = self._add(
+            registry.API_VERSION,
+            "Lease",
+            f"lease-{index}",
+            namespace,
+            owner=owner,
+            spec={
+                "cloudCredentialsSecretName": secret["metadata"]["name"],
+                "startsAt": util.isoformat(starts_at),
+                "endsAt": util.isoformat(ends_at),
+                "resources": {"machines": [{"sizeId": "id1", "count": 1}]},
+            },
+        )
+        return self._key(lease)
+
+    def create_schedule(self, index):
+        now = self.clock.now()
+        namespace = f"ns-{index % self.args.namespaces}"
+        ref = self._add("v1", "ConfigMap", f"platform-schedule-{index}", namespace)
+        not_after = now + self._random_duration(
+            datetime.timedelta(hours=1),
+            datetime.timedelta(hours=self.args.max_lease_hours),
+        )
+        self._add(
+            registry.API_VERSION,
+            "Schedule",
+            f"schedule-{index}",
+            namespace,
+            spec={
+                "ref": {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "name": ref["metadata"]["name"],
+                },
+                "notAfter": util.isoformat(not_after),
+            },
+        )
+
+    def _key(self, obj):
+        metadata = obj["metadata"]
+        return (
+            obj["apiVersion"],
+            f"{obj['kind'].lower()}s",
+            metadata["namespace"],
+            metadata["name"],
+        )
+
+    def _objects(self, plural):
+        return [
+            key
+            for key in self.k8s_fake.objects
+            if key[0] == registry.API_VERSION and key[1] == plural
+        ]
+
+    async def _invoke(self, handler, key, **kwargs):
+        """Invokes the handler for the latest version of the object."""
+        async with self.semaphore:
+            self.invocations[handler.__name__] += 1
+            body = self.k8s_fake.objects[key]
+            try:
+                await handler(body=body, **kwargs)
+            except kopf.TemporaryError as exc:
+                return exc.delay
+            except Exception:
+                self.errors[handler.__name__] += 1
+                return self.args.check_interval
+
+    async def _delete_lease(self, key):
+        delay = await self._invoke(operator.delete_lease, key, logger=self.logger)
+        if delay is None:
+            # The finalizer is removed, so the lease goes away
+            del self.k8s_fake.objects[key]
+            self.deleting.discard(key)
+            self.memos.pop(key, None)
+        else:
+            self._push(
+                self.deletions,
+                self.clock.now() + datetime.timedelta(seconds=delay),
+                key,
+            )
+
+    def collect_garbage(self):
+        """Deletes the objects whose owner or reference was deleted."""
+        deleted = []
+        for key in self._objects("leases"):
+            if key in self.deleting:
+                continue
+            lease = self.k8s_fake.objects[key]
+            owners = lease["metadata"].get("ownerReferences", [])
+            if any(
+                self.k8s_fake.get("v1", "configmaps", key[2], owner["name"]) is None
+                for owner in owners
+            ):
+                lease["metadata"]["deletionTimestamp"] = util.isoformat(
+                    self.clock.now()
+                )
+                self.deleting.add(key)
+                deleted.append(key)
+        for key in self._objects("schedules"):
+            schedule = self.k8s_fake.objects[key]
+            ref = schedule["spec"]["ref"]
+            if self.k8s_fake.get("v1", "configmaps", key[2], ref["name"]) is None:
+                del self.k8s_fake.objects[key]
+        return deleted
+
+    async def tick(self):
+        """Runs the handlers that are due at the current time."""
+        now = self.clock.now()
+        # Create the objects that have arrived, running the create handler for leases
+        created = []
+        while self.arrivals and self.arrivals[0][0] <= now:
+            _, _, kind, index = heapq.heappop(self.arrivals)
+            if kind == "lease":
+                created.append(self.create_lease(index))
+            else:
+                self.create_schedule(index)
+        # Retry the deletions that are due
+        retries = []
+        while self.deletions and self.deletions[0][0] <= now:
+            retries.append(heapq.heappop(self.deletions)[2])
+        await asyncio.gather(
+            *[
+                self._invoke(operator.reconcile_lease, key, logger=self.logger)
+                for key in created
+            ],
+            *[self._delete_lease(key) for key in retries],
+        )
+        # Run the timers for the objects that are not being deleted
+        await asyncio.gather(
+            *[
+                self._invoke(
+                    operator.check_lease,
+                    key,
+                    logger=self.logger,
+                    memo=self.memos[key],
+                )
+                for key in self._objects("leases")
+                if key not in self.deleting
+            ],
+            *[
+                self._invoke(operator.schedule_check, key, namespace=key[2])
+                for key in self._objects("schedules")
+            ],
+        )
+        # Run the delete handler for the objects deleted by the garbage collector
+        await asyncio.gather(
+            *[self._delete_lease(key) for key in self.collect_garbage()]
+        )
+
+    def _record_day(self, day, started_at, invocations, errors, k8s_calls, cloud_calls):
+        k8s_calls = self.k8s_fake.calls - k8s_calls
+        self.days.append(
+            {
+                "day": day,
+                "wallSeconds": time.perf_counter() - started_at,
+                "invocations": dict(self.invocations - invocations),
+                "errors": dict(self.errors - errors),
+                "statusWrites": sum(
+                    count for op, count in k8s_calls.items() if op in STATUS_WRITES
+                ),
+                "calls": {
+                    "kubernetes": dict(k8s_calls),
+                    "openstack": dict(self.cloud_fake.calls - cloud_calls),
+                },
+                "leases": len(self._objects("leases")),
+                "schedules": len(self._objects("schedules")),
+            }
+        )
+
+    def skip_idle(self, until, interval):
+        """
+        Jumps the clock forward to the tick before the next arrival if there are no
+        objects to run the handlers for, as the ticks in between would do nothing.
+        """
+        if self._objects("leases") or self._objects("schedules"):
+            return
+        next_arrival = self.arrivals[0][0] if self.arrivals else until
+        idle_ticks = (min(next_arrival, until) - self.clock.now()) // interval
+        if idle_ticks > 0:
+            self.clock.advance(idle_ticks * interval)
+
+    async def run(self):
+        self.plan()
+        interval = datetime.timedelta(seconds=self.args.check_interval)
+        for day in range(self.args.days):
+            started_at = time.perf_counter()
+            invocations = self.invocations.copy()
+            errors = self.errors.copy()
+            k8s_calls = self.k8s_fake.calls.copy()
+            cloud_calls = self.cloud_fake.calls.copy()
+            end_of_day = START + (day + 1) * DAY
+            while self.clock.now() < end_of_day:
+                await self.tick()
+                self.clock.advance(interval)
+                self.skip_idle(end_of_day, interval)
+            self._record_day(
+                day + 1, started_at, invocations, errors, k8s_calls, cloud_calls
+            )
+
+    def results(self):
+        def per_day(key):
+            return sum(day[key] for day in self.days) / len(self.days)
+
+        return {
+            "config": {
+                "leases": self.args.leases,
+                "schedules": self.args.schedules,
+                "namespaces": self.args.namespaces,
+                "days": self.args.days,
+                "checkInterval": self.args.check_interval,
+                "gracePeriod": self.args.grace_period,
+                "maxLeaseHours": self.args.max_lease_hours,
+                "blazar": self.args.blazar,
+                "seed": self.args.seed,
+            },
+            "perDay": {
+                "invocations": sum(
+                    sum(day["invocations"].values()) for day in self.days
+                )
+                / len(self.days),
+                "apiCalls": sum(
+                    sum(day["calls"]["kubernetes"].values())
+                    + sum(day["calls"]["openstack"].values())
+                    for day in self.days
+                )
+                / len(self.days),
+                "statusWrites": per_day("statusWrites"),
+            },
+            "days": self.days,
+        }
+
+
+async def run(args):
+    simulation = Simulation(args)
+    k8s_client = simulation.k8s_fake.client()
+    from_secret_data = openstack.from_secret_data
+
+    def fake_from_secret_data(secret_data):
+        transport = httpx.ASGITransport(app=simulation.cloud_fake)
+        return from_secret_data(secret_data, transport=transport)
+
+    with (
+        mock.patch.object(clock, "CLOCK", simulation.clock),
+        mock.patch.object(operator, "K8S_CLIENT", k8s_client),
+        mock.patch.object(operator, "LEASE_BLAZAR_ENABLED", args.blazar),
+        mock.patch.object(
+            operator, "LEASE_DEFAULT_GRACE_PERIOD_SECONDS", args.grace_period
+        ),
+        mock.patch.object(openstack, "from_secret_data", fake_from_secret_data),
+    ):
+        async with k8s_client:
+            await simulation.run()
+    return simulation.results()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--leases", type=int, default=20)
+    parser.add_argument("--schedules", type=int, default=20)
+    parser.add_argument("--namespaces", type=int, default=10)
+    parser.add_argument(
+        "--days", type=int, default=1, help="The number of days to simulate."
+    )
+    parser.add_argument(
+        "--check-interval",
+        type=int,
+        default=operator.LEASE_CHECK_INTERVAL_SECONDS,
+        help="The interval in seconds for the lease and schedule timers.",
+    )
+    parser.add_argument(
+        "--grace-period",
+        type=int,
+        default=operator.LEASE_DEFAULT_GRACE_PERIOD_SECONDS,
+        help="The grace period in seconds before the end of a lease.",
+    )
+    parser.add_argument(
+        "--max-lease-hours",
+        type=int,
+        default=72,
+        help="The maximum duration of a lease or schedule, in hours.",
+    )
+    parser.add_argument("--blazar", choices=["yes", "no"], default="no")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="The maximum number of handlers that run at once.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="File to write the results to.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()